@@ -0,0 +1,59 @@
+"""
+Benchmark of in-memory operation compression, comparing the object
+based procedure with the columnar ``OperationBatch`` one.
+
+Usage::
+
+    python -m benchmarks.operation_batch [number of operations]
+"""
+
+import sys
+import random
+import time
+import uuid
+
+from dbsync import batch
+from dbsync.models import OperationRecord
+from dbsync.batch import OperationBatch
+from dbsync.client.compression import compressed_operations
+
+
+def make_operations(n, content_types=20, seed=0):
+    "Builds *n* random operations over roughly n/3 objects."
+    rnd = random.Random(seed)
+    rows = [uuid.UUID(int=rnd.getrandbits(128)) for _ in range(max(1, n // 3))]
+    return [OperationRecord(row_id=rnd.choice(rows),
+                            content_type_id=rnd.randrange(content_types),
+                            command=rnd.choice('iud'),
+                            order=order)
+            for order in range(1, n + 1)]
+
+
+def timed(label, fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    print("{0:<40} {1:8.3f}s".format(label, time.perf_counter() - start))
+    return result
+
+
+def main(n=1000000):
+    assert batch.available, "numpy is required for this benchmark"
+    operations = timed("build {0} records".format(n), make_operations, n)
+
+    previous = batch.MIN_BATCH_SIZE
+    batch.MIN_BATCH_SIZE = n + 1
+    expected = timed("compressed_operations (objects)",
+                     compressed_operations, operations)
+    batch.MIN_BATCH_SIZE = previous
+    compressed = timed("compressed_operations (batch)",
+                       compressed_operations, operations)
+    assert len(compressed) == len(expected)
+
+    operations_batch = timed("OperationBatch.from_operations",
+                             OperationBatch.from_operations, operations)
+    timed("OperationBatch.compressed", operations_batch.compressed)
+    timed("OperationBatch.redundant", operations_batch.redundant)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,107 @@
+"""
+Benchmark of the queries behind ``fill_for``, ``compress``,
+``is_synched`` and ``trim`` over the synchronization tables, with and
+without the indexes declared in ``dbsync.models``. The query plans
+are printed along with the timings.
+
+Usage::
+
+    python -m benchmarks.sync_indexes [number of operations]
+"""
+
+import sys
+import os
+import random
+import tempfile
+import time
+import uuid
+
+from sqlalchemy import create_engine, select, func
+
+from dbsync.models import Base, Operation, Version, Node, UNVERSIONED_INDEX
+from dbsync.indexes import upgrade_indexes, INDEXED_TABLES
+
+
+operations = Operation.__table__
+versions = Version.__table__
+
+
+def populate(engine, n, nodes=20, per_version=50, unversioned=0.05, seed=0):
+    "Inserts *n* operations, most of them versioned."
+    rnd = random.Random(seed)
+    rows = [uuid.UUID(int=rnd.getrandbits(128)) for _ in range(max(1, n // 3))]
+    versioned = int(n * (1 - unversioned))
+    with engine.begin() as connection:
+        connection.execute(Node.__table__.insert(),
+                           [{'node_id': i} for i in range(1, nodes + 1)])
+        connection.execute(versions.insert(),
+                           [{'version_id': v, 'node_id': rnd.randint(1, nodes)}
+                            for v in range(1, versioned // per_version + 2)])
+        connection.execute(operations.insert(), [
+            {'order': order,
+             'row_id': rnd.choice(rows),
+             'content_type_id': rnd.randrange(20),
+             'command': rnd.choice('iud'),
+             'version_id': order // per_version + 1 if order < versioned else None}
+            for order in range(1, n + 1)])
+    return rows
+
+
+def queries(rows, n, per_version=50):
+    "The statements to measure, by procedure."
+    middle = n // per_version // 2
+    return [
+        ("fill_for", select([operations]).
+         where(operations.c.version_id > middle).
+         order_by(operations.c.order)),
+        ("compress", select([operations]).
+         where(operations.c.version_id == None).
+         order_by(operations.c.order.desc())),
+        ("is_synched", select([operations]).
+         where(operations.c.content_type_id == 3).
+         where(operations.c.row_id == rows[0]).
+         order_by(operations.c.order.desc()).limit(1)),
+        ("trim", select([func.max(versions.c.version_id)]).
+         where(versions.c.node_id == 7)),
+    ]
+
+
+def measure(engine, statements, repeat=5):
+    for label, statement in statements:
+        compiled = statement.compile(engine, compile_kwargs={'literal_binds': True})
+        plan = engine.execute("EXPLAIN QUERY PLAN " + str(compiled)).fetchall()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            engine.execute(statement).fetchall()
+        elapsed = (time.perf_counter() - start) / repeat
+        print("{0:<12} {1:8.4f}s  {2}".format(
+            label, elapsed, "; ".join(row[-1] for row in plan)))
+
+
+def main(n=200000):
+    path = tempfile.mktemp(suffix=".db")
+    engine = create_engine("sqlite:///{0}".format(path))
+    try:
+        Base.metadata.create_all(engine)
+        for table in INDEXED_TABLES:
+            for index in table.indexes:
+                index.drop(engine)
+        engine.execute("DROP INDEX {0}".format(UNVERSIONED_INDEX))
+        rows = populate(engine, n)
+        statements = queries(rows, n)
+        print("without indexes")
+        measure(engine, statements)
+        start = time.perf_counter()
+        created = upgrade_indexes(engine)
+        print("created {0} in {1:.3f}s".format(
+            ", ".join(created), time.perf_counter() - start))
+        print("with indexes")
+        measure(engine, statements)
+    finally:
+        engine.dispose()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
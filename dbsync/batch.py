@@ -0,0 +1,207 @@
+"""
+.. module:: dbsync.batch
+   :synopsis: Columnar operation batches for compression and grouping.
+
+An :class:`OperationBatch` holds the ``row_id``, ``content_type_id``,
+``command`` and ``order`` of a sequence of operations as NumPy
+arrays, so the compression rules can be evaluated with array
+operations instead of grouping Python objects.
+
+NumPy is an optional dependency. If it can't be imported,
+:data:`available` is ``False`` and the callers fall back to the
+object based procedures.
+"""
+
+from typing import Iterable, Sequence, Tuple, Any
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+#: Whether columnar batches can be used in this environment.
+available = numpy is not None
+
+#: Minimum number of operations for which a batch is worth building.
+MIN_BATCH_SIZE = 256
+
+#: Command codes, as stored in the ``command`` array.
+INSERT, UPDATE, DELETE = b'i', b'u', b'd'
+
+
+def _factorize(values: Sequence[Any]) -> "numpy.ndarray":
+    """
+    Returns an array of integer codes, one for each distinct value in
+    *values* (which must be hashable).
+    """
+    index = {}
+    return numpy.fromiter(
+        (index.setdefault(v, len(index)) for v in values),
+        dtype=numpy.int64,
+        count=len(values))
+
+
+class OperationBatch(object):
+    """
+    Columnar view over a sequence of operations.
+
+    *row_id* is an array of integer codes (equal row ids share a
+    code), *content_type_id* and *order* are integer arrays and
+    *command* is an array of single bytes. Positions in the arrays
+    refer to positions in the original sequence, so results can be
+    mapped back to the operation objects.
+    """
+
+    def __init__(self, row_id, content_type_id, command, order):
+        self.row_id = row_id
+        self.content_type_id = content_type_id
+        self.command = command
+        self.order = order
+
+    @classmethod
+    def from_columns(cls, row_ids: Sequence[Any],
+                     content_type_ids: Sequence[int],
+                     commands: Sequence[str],
+                     orders: Sequence[int]) -> "OperationBatch":
+        "Builds a batch from parallel sequences of column values."
+        assert available, "numpy is required to build operation batches"
+        n = len(row_ids)
+        return cls(
+            _factorize(row_ids),
+            numpy.fromiter(content_type_ids, dtype=numpy.int64, count=n),
+            numpy.frombuffer("".join(commands).encode("ascii"), dtype='S1'),
+            numpy.fromiter(orders, dtype=numpy.int64, count=n))
+
+    @classmethod
+    def from_operations(cls, operations: Sequence[Any]) -> "OperationBatch":
+        "Builds a batch from operation objects (mapped or records)."
+        return cls.from_columns(
+            [op.row_id for op in operations],
+            [op.content_type_id for op in operations],
+            [op.command for op in operations],
+            [op.order for op in operations])
+
+    @classmethod
+    def from_rows(cls, rows: Sequence[Tuple[Any, int, str, int]]) -> "OperationBatch":
+        """
+        Builds a batch from (row_id, content_type_id, command, order)
+        tuples, e.g. the result of a column query.
+        """
+        if not rows:
+            return cls.from_columns([], [], [], [])
+        return cls.from_columns(*zip(*rows))
+
+    def __len__(self):
+        return len(self.order)
+
+    def sort_index(self) -> "numpy.ndarray":
+        """
+        Returns the permutation that sorts the batch by object
+        (content type and row) and then by order.
+        """
+        return numpy.lexsort((self.order, self.row_id, self.content_type_id))
+
+    def groups(self, index: "numpy.ndarray") -> Tuple["numpy.ndarray", "numpy.ndarray"]:
+        """
+        Returns the (starts, ends) bounds of each object's operation
+        sequence, as positions in the sorted *index*.
+        """
+        n = len(index)
+        if n == 0:
+            empty = numpy.zeros(0, dtype=numpy.int64)
+            return empty, empty
+        ct = self.content_type_id[index]
+        rows = self.row_id[index]
+        change = numpy.flatnonzero((ct[1:] != ct[:-1]) | (rows[1:] != rows[:-1])) + 1
+        starts = numpy.concatenate(([0], change))
+        ends = numpy.concatenate((change, [n]))
+        return starts, ends
+
+    def group_first(self) -> "numpy.ndarray":
+        "Returns the positions of the oldest operation of each object."
+        index = self.sort_index()
+        starts, _ = self.groups(index)
+        return index[starts]
+
+    def group_last(self) -> "numpy.ndarray":
+        "Returns the positions of the newest operation of each object."
+        index = self.sort_index()
+        _, ends = self.groups(index)
+        return index[ends - 1]
+
+    def _sequences(self):
+        index = self.sort_index()
+        starts, ends = self.groups(index)
+        commands = self.command[index]
+        first = commands[starts] if len(index) else commands
+        last = commands[ends - 1] if len(index) else commands
+        return index, starts, ends, commands, first, last
+
+    def compressed(self) -> Tuple["numpy.ndarray", "numpy.ndarray"]:
+        """
+        Reduces each object's command sequence following the rules of
+        ``dbsync.client.compression.compressed_operations``.
+
+        Returns a pair of arrays of positions (*kept*, *updates*),
+        both sorted by order. *kept* are the operations that remain
+        as they are; *updates* are operations that must be replaced
+        by an update (a delete followed by an insert).
+        """
+        index, starts, ends, commands, first, last = self._sequences()
+        single = (ends - starts) == 1
+        keep_first = single | \
+            ((first == INSERT) & (last != DELETE)) | \
+            ((first == UPDATE) & (last != DELETE)) | \
+            ((first == DELETE) & (last == DELETE))
+        keep_last = ~single & (
+            ((first == UPDATE) & (last == DELETE)) |
+            ((first == DELETE) & (last == UPDATE)))
+        make_update = ~single & (first == DELETE) & (last == INSERT)
+        kept = numpy.concatenate((index[starts[keep_first]],
+                                  index[ends[keep_last] - 1]))
+        updates = index[ends[make_update] - 1]
+        kept = kept[numpy.argsort(self.order[kept], kind='stable')]
+        updates = updates[numpy.argsort(self.order[updates], kind='stable')]
+        return kept, updates
+
+    def redundant(self) -> "numpy.ndarray":
+        """
+        Returns the positions of the operations that can be removed
+        from an operations log, following the rules of
+        ``dbsync.client.compression.compress``.
+        """
+        index, starts, ends, commands, first, last = self._sequences()
+        if len(index) == 0:
+            return index
+        sizes = ends - starts
+        updates = numpy.add.reduceat((commands == UPDATE).astype(numpy.int64), starts)
+        # all operations after the oldest one are updates
+        rest_updates = updates - (first == UPDATE) == sizes - 1
+        multiple = sizes > 1
+        drop_all_but_first = multiple & (first == INSERT) & rest_updates
+        drop_all = multiple & (first == INSERT) & ~rest_updates & (last == DELETE)
+        drop_all_but_last = multiple & (first == UPDATE) & \
+            (((updates == sizes)) | (last == DELETE))
+        group_of = numpy.repeat(numpy.arange(len(starts)), sizes)
+        position = numpy.arange(len(index)) - starts[group_of]
+        mask = (drop_all_but_first[group_of] & (position > 0)) | \
+            drop_all[group_of] | \
+            (drop_all_but_last[group_of] & (position < sizes[group_of] - 1))
+        return index[mask]
+
+    def inconsistent(self) -> "numpy.ndarray":
+        """
+        Returns the positions (sorted by object and order) of the
+        operations belonging to inconsistent sequences: anything but
+        updates between the first and last operation, anything after
+        a delete, or anything before an insert.
+        """
+        index, starts, ends, commands, first, last = self._sequences()
+        if len(index) == 0:
+            return index
+        sizes = ends - starts
+        others = numpy.add.reduceat((commands != UPDATE).astype(numpy.int64), starts)
+        interior = others - (first != UPDATE) - numpy.where(sizes > 1, last != UPDATE, 0)
+        bad = (interior > 0) | ((sizes > 1) & ((first == DELETE) | (last == INSERT)))
+        group_of = numpy.repeat(numpy.arange(len(starts)), sizes)
+        return index[bad[group_of]]
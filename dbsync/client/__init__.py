@@ -9,6 +9,7 @@ yet.
 import inspect
 
 from dbsync.client.compression import unsynched_objects, trim
+from dbsync.client.status import sync_status, model_status, pending_summary
 from dbsync.client.tracking import track, start_tracking
 
 from dbsync.client.register import (
@@ -9,14 +9,29 @@ from sqlalchemy.orm import Query
 
 from dbsync.lang import *
 from dbsync.utils import get_pk, query_model
-from dbsync import core
-from dbsync.models import Version, Operation, SQLClass
+from dbsync import core, batch
+from dbsync.batch import OperationBatch
+from dbsync.models import Version, Operation, OperationRecord, SQLClass
 from dbsync.logs import get_logger
 
 
 logger = get_logger(__name__)
 
 
+#: Command left pending for a row when *command* (second) is tracked
+#  after a pending *command* (first), following the rules of
+#  :func:`compressed_operations`. The pending operation is kept if
+#  the command doesn't change, and dropped along with the new one if
+#  it's ``None``. Missing pairs are inconsistent sequences.
+COMPACTION = {
+    ('i', 'u'): 'i',
+    ('i', 'd'): None,
+    ('u', 'u'): 'u',
+    ('u', 'd'): 'd',
+    ('d', 'i'): 'u',
+}
+
+
 def _assert_operation_sequence(seq, session=None):
     """
     Asserts the correctness of a sequence of operations over a single
@@ -58,17 +73,8 @@ def _assert_operation_sequence(seq, session=None):
                 seq)
 
 
-@core.session_committing
-def compress(session=None) -> List[Operation]:
-    """
-    Compresses unversioned operations in the database.
-
-    For each row in the operations table, this deletes unnecesary
-    operations that would otherwise bloat the message.
-
-    This procedure is called internally before the 'push' request
-    happens, and before the local 'merge' happens.
-    """
+def _delete_redundant(session):
+    "Deletes redundant unversioned operations, grouping objects."
     unversioned: Query = session.query(Operation).\
         filter(Operation.version_id == None).order_by(Operation.order.desc())
     seqs = group_by(lambda op: (op.row_id, op.content_type_id), unversioned)
@@ -92,6 +98,52 @@ def compress(session=None) -> List[Operation]:
             elif seq[0].command == 'd':
                 # leave the delete statement
                 list(map(session.delete, seq[1:]))
+
+
+def _delete_redundant_batch(session):
+    """
+    Like *_delete_redundant*, but evaluated over an
+    ``OperationBatch`` of the operation columns.
+    """
+    rows = session.query(Operation.row_id,
+                         Operation.content_type_id,
+                         Operation.command,
+                         Operation.order).\
+        filter(Operation.version_id == None).all()
+    operations = OperationBatch.from_rows(rows)
+
+    # Check errors on sequences
+    inconsistent = group_by(
+        lambda op: (op.row_id, op.content_type_id),
+        (OperationRecord(row_id=row_id, content_type_id=ct_id,
+                         command=command, order=order)
+         for row_id, ct_id, command, order in
+         (rows[i] for i in operations.inconsistent()[::-1])))
+    for seq in list(inconsistent.values()):
+        _assert_operation_sequence(seq, session)
+
+    redundant = operations.order[operations.redundant()].tolist()
+    for orders in grouper(redundant, core.MAX_SQL_VARIABLES):
+        session.query(Operation).\
+            filter(Operation.order.in_(orders)).\
+            delete(synchronize_session=False)
+
+
+@core.session_committing
+def compress(session=None) -> List[Operation]:
+    """
+    Compresses unversioned operations in the database.
+
+    For each row in the operations table, this deletes unnecesary
+    operations that would otherwise bloat the message.
+
+    This procedure is called internally before the 'push' request
+    happens, and before the local 'merge' happens.
+    """
+    if batch.available:
+        _delete_redundant_batch(session)
+    else:
+        _delete_redundant(session)
     session.flush()
 
     # repair inconsistencies
@@ -150,8 +202,12 @@ def compressed_operations(operations):
     """
     Compresses a set of operations so as to avoid redundant
     ones. Returns the compressed set sorted by operation order. This
-    procedure doesn't perform database operations.
+    procedure doesn't perform database operations, and operations
+    synthesized by it are instances of ``OperationRecord``.
     """
+    operations = list(operations)
+    if batch.available and len(operations) >= batch.MIN_BATCH_SIZE:
+        return _batch_compressed_operations(operations)
     seqs = group_by(lambda op: (op.row_id, op.content_type_id),
                     sorted(operations, key=attr('order')))
     compressed = []
@@ -176,15 +232,32 @@ def compressed_operations(operations):
             else: # seq[-1].command == 'i':
                 op = seq[-1]
                 compressed.append(
-                    Operation(order=op.order,
-                              content_type_id=op.content_type_id,
-                              row_id=op.row_id,
-                              version_id=op.version_id,
-                              command='u'))
+                    OperationRecord(order=op.order,
+                                    content_type_id=op.content_type_id,
+                                    row_id=op.row_id,
+                                    version_id=op.version_id,
+                                    command='u'))
     compressed.sort(key=attr('order'))
     return compressed
 
 
+def _batch_compressed_operations(operations):
+    "*compressed_operations* evaluated over an ``OperationBatch``."
+    kept, updates = OperationBatch.from_operations(operations).compressed()
+    compressed = [operations[i] for i in kept]
+    for i in updates:
+        op = operations[i]
+        compressed.append(
+            OperationRecord(order=op.order,
+                            content_type_id=op.content_type_id,
+                            row_id=op.row_id,
+                            version_id=op.version_id,
+                            command='u'))
+    if len(updates):
+        compressed.sort(key=attr('order'))
+    return compressed
+
+
 @core.session_committing
 def unsynched_objects(session=None):
     """
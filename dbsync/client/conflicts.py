@@ -15,13 +15,11 @@ horizontally decentralized relational databases. `Link to pdf`__.
 """
 
 from sqlalchemy import or_
-from sqlalchemy.orm import undefer
-from sqlalchemy.schema import UniqueConstraint
-from sqlalchemy.sql import Join
 
 from dbsync.lang import *
-from dbsync.utils import get_pk, class_mapper, query_model, column_properties, entity_name
-from dbsync.core import synched_models, null_model
+from dbsync.utils import get_pk, class_mapper, column_properties, entity_name, \
+    unique_matches
+from dbsync.core import synched_models, null_model, MAX_SQL_VARIABLES
 from dbsync.models import Operation
 from dbsync.createlogger import create_logger
 
@@ -32,22 +30,18 @@ def get_related_tables(sa_class):
     Returns a list of related SA tables dependent on the given SA
     model by foreign key.
     """
-    mapper = class_mapper(sa_class)
-    models = iter(list(synched_models.models.keys()))
-    return [
-        table
-        for table
-        in (
-            class_mapper(model).mapped_table
-            for model
-            in models
-        )
-        if mapper.mapped_table in [
-            key.column.table
-            for key
-            in table.foreign_keys
-        ]
-    ]
+    return [synched_models.metadata[child].table
+            for child, _ in get_related_models(sa_class)]
+
+
+def get_related_models(sa_class):
+    """
+    Returns a list of pairs (model, foreign key names) of the
+    synchronized models dependent on the given SA model by foreign
+    key, as precomputed when the models were installed.
+    """
+    meta = synched_models.metadata.get(sa_class, None)
+    return list(meta.children) if meta is not None else []
 
 
 def get_fks(table_from, table_to):
@@ -61,6 +55,81 @@ def get_fks(table_from, table_to):
     return [fk.parent.name for fk in fks]
 
 
+def _parent_ids(operations):
+    "Groups the row ids of *operations* by tracked model."
+    ids = {}
+    for operation in operations:
+        model = operation.tracked_model
+        if model is not None:
+            ids.setdefault(model, set()).add(operation.row_id)
+    return ids
+
+
+def _collect(operations, index):
+    """
+    Returns a dictionary of (operation, set of related (row id,
+    content type id) pairs), given an *index* of (parent model,
+    {parent id: related pairs}).
+    """
+    return dict(
+        (operation, set(index.get(operation.tracked_model, {}).\
+                        get(operation.row_id, ())))
+        for operation in operations)
+
+
+def related_local_ids_batch(operations, session):
+    """
+    Like *related_local_ids*, for many operations at once. Returns a
+    dictionary of (operation, set of related pairs).
+
+    The dependent rows of all the operations over the same model are
+    looked up with one ``IN`` query per related model (and batch of
+    ids), selecting only the primary key and foreign key columns.
+    """
+    index = {}
+    for parent_model, ids in _parent_ids(operations).items():
+        related = index.setdefault(parent_model, {})
+        for model, fks in get_related_models(parent_model):
+            ct = synched_models.models.get(model, None)
+            if ct is None:
+                continue
+            pk = getattr(model, synched_models.metadata[model].pk)
+            columns = [getattr(model, fk) for fk in fks]
+            for batch in grouper(ids, max(1, MAX_SQL_VARIABLES // len(fks))):
+                batch = list(batch)
+                for row in session.query(pk, *columns).\
+                        filter(or_(*(column.in_(batch) for column in columns))):
+                    for value in row[1:]:
+                        if value is not None:
+                            related.setdefault(value, set()).add((row[0], ct.id))
+    return _collect(operations, index)
+
+
+def related_remote_ids_batch(operations, container):
+    """
+    Like *related_remote_ids*, for many operations at once. The
+    objects of each related model in *container* are filtered once
+    per foreign key, for all the ids of the parent model (in batches),
+    so a payload store answers through its reference index instead
+    of reading every object.
+    """
+    index = {}
+    for parent_model, ids in _parent_ids(operations).items():
+        related = index.setdefault(parent_model, {})
+        for model, fks in get_related_models(parent_model):
+            ct = synched_models.models.get(model, None)
+            if ct is None:
+                continue
+            pk = synched_models.metadata[model].pk
+            for fk in fks:
+                for batch in grouper(ids, MAX_SQL_VARIABLES):
+                    for obj in container.query(model).\
+                            filter(attr(fk).in_(set(batch))):
+                        related.setdefault(getattr(obj, fk), set()).add(
+                            (getattr(obj, pk), ct.id))
+    return _collect(operations, index)
+
+
 def related_local_ids(operation, session):
     """
     For the given operation, return a set of row id values mapped to
@@ -68,50 +137,8 @@ def related_local_ids(operation, session):
     foreign key on the object being operated upon. The lookups are
     performed in the local database.
     """
-    parent_model = operation.tracked_model
-    if parent_model is None:
-        return set()
-    related_tables = get_related_tables(parent_model)
-
-    mapped_fks = [
-        m_fks
-        for m_fks
-        in [
-            (
-                synched_models.tables.get(entity_name(t), null_model).model,
-                get_fks(t, class_mapper(parent_model).mapped_table)
-            )
-            for t
-            in related_tables
-        ]
-        if m_fks[0] is not None and m_fks[1]
-    ]
-    try:
-        return set(
-            (pk, ct.id)
-            for pk, ct
-            in (
-                (getattr(obj, get_pk(obj)), synched_models.models.get(model, None))
-                for model, fks in mapped_fks
-                for obj in query_model(session, model) \
-                    # removed the pk_only param, because that fails with joins
-                    .filter(
-                        or_(
-                            *(
-                                getattr(model, fk) == operation.row_id
-                                for fk
-                                in fks
-                            )
-                        )
-                    ).all()
-            )
-            if ct is not None
-        )
-    except Exception as ex:
-        logger.exception(f"collecting conflicts failed: {ex}")
-        r0 = [query_model(session, model) for model, fks in mapped_fks]
-        r1 = [query_model(session, model).all() for model, fks in mapped_fks]
-        raise
+    return related_local_ids_batch([operation], session)[operation]
+
 
 def related_remote_ids(operation, container):
     """
@@ -119,23 +146,7 @@ def related_remote_ids(operation, container):
     *container*, that's an instance of
     *dbsync.messages.base.BaseMessage*.
     """
-    parent_model = operation.tracked_model
-    if parent_model is None:
-        return set()
-    related_tables = get_related_tables(parent_model)
-
-    mapped_fks = [m_fks1 for m_fks1 in [(synched_models.tables.get(entity_name(t), null_model).model,
-                                         get_fks(t, class_mapper(parent_model).mapped_table))
-                                        for t in related_tables] if m_fks1[0] is not None and m_fks1[1]]
-    return set(
-        (pk, ct.id)
-        for pk, ct in \
-        ((getattr(obj, get_pk(obj)), synched_models.models.get(model, None))
-         for model, fks in mapped_fks
-         for obj in container.query(model). \
-             filter(lambda obj: any(getattr(obj, fk) == operation.row_id
-                                    for fk in fks)))
-        if ct is not None)
+    return related_remote_ids_batch([operation], container)[operation]
 
 
 def find_direct_conflicts(pull_ops, unversioned_ops):
@@ -162,10 +173,9 @@ def find_dependency_conflicts(pull_ops, unversioned_ops, session):
     message on objects that have dependent objects inserted or updated
     on the local database.
     """
-    related_ids = dict(
-        (pull_op, related_local_ids(pull_op, session))
-        for pull_op in pull_ops
-        if pull_op.command == 'd')
+    related_ids = related_local_ids_batch(
+        [pull_op for pull_op in pull_ops if pull_op.command == 'd'],
+        session)
     return [
         (pull_op, local_op)
         for pull_op in pull_ops
@@ -180,10 +190,9 @@ def find_reversed_dependency_conflicts(pull_ops, unversioned_ops, pull_message):
     Deletes on the local database on objects that are referenced by
     inserted or updated objects in the pull message.
     """
-    related_ids = dict(
-        (local_op, related_remote_ids(local_op, pull_message))
-        for local_op in unversioned_ops
-        if local_op.command == 'd')
+    related_ids = related_remote_ids_batch(
+        [local_op for local_op in unversioned_ops if local_op.command == 'd'],
+        pull_message)
     return [
         (pull_op, local_op)
         for local_op in unversioned_ops
@@ -230,49 +239,73 @@ def find_unique_conflicts(pull_ops, unversioned_ops, pull_message, session):
         columns: tuple of column names in the unique constraint
     """
 
-    def verify_constraint(model, columns, values):
-        """
-        Checks to see whether some local object exists with
-        conflicting values.
-        """
-        match = query_model(session, model, only_pk=True). \
-            options(*(undefer(column) for column in columns)). \
-            filter_by(**dict((column, value)
-                             for column, value in zip(columns, values))).first()
-        pk = get_pk(model)
-        return match, getattr(match, pk, None)
+    # keyed to content type
+    unversioned_pks = dict((ct_id, set(op.row_id for op in unversioned_ops
+                                       if op.content_type_id == ct_id
+                                       if op.command != 'd'))
+                           for ct_id in set(operation.content_type_id
+                                            for operation in unversioned_ops))
+    # the lists to fill with conflicts and errors
+    conflicts, errors = [], []
+
+    for batch in grouper(pull_ops, MAX_SQL_VARIABLES):
+        _batch_unique_conflicts(batch, unversioned_pks, pull_message, session,
+                                conflicts, errors)
+    return conflicts, errors
+
+
+def _batch_unique_conflicts(pull_ops, unversioned_pks, pull_message, session,
+                            conflicts, errors):
+    """
+    Fills *conflicts* and *errors* with the unique conflicts of a
+    batch of *pull_ops*. The remote objects of the batch are read
+    from the message by primary key and the local matches are looked
+    up once per model and unique constraint, so only a batch of
+    objects is in memory at once.
+    """
+    remote_objects = {}
+    local_matches = {}
+    for model in set(op.tracked_model for op in pull_ops) - {None}:
+        meta = synched_models.metadata[model]
+        if not meta.unique: continue
+        remote_objects[model] = pull_message.get_objects(
+            model, (op.row_id for op in pull_ops if op.tracked_model is model))
+        for unique_columns in meta.unique:
+            local_matches[(model, unique_columns)] = unique_matches(
+                model, unique_columns,
+                set(tuple(getattr(obj, column) for column in unique_columns)
+                    for obj in remote_objects[model].values()),
+                session)
 
     def get_remote_values(model, row_id, columns):
         """
         Gets the conflicting values out of the remote object set
         (*container*).
         """
-        obj = pull_message.query(model).filter(attr('__pk__') == row_id).first()
+        obj = remote_objects[model].get(row_id, None)
         if obj is not None:
             return tuple(getattr(obj, column) for column in columns)
         return (None,)
 
-    # keyed to content type
-    unversioned_pks = dict((ct_id, set(op.row_id for op in unversioned_ops
-                                       if op.content_type_id == ct_id
-                                       if op.command != 'd'))
-                           for ct_id in set(operation.content_type_id
-                                            for operation in unversioned_ops))
-    # the lists to fill with conflicts and errors
-    conflicts, errors = [], []
+    def get_remote_object(model, pk):
+        obj = remote_objects[model].get(pk, None)
+        if obj is None:
+            obj = pull_message.get_objects(model, [pk]).get(pk, None)
+        return obj
+
+    def verify_constraint(model, columns, values):
+        """
+        Checks to see whether some local object exists with
+        conflicting values.
+        """
+        match = local_matches[(model, columns)].get(values, None)
+        return match, getattr(match, synched_models.metadata[model].pk, None)
 
     for op in pull_ops:
         model = op.tracked_model
+        if model is None: continue
 
-        mt = class_mapper(model).mapped_table
-        if isinstance(mt, Join):
-            constraints = mt.left.constraints.union(mt.right.constraints)
-        else:
-            constraints = mt.constraints
-
-        for constraint in [c for c in constraints if isinstance(c, UniqueConstraint)]:
-
-            unique_columns = tuple(col.name for col in constraint.columns)
+        for unique_columns in synched_models.metadata[model].unique:
             # Unique values on the server, to check conflicts with local database
             remote_values = get_remote_values(model, op.row_id, unique_columns)
 
@@ -295,8 +328,7 @@ def find_unique_conflicts(pull_ops, unversioned_ops, pull_message, session):
                 continue
 
             # if pk_conflict != op.row_id:
-            remote_obj = pull_message.query(model). \
-                filter(attr('__pk__') == pk_conflict).first()
+            remote_obj = get_remote_object(model, pk_conflict)
 
             if remote_obj is not None and not is_unversioned:
                 old_values = tuple(getattr(obj_conflict, column)
@@ -309,7 +341,7 @@ def find_unique_conflicts(pull_ops, unversioned_ops, pull_message, session):
                 if old_values != new_values:
                     # Library error
                     # It's necesary to first update the unique value
-                    session.refresh(obj_conflict, column_properties(obj_conflict))
+                    # (the local match is loaded with all its columns)
                     conflicts.append(
                         {'object': obj_conflict,
                          'columns': unique_columns,
@@ -333,4 +365,3 @@ def find_unique_conflicts(pull_ops, unversioned_ops, pull_message, session):
                     {'model': type(obj_conflict),
                      'pk': pk_conflict,
                      'columns': unique_columns})
-    return conflicts, errors
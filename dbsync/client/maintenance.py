@@ -0,0 +1,209 @@
+"""
+Housekeeping of the local synchronization tables and database file.
+
+Versioned operations and old versions are of no use to a client once
+merged, and SQLite files keep their free pages unless vacuumed.
+:class:`Maintenance` runs these chores in small steps, each bounded
+to a batch of rows or pages, within a time budget, and yields to the
+event loop between steps so that it can run in idle time without
+blocking the application:
+
+1. delete the versioned operations (like ``compression.trim``),
+2. delete every version but the latest one,
+3. release free pages with ``PRAGMA incremental_vacuum``, if the
+   database uses incremental auto-vacuum (see
+   :func:`enable_incremental_vacuum`),
+4. refresh the planner statistics with a bounded ``ANALYZE``.
+
+Maintenance is due after a successful synchronization (see
+:meth:`Maintenance.request`) or when the versioned operations or the
+free pages cross their thresholds. Steps interrupted by the budget
+resume on the next run.
+"""
+
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Callable, Iterator, Optional
+
+from sqlalchemy import func
+from sqlalchemy.engine import Engine
+
+from dbsync import core
+from dbsync.models import Operation, Version
+from dbsync.logs import get_logger
+
+
+logger = get_logger(__name__)
+
+#: Seconds each maintenance run may take.
+MAINTENANCE_BUDGET = 0.2
+
+#: Rows deleted by each step.
+MAINTENANCE_BATCH_SIZE = 500
+
+#: Pages released by each incremental vacuum step.
+VACUUM_PAGES = 256
+
+#: Versioned operations that make maintenance due.
+OPERATIONS_THRESHOLD = 10000
+
+#: Free pages that make maintenance due.
+FREE_PAGES_THRESHOLD = 2048
+
+#: Rows sampled per index by ANALYZE (``PRAGMA analysis_limit``).
+ANALYSIS_LIMIT = 400
+
+#: ``PRAGMA auto_vacuum`` value of incremental mode.
+INCREMENTAL = 2
+
+
+@dataclass
+class MaintenanceReport:
+    operations: int = 0
+    versions: int = 0
+    pages: int = 0
+    analyzed: bool = False
+    steps: int = 0
+    duration: float = 0.0
+    #: Whether every chore was done (False if the budget ran out).
+    finished: bool = False
+
+
+def enable_incremental_vacuum(engine: Optional[Engine] = None) -> None:
+    """
+    Switches a SQLite database to incremental auto-vacuum. This runs
+    a full ``VACUUM`` once, so it should be called at a convenient
+    time (e.g. at installation).
+    """
+    engine = engine or core.get_engine()
+    if engine.dialect.name != 'sqlite':
+        return
+    with engine.connect() as connection:
+        if connection.execute("PRAGMA auto_vacuum").scalar() != INCREMENTAL:
+            connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            connection.execute("VACUUM")
+
+
+def _delete_batch(model, column, criterion) -> int:
+    with core.committing_context() as session:
+        keys = [key for (key,) in session.query(column).filter(criterion).\
+                limit(MAINTENANCE_BATCH_SIZE)]
+        if keys:
+            session.query(model).filter(column.in_(keys)).\
+                delete(synchronize_session=False)
+        return len(keys)
+
+
+class Maintenance(object):
+    """
+    Runs the maintenance chores in idle time. *idle* is called before
+    each step, and the run stops if it returns ``False`` (e.g. while
+    a synchronization is in progress).
+    """
+
+    def __init__(self, engine: Optional[Engine] = None,
+                 budget: float = MAINTENANCE_BUDGET,
+                 idle: Optional[Callable[[], bool]] = None):
+        self.engine = engine
+        self.budget = budget
+        self.idle = idle or (lambda: True)
+        self.requested = False
+        self._steps: Optional[Iterator[None]] = None
+        self._report = MaintenanceReport()
+
+    @property
+    def _engine(self) -> Engine:
+        return self.engine or core.get_engine()
+
+    def request(self) -> None:
+        "Marks maintenance as due, e.g. after a successful synchronization."
+        self.requested = True
+
+    def _free_pages(self) -> int:
+        if self._engine.dialect.name != 'sqlite':
+            return 0
+        return self._engine.execute("PRAGMA freelist_count").scalar() or 0
+
+    def due(self) -> bool:
+        "Returns whether maintenance should run."
+        if self.requested or self._steps is not None:
+            return True
+        with core.committing_context() as session:
+            versioned = session.query(func.count(Operation.order)).\
+                filter(Operation.version_id != None).scalar()
+        return versioned > OPERATIONS_THRESHOLD or \
+            self._free_pages() > FREE_PAGES_THRESHOLD
+
+    def _chores(self) -> Iterator[None]:
+        report = self._report
+        while True:
+            count = _delete_batch(Operation, Operation.order,
+                                  Operation.version_id != None)
+            report.operations += count
+            yield
+            if count < MAINTENANCE_BATCH_SIZE:
+                break
+        latest = core.get_latest_version_id()
+        while latest is not None:
+            count = _delete_batch(Version, Version.version_id,
+                                  Version.version_id != latest)
+            report.versions += count
+            yield
+            if count < MAINTENANCE_BATCH_SIZE:
+                break
+        engine = self._engine
+        if engine.dialect.name != 'sqlite':
+            return
+        with engine.connect() as connection:
+            incremental = connection.execute("PRAGMA auto_vacuum").scalar() \
+                == INCREMENTAL
+        while incremental:
+            free = self._free_pages()
+            if not free:
+                break
+            with engine.connect() as connection:
+                connection.execute(
+                    "PRAGMA incremental_vacuum({0})".format(VACUUM_PAGES)).\
+                    fetchall()
+            report.pages += min(free, VACUUM_PAGES)
+            yield
+        with engine.connect() as connection:
+            connection.execute(
+                "PRAGMA analysis_limit = {0}".format(ANALYSIS_LIMIT))
+            connection.execute("ANALYZE")
+        report.analyzed = True
+
+    def run_step(self) -> bool:
+        "Runs one step. Returns whether there are steps left."
+        if self._steps is None:
+            self._steps = self._chores()
+            self._report = MaintenanceReport()
+            self.requested = False
+        try:
+            next(self._steps)
+            self._report.steps += 1
+            return True
+        except StopIteration:
+            self._steps = None
+            self._report.finished = True
+            return False
+
+    async def run(self, budget: Optional[float] = None) -> MaintenanceReport:
+        """
+        Runs maintenance steps until they're done, the time budget is
+        spent or the application stops being idle, yielding to the
+        event loop between steps. Returns the report of the chores,
+        which accumulates over interrupted runs.
+        """
+        budget = self.budget if budget is None else budget
+        start = time.monotonic()
+        while self.idle() and self.run_step():
+            if time.monotonic() - start >= budget:
+                break
+            await asyncio.sleep(0)
+        report = self._report
+        report.duration += time.monotonic() - start
+        if report.finished:
+            logger.info("maintenance done: %s", report)
+        return report
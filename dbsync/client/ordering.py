@@ -0,0 +1,70 @@
+"""
+Order keys for operations inserted in the middle of the local log.
+
+When a merge finds a dependency conflict it registers a reinsertion
+operation that must come before every unversioned operation. Instead
+of shifting the whole unversioned log by one for each of them, the
+unversioned operations are moved once, leaving a gap of
+``ORDER_GAP`` free keys, and later reinsertions take keys from that
+gap.
+"""
+
+from typing import List
+
+from sqlalchemy import func
+
+from dbsync.models import Operation
+from dbsync.logs import get_logger
+
+
+logger = get_logger(__name__)
+
+#: Free order keys left before the unversioned operations when the
+#  log has to be respaced.
+ORDER_GAP = 1024
+
+
+class OrderAllocator(object):
+    """
+    Hands out order keys placed after the keys handed out before and
+    before every operation in *operations* (the unversioned
+    operations, a list that may shrink while the allocator is used).
+    """
+
+    def __init__(self, operations: List[Operation], session):
+        self.operations = operations
+        self.session = session
+        self.last = None
+
+    def before(self) -> int:
+        "Returns a free order key placed before the operations."
+        if not self.operations:
+            self.last = self._max_order() + 1 if self.last is None \
+                else self.last + 1
+            return self.last
+        first = min(op.order for op in self.operations)
+        if self.last is None:
+            self.last = self.session.query(func.max(Operation.order)).\
+                filter(Operation.order < first).scalar() or 0
+        if self.last + 1 >= first:
+            first = self._respace(first)
+        self.last += 1
+        return self.last
+
+    def _max_order(self) -> int:
+        return self.session.query(func.max(Operation.order)).scalar() or 0
+
+    def _respace(self, first: int) -> int:
+        """
+        Moves the operations past every order key in use, plus
+        ``ORDER_GAP``, keeping their relative order. Returns the new
+        first key.
+        """
+        self.session.flush()
+        shift = self._max_order() - first + 1 + ORDER_GAP
+        for op in sorted(self.operations, key=lambda op: op.order,
+                         reverse=True):
+            op.order = op.order + shift
+        self.session.flush()
+        logger.info("respaced %s operations by %s", len(self.operations), shift)
+        return first + shift
@@ -2,8 +2,12 @@
 Pull, merge and related operations.
 """
 
+import asyncio
 import collections
+import time
+from dataclasses import dataclass
 
+from sqlalchemy import case, literal
 from sqlalchemy.orm import make_transient
 
 from dbsync.core import get_latest_version_id
@@ -16,14 +20,14 @@ from dbsync import dialects
 from dbsync.messages.pull import PullMessage, PullRequestMessage
 from dbsync.client.compression import compress, compressed_operations
 from dbsync.client.conflicts import (
-    get_related_tables,
-    get_fks,
+    get_related_models,
     find_direct_conflicts,
     find_dependency_conflicts,
     find_reversed_dependency_conflicts,
     find_insert_conflicts,
     find_unique_conflicts)
 from dbsync.client.net import post_request
+from dbsync.client.ordering import OrderAllocator
 
 
 logger = create_logger("client/pull")
@@ -47,30 +51,75 @@ def max_remote(model, container):
     return max(getattr(obj, get_pk(obj)) for obj in container.query(model))
 
 
-def update_local_id(old_id, new_id, model, session):
+class IdAllocator(object):
     """
-    Updates the tuple matching *old_id* with *new_id*, and updates all
-    dependent tuples in other tables as well.
+    Hands out new primary keys for local objects moved out of the way
+    of pulled ones. Each model is seeded once, from the maximum key
+    in *container* and in the local database, and incremented from
+    there.
+    """
+
+    def __init__(self, container, session):
+        self.container = container
+        self.session = session
+        self.last = {}
+
+    def next_id(self, model):
+        if model not in self.last:
+            self.last[model] = max(max_remote(model, self.container),
+                                   max_local(model, self.session))
+        self.last[model] += 1
+        return self.last[model]
+
+
+def update_local_ids(new_ids, model, session):
+    """
+    Updates the tuples of *model* with primary keys in the *new_ids*
+    dictionary (of old key, new key) and all the dependent tuples in
+    other tables, with one ``UPDATE ... CASE`` statement per table
+    and batch of keys.
     """
     # Updating either the tuple or the dependent tuples first would
     # cause integrity violations if the transaction is flushed in
     # between. The order doesn't matter.
     if model is None:
-        raise ValueError("null model given to update_local_id subtransaction")
-    # must load fully, don't know yet why
-    obj = query_model(session, model).\
-        filter_by(**{get_pk(model): old_id}).first()
-    setattr(obj, get_pk(model), new_id)
-
-    # Then the dependent ones
-    related_tables = get_related_tables(model)
-    mapped_fks = [m_fks for m_fks in [(core.synched_models.tables.get(t.name, core.null_model).model,
-          get_fks(t, class_mapper(model).mapped_table))
-         for t in related_tables] if m_fks[0] is not None and m_fks[1]]
-    for model, fks in mapped_fks:
-        for fk in fks:
-            for obj in query_model(session, model).filter_by(**{fk: old_id}):
-                setattr(obj, fk, new_id)
+        raise ValueError("null model given to update_local_ids subtransaction")
+    if not new_ids:
+        return
+    session.flush()
+    targets = [(model, core.synched_models.metadata[model].pk)]
+    targets.extend((related, fk)
+                   for related, fks in get_related_models(model)
+                   for fk in fks)
+    for batch in grouper(new_ids, core.MAX_SQL_VARIABLES // 3):
+        mapping = dict((old_id, new_ids[old_id]) for old_id in batch)
+        for target, column in targets:
+            attribute = getattr(target, column)
+            type_ = attribute.property.columns[0].type
+            session.query(target).\
+                filter(attribute.in_(list(mapping))).\
+                update({attribute: case(
+                    [(attribute == old_id, literal(new_id, type_))
+                     for old_id, new_id in mapping.items()],
+                    else_=attribute)},
+                       synchronize_session=False)
+
+    # the objects loaded in the session are stale now
+    related = set(target for target, _ in targets[1:])
+    for obj in list(session.identity_map.values()):
+        if type(obj) is model and \
+                getattr(obj, targets[0][1], None) in new_ids:
+            session.expunge(obj)
+        elif type(obj) is model or type(obj) in related:
+            session.expire(obj)
+
+
+def update_local_id(old_id, new_id, model, session):
+    """
+    Updates the tuple matching *old_id* with *new_id*, and updates all
+    dependent tuples in other tables as well.
+    """
+    update_local_ids({old_id: new_id}, model, session)
     session.flush() # raise integrity errors now
 
 
@@ -100,13 +149,96 @@ class UniqueConstraintError(Exception):
     def __str__(self): return repr(self)
 
 
-@core.with_transaction()
+#: Objects in each chunk of a pull payload streamed over websocket.
+PAYLOAD_CHUNK_SIZE = 500
+
+
+#: Longest time (in seconds) the merge runs without giving control
+#  back to the event loop, when there's somewhere to yield.
+MERGE_YIELD_INTERVAL = 0.05
+
+#: Operations checked for conflicts (and local keys moved) in each
+#  step of the merge, between which it may yield.
+MERGE_BATCH_SIZE = 500
+
+
+@dataclass
+class MergeStats:
+    """
+    Measurements of a merge: the amount of pulled operations, how
+    many times it yielded to the event loop and the longest stretch
+    (in seconds) it kept the loop blocked.
+    """
+    operations: int = 0
+    yields: int = 0
+    max_blocking: float = 0.0
+    duration: float = 0.0
+
+
+class _Cooperative(object):
+    """
+    Yields to the event loop from a long running coroutine, at most
+    once every *interval* seconds, so that other tasks (e.g.
+    websocket keepalives) get to run. Other awaits of the coroutine
+    go through :meth:`wait`, so that the time they spend suspended
+    (e.g. waiting for the server) isn't counted as blocking.
+    """
+
+    def __init__(self, stats, interval=MERGE_YIELD_INTERVAL):
+        self.stats = stats
+        self.interval = interval
+        self.started = self.last = time.monotonic()
+
+    def _blocked(self):
+        blocked = time.monotonic() - self.last
+        self.stats.max_blocking = max(self.stats.max_blocking, blocked)
+        return blocked
+
+    async def checkpoint(self):
+        if self._blocked() >= self.interval:
+            await asyncio.sleep(0)
+            self.stats.yields += 1
+            self.last = time.monotonic()
+
+    async def wait(self, awaitable):
+        "Awaits *awaitable*, restarting the blocking stretch afterwards."
+        self._blocked()
+        try:
+            return await awaitable
+        finally:
+            self.last = time.monotonic()
+
+    async def batched(self, step, items, batch_size=MERGE_BATCH_SIZE):
+        """
+        Returns the concatenated results of *step* over batches of
+        *items*, with a checkpoint after each batch.
+        """
+        results = []
+        for batch in grouper(items, batch_size):
+            results.extend(step(list(batch)))
+            await self.checkpoint()
+        return results
+
+    def finish(self):
+        self._blocked()
+        self.stats.duration = time.monotonic() - self.started
+        return self.stats
+
+
+@core.with_transaction_async()
 async def merge(pull_message, session=None, websocket=None):
     """
     Merges a message from the server with the local database.
 
     *pull_message* is an instance of dbsync.messages.pull.PullMessage.
+
+    The merge yields to the event loop between batches of
+    ``MERGE_BATCH_SIZE`` operations in the conflict detection phases,
+    and between pulled operations, whenever it has run for longer than
+    ``MERGE_YIELD_INTERVAL``. Returns a :class:`MergeStats`.
     """
+    stats = MergeStats()
+    cooperative = _Cooperative(stats)
 
     logger.info("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~begin merge")
     if not isinstance(pull_message, PullMessage):
@@ -118,11 +250,18 @@ async def merge(pull_message, session=None, websocket=None):
     pull_ops = list(filter(attr('content_type_id').in_(valid_cts),
                       pull_message.operations))
     pull_ops = compressed_operations(pull_ops)
+    stats.operations = len(pull_ops)
     logger.info(f"pull_ops:{len(pull_ops)} items")
+    await cooperative.checkpoint()
     # I) first phase: resolve unique constraint conflicts if
     # possible. Abort early if a human error is detected
-    unique_conflicts, unique_errors = find_unique_conflicts(
-        pull_ops, unversioned_ops, pull_message, session)
+    unique_conflicts, unique_errors = [], []
+    for batch in grouper(pull_ops, MERGE_BATCH_SIZE):
+        conflicts, errors = find_unique_conflicts(
+            list(batch), unversioned_ops, pull_message, session)
+        unique_conflicts.extend(conflicts)
+        unique_errors.extend(errors)
+        await cooperative.checkpoint()
 
     if unique_errors:
         raise UniqueConstraintError(unique_errors)
@@ -146,24 +285,52 @@ async def merge(pull_message, session=None, websocket=None):
             delete(synchronize_session=False) # remove from the database
     session.add_all(conflicting_objects) # reinsert them
     session.flush()
+    await cooperative.checkpoint()
 
 
     # II) second phase: detect conflicts between pulled operations and
-    # unversioned ones
-    direct_conflicts = find_direct_conflicts(pull_ops, unversioned_ops)
+    # unversioned ones, in batches of the operations each search
+    # iterates first, which keeps the order of the conflicts
+    direct_conflicts = await cooperative.batched(
+        lambda batch: find_direct_conflicts(batch, unversioned_ops),
+        pull_ops)
 
     # in which the delete operation is registered on the pull message
-    dependency_conflicts = find_dependency_conflicts(
-        pull_ops, unversioned_ops, session)
+    dependency_conflicts = await cooperative.batched(
+        lambda batch: find_dependency_conflicts(
+            batch, unversioned_ops, session),
+        pull_ops)
 
     # in which the delete operation was performed locally
-    reversed_dependency_conflicts = find_reversed_dependency_conflicts(
-        pull_ops, unversioned_ops, pull_message)
-
-    insert_conflicts = find_insert_conflicts(pull_ops, unversioned_ops)
+    reversed_dependency_conflicts = await cooperative.batched(
+        lambda batch: find_reversed_dependency_conflicts(
+            pull_ops, batch, pull_message),
+        unversioned_ops)
+
+    insert_conflicts = await cooperative.batched(
+        lambda batch: find_insert_conflicts(pull_ops, batch),
+        unversioned_ops)
+
+    # local objects inserted with the same keys as pulled ones are
+    # moved out of the way, a batch of keys at a time
+    allocator = IdAllocator(pull_message, session)
+    new_ids = {}
+    for pull_op, local in insert_conflicts:
+        new_id = allocator.next_id(pull_op.tracked_model)
+        new_ids.setdefault(pull_op.tracked_model, {})[local.row_id] = new_id
+        local.row_id = new_id
+    for model, ids in new_ids.items():
+        for batch in grouper(ids, MERGE_BATCH_SIZE):
+            update_local_ids(dict((old_id, ids[old_id]) for old_id in batch),
+                             model, session)
+            await cooperative.checkpoint()
+    session.flush()
+    await cooperative.checkpoint()
 
     # III) third phase: perform pull operations, when allowed and
     # while resolving conflicts
+    orders = OrderAllocator(unversioned_ops, session)
+
     def extract(op, conflicts):
         return [local for (remote, local) in conflicts if remote is op]
 
@@ -177,6 +344,7 @@ async def merge(pull_message, session=None, websocket=None):
         unversioned_ops.remove(local)
 
     for pull_op in pull_ops:
+        await cooperative.checkpoint()
         # flag to control whether the remote operation is free of obstacles
         can_perform = True
         # flag to detect the early exclusion of a remote operation
@@ -205,39 +373,29 @@ async def merge(pull_message, session=None, websocket=None):
         dependency = extract(pull_op, dependency_conflicts)
         if dependency and not reverted:
             can_perform = False
-            order = min(op.order for op in unversioned_ops)
-            # first move all operations further in order, to make way
-            # for the new one
-            for op in unversioned_ops:
-                op.order = op.order + 1
-            session.flush()
-            # then create operation to reflect the reinsertion and
-            # maintain a correct operation history
+            # create operation to reflect the reinsertion and
+            # maintain a correct operation history, placed before the
+            # unversioned operations
             session.add(Operation(row_id=pull_op.row_id,
                                   content_type_id=pull_op.content_type_id,
                                   command='i',
-                                  order=order))
+                                  order=orders.before()))
 
         reversed_dependency = extract(pull_op, reversed_dependency_conflicts)
         for local in reversed_dependency:
             # reinsert record
             local.command = 'i'
             # local.perform(pull_message, session)
-            await local.perform_async(pull_message, session, websocket=websocket)
+            await cooperative.wait(local.perform_async(
+                pull_message, session, websocket=websocket))
             # delete trace of deletion
             purgelocal(local)
 
-        insert = extract(pull_op, insert_conflicts)
-        for local in insert:
-            session.flush()
-            next_id = max(max_remote(class_, pull_message),
-                          max_local(class_, session)) + 1
-            update_local_id(local.row_id, next_id, class_, session)
-            local.row_id = next_id
         if can_perform:
             # pull_op.perform(pull_message, session)
             logger.info("calling pull_op.perform_aync")
-            await pull_op.perform_async(pull_message, session, websocket=websocket)
+            await cooperative.wait(pull_op.perform_async(
+                pull_message, session, websocket=websocket))
 
             session.flush()
 
@@ -251,7 +409,10 @@ async def merge(pull_message, session=None, websocket=None):
     latest_version=get_latest_version_id(session=session)
     logger.info(f"latest version after all {latest_version}/{pull_version}")
 
-    session.commit()
+    stats = cooperative.finish()
+    logger.info(f"merged {stats.operations} operations in {stats.duration:.3f}s, "
+                f"blocking the event loop for at most {stats.max_blocking:.3f}s")
+    return stats
 
 class BadResponseError(Exception):
     pass
@@ -259,7 +420,7 @@ class BadResponseError(Exception):
 
 def pull(pull_url, extra_data=None,
          encode=None, decode=None, headers=None, monitor=None, timeout=None,
-         include_extensions=True):
+         include_extensions=True, store=None):
     """
     Attempts a pull from the server. Returns the response body.
 
@@ -279,6 +440,9 @@ def pull(pull_url, extra_data=None,
 
     *include_extensions* dictates whether the extension functions will
     be called during the merge or not. Default is ``True``.
+
+    *store* is an optional dbsync.messages.store.PayloadStore to keep
+    the objects of the response in, instead of memory.
     """
     assert isinstance(pull_url, str), "pull url must be a string"
     assert bool(pull_url), "pull url can't be empty"
@@ -303,7 +467,7 @@ def pull(pull_url, extra_data=None,
         raise BadResponseError(code, reason, response)
     message = None
     try:
-        message = PullMessage(response)
+        message = PullMessage(response, store=store)
     except KeyError:
         if monitor:
             monitor({
@@ -13,14 +13,36 @@ correct.
 
 This procedure can take a long time to complete, since it clears the
 client database and fetches a big message from the server.
+
+The streamed repair (``SyncClient.run_repair``) fetches the server
+database table by table instead, in chunks ordered by primary key,
+and loads each chunk with a bulk insert. The progress is recorded in
+``RepairCursor`` rows, so that an interrupted repair resumes from the
+last chunk loaded.
 """
 
+import json
+from typing import Any, Dict, List, Optional
+
+
 from dbsync import core
-from dbsync.models import Operation, Version
+from dbsync.lang import *
+from dbsync.utils import class_mapper, get_pk, object_from_dict
+from dbsync.merkle import MerkleTree, bucket_pks
+from dbsync.models import Operation, Version, RepairCursor, save_extensions, \
+    get_model_extensions_for_class
 from dbsync.messages.base import BaseMessage
+from dbsync.messages.codecs import SyncdbJSONEncoder, decode_dict
 from dbsync.client.net import get_request
 
 
+#: Default amount of rows requested in each chunk of a streamed repair.
+REPAIR_CHUNK_SIZE = 1000
+
+#: Default amount of models streamed at once.
+REPAIR_PARALLEL_MODELS = 4
+
+
 @core.with_transaction()
 def repair_database(message, latest_version_id, session=None):
     if not isinstance(message, BaseMessage):
@@ -47,12 +69,185 @@ def repair_database(message, latest_version_id, session=None):
         session.add(Version(version_id=latest_version_id))
 
 
+def _model(model_name):
+    model = core.synched_models.model_names.\
+        get(model_name, core.null_model).model
+    if model is None:
+        raise ValueError("model {0} isn't being tracked".format(model_name))
+    return model
+
+
+def _bulk_insert(model, objects, include_extensions, session):
+    """
+    Inserts encoded objects of *model* with a single Core insert,
+    which isn't tracked.
+    """
+    mapper = class_mapper(model)
+    decoded = list(map(decode_dict(model), objects))
+    # map property keys to column keys, leaving extension fields out
+    columns = dict((prop.key, prop.columns[0].key)
+                   for prop in mapper.column_attrs)
+    rows = [dict((columns[k], v) for k, v in dict_.items() if k in columns)
+            for dict_ in decoded]
+    if rows:
+        session.execute(mapper.mapped_table.insert(), rows)
+    if include_extensions and get_model_extensions_for_class(model):
+        session.flush()
+        for dict_ in decoded:
+            save_extensions(object_from_dict(model, dict_))
+
+
+@core.session_committing
+def begin_streamed_repair(session=None):
+    """
+    Clears the local database and creates a fresh repair cursor for
+    each synchronized model.
+    """
+    for model in core.synched_models.models:
+        session.query(model).delete(synchronize_session=False)
+    session.query(Operation).delete(synchronize_session=False)
+    session.query(Version).delete(synchronize_session=False)
+    session.query(RepairCursor).delete(synchronize_session=False)
+    session.add_all([RepairCursor(model_name=model.__name__, finished=False)
+                     for model in core.synched_models.models])
+
+
+@core.session_closing
+def pending_repair(session=None) -> Dict[str, Optional[Any]]:
+    """
+    Returns a dictionary of (model name, encoded last primary key)
+    for the models that a streamed repair in course hasn't finished
+    yet. The dictionary is empty if there's no repair in course.
+    """
+    return dict((cursor.model_name,
+                 maybe(cursor.last_pk, json.loads, None))
+                for cursor in session.query(RepairCursor).
+                filter(RepairCursor.finished == False))
+
+
+def repair_dependencies() -> Dict[str, List[str]]:
+    """
+    Returns a dictionary of (model name, names of the synchronized
+    models it references by foreign key). A model is loaded only
+    after its parents are, so that the streamed repair doesn't depend
+    on foreign key checks being off.
+    """
+    dependencies = {}
+    # only references to models sorted before are kept, which breaks
+    # reference cycles
+    for model in core.synched_models.order:
+        dependencies[model.__name__] = [
+            parent.__name__
+            for parent, _ in core.synched_models.metadata[model].parents
+            if parent.__name__ in dependencies]
+    return dependencies
+
+
+@core.session_committing
+def load_repair_chunk(model_name: str, objects: List[Dict[str, Any]],
+                      last: Any, include_extensions=True, session=None):
+    """
+    Inserts a chunk of encoded objects of the model *model_name* with
+    a single bulk insert, and moves the model's repair cursor to the
+    encoded primary key *last*, in the same transaction.
+    """
+    _bulk_insert(_model(model_name), objects, include_extensions, session)
+    session.query(RepairCursor).\
+        filter(RepairCursor.model_name == model_name).\
+        update({RepairCursor.last_pk: json.dumps(last, cls=SyncdbJSONEncoder)},
+               synchronize_session=False)
+
+
+@core.session_committing
+def finish_repair_model(model_name: str, latest_version_id: Optional[int],
+                        session=None):
+    "Marks the repair cursor of *model_name* as finished."
+    session.query(RepairCursor).\
+        filter(RepairCursor.model_name == model_name).\
+        update({RepairCursor.finished: True,
+                RepairCursor.latest_version_id: latest_version_id},
+               synchronize_session=False)
+
+
+@core.session_committing
+def finish_streamed_repair(session=None) -> Optional[int]:
+    """
+    Ends a streamed repair once every model is loaded. The local
+    version is set to the oldest of the versions seen while streaming
+    each model, so that changes made on the server during the repair
+    are pulled afterwards. Returns that version identifier.
+    """
+    cursors = session.query(RepairCursor).all()
+    assert all(cursor.finished for cursor in cursors), \
+        "the repair hasn't finished loading every model"
+    versions = [cursor.latest_version_id for cursor in cursors
+                if cursor.latest_version_id is not None]
+    latest_version_id = min(versions) if versions else None
+    if latest_version_id is not None:
+        session.add(Version(version_id=latest_version_id))
+    session.query(RepairCursor).delete(synchronize_session=False)
+    return latest_version_id
+
+
+@core.session_closing
+def local_merkle_tree(model_name: str, depth: int, session=None) -> MerkleTree:
+    "Builds the hash tree of the local table of *model_name*."
+    return MerkleTree.for_model(_model(model_name), session.connection(),
+                                depth)
+
+
+@core.session_committing
+def repair_buckets(model_name: str, buckets: List[str], depth: int,
+                   objects: List[Dict[str, Any]], include_extensions=True,
+                   session=None) -> int:
+    """
+    Makes the local rows of *model_name* in the leaf *buckets* equal
+    to *objects*, the server's encoded rows in those buckets. Local
+    rows missing in the server are deleted, along with their
+    unversioned operations. Returns the amount of rows deleted or
+    written.
+    """
+    model = _model(model_name)
+    pk_name = get_pk(model)
+    pk = getattr(model, pk_name)
+    local_pks = bucket_pks(model, session.connection(), buckets, depth)
+    remote_pks = [dict_[pk_name] for dict_ in map(decode_dict(model), objects)]
+    for batch in grouper(local_pks + remote_pks, core.MAX_SQL_VARIABLES):
+        session.query(model).filter(pk.in_(batch)).\
+            delete(synchronize_session=False)
+    content_type = core.synched_models.models[model]
+    removed = set(local_pks).difference(remote_pks)
+    for batch in grouper(removed, core.MAX_SQL_VARIABLES):
+        session.query(Operation).\
+            filter(Operation.version_id == None,
+                   Operation.content_type_id == content_type.id,
+                   Operation.row_id.in_(batch)).\
+            delete(synchronize_session=False)
+    _bulk_insert(model, objects, include_extensions, session)
+    return len(removed) + len(objects)
+
+
+@core.session_committing
+def finish_differential_repair(latest_version_id: Optional[int],
+                               session=None) -> None:
+    """
+    Records the server version the local database was compared
+    against, once every model has been repaired.
+    """
+    if latest_version_id is not None and \
+            session.query(Version).get(latest_version_id) is None:
+        session.add(Version(version_id=latest_version_id))
+
+
 class BadResponseError(Exception): pass
 
 
+class RepairRejected(Exception): pass
+
+
 def repair(repair_url, include_extensions=True, extra_data=None,
            encode=None, decode=None, headers=None, timeout=None,
-           monitor=None):
+           monitor=None, store=None):
     """
     Fetches the server database and replaces the local one with it.
 
@@ -61,6 +256,10 @@ def repair(repair_url, include_extensions=True, extra_data=None,
 
     *extra_data* can be used to add user credentials.
 
+    *store* is an optional dbsync.messages.store.PayloadStore to keep
+    the fetched objects in while they're inserted, so that they don't
+    need to fit in memory all at once.
+
     By default, the *encode* function is ``json.dumps``, the *decode*
     function is ``json.loads``, and the *headers* are appropriate HTTP
     headers for JSON.
@@ -85,7 +284,7 @@ def repair(repair_url, include_extensions=True, extra_data=None,
         raise BadResponseError(code, reason, response)
     message = None
     try:
-        message = BaseMessage(response)
+        message = BaseMessage(response, store=store)
     except KeyError:
         if monitor: monitor({'status': "error",
                              'reason': "invalid message format"})
@@ -0,0 +1,83 @@
+"""
+.. module:: client.snapshot
+   :synopsis: Bootstrap of a node from a server snapshot.
+
+A new node can replace its database with a snapshot built by the
+server (see ``dbsync.server.snapshot``) instead of running a repair.
+The snapshot file is attached to the local SQLite database and copied
+table by table with ``INSERT ... SELECT`` statements, so the rows
+never go through the ORM.
+"""
+
+import os
+from typing import Optional
+
+from sqlalchemy.sql.util import sort_tables
+
+from dbsync import core
+from dbsync.models import Operation, Version, RepairCursor
+from dbsync.client.triggers import suppressed
+from dbsync.logs import get_logger
+
+
+logger = get_logger(__name__)
+
+#: Name under which the snapshot is attached.
+SNAPSHOT_SCHEMA = "dbsync_snapshot"
+
+
+class SnapshotUnavailable(Exception): pass
+
+
+def load_snapshot(path: str) -> Optional[int]:
+    """
+    Replaces the local synchronized tables, operations and versions
+    with the contents of the snapshot file at *path*. Returns the
+    version identifier of the snapshot.
+
+    Only the columns present both in the local table and in the
+    snapshot are copied, so the local schema is kept as it is.
+    """
+    if not os.path.exists(path):
+        raise SnapshotUnavailable("snapshot file not found", path)
+    engine = core.get_engine()
+    if engine.name != 'sqlite':
+        raise ValueError("snapshots can only be loaded in SQLite databases")
+    quote = engine.dialect.identifier_preparer.quote
+    tables = sort_tables(set(model.__table__
+                             for model in core.synched_models.models))
+    versions = Version.__table__
+
+    with engine.connect() as connection:
+        # ATTACH isn't allowed inside a transaction
+        connection.execute("ATTACH DATABASE ? AS {0}".format(SNAPSHOT_SCHEMA),
+                           (path,))
+        try:
+            with connection.begin(), suppressed(connection):
+                for table in reversed(tables):
+                    connection.execute(table.delete())
+                connection.execute(Operation.__table__.delete())
+                connection.execute(RepairCursor.__table__.delete())
+                connection.execute(versions.delete())
+                for table in tables + [versions]:
+                    available = set(
+                        row[1] for row in connection.execute(
+                            "PRAGMA {0}.table_info({1})".format(
+                                SNAPSHOT_SCHEMA, quote(table.name))))
+                    columns = ", ".join(quote(c.name) for c in table.columns
+                                        if c.name in available)
+                    if not columns:
+                        logger.warning("table %s missing from snapshot",
+                                       table.name)
+                        continue
+                    connection.execute(
+                        "INSERT INTO main.{0} ({1}) "
+                        "SELECT {1} FROM {2}.{0}".format(
+                            quote(table.name), columns, SNAPSHOT_SCHEMA))
+                version_id = connection.execute(
+                    "SELECT max(version_id) FROM main.{0}".format(
+                        quote(versions.name))).scalar()
+        finally:
+            connection.execute("DETACH DATABASE {0}".format(SNAPSHOT_SCHEMA))
+    logger.info("snapshot %s loaded at version %s", path, version_id)
+    return version_id
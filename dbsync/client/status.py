@@ -0,0 +1,244 @@
+"""
+Read-only synchronization status, cheap enough for list screens.
+
+``core.is_synched`` queries one object at a time and
+``unsynched_objects`` compresses the operations log before reporting.
+The procedures here only read the unversioned operations, which the
+partial index on them keeps cheap:
+
+- :func:`sync_status` returns the pending command of many objects,
+  with one query per model (and ``core.MAX_SQL_VARIABLES`` objects).
+- :func:`model_status` returns the pending rows of a whole model with
+  a single query.
+- :func:`pending_summary` counts the rows with pending operations of
+  each model with a single aggregate query.
+
+The pending command of a row is the result of merging its unversioned
+operations (see ``compression.COMPACTION``): ``'i'``, ``'u'``, ``'d'``,
+or ``None`` if they cancel out (e.g. an insert followed by a delete)
+or there are none, meaning the row is synched.
+
+The :data:`counter` answers the same summary from memory. It's loaded
+with a single query when first read and kept current by the tracking
+listeners afterwards; pushes, compression and other changes of the
+operations through a session make it reload. If the operations table
+is changed by other means (e.g. raw SQL), call ``counter.invalidate()``.
+"""
+
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import event, func, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm.session import Session as GlobalSession
+
+from dbsync.lang import grouper
+from dbsync import core, statements
+from dbsync.models import Operation, SQLClass
+from dbsync.utils import get_pk
+from dbsync.client.compression import COMPACTION
+from dbsync.logs import get_logger
+
+
+logger = get_logger(__name__)
+
+
+def _content_type_id(model) -> int:
+    if model not in core.synched_models.models:
+        raise TypeError("the given class {0} isn't being tracked".\
+                            format(model.__name__))
+    return core.synched_models.models[model].id
+
+
+def _pk(obj: SQLClass) -> Any:
+    "Returns the primary key value of *obj*, without loading it if expired."
+    identity = inspect(obj).identity
+    return identity[0] if identity is not None else getattr(obj, get_pk(obj))
+
+
+def _merge(pending: Dict[Any, Optional[str]], rows) -> None:
+    "Merges the (row_id, command) *rows*, in order, into *pending*."
+    for row_id, command in rows:
+        if row_id in pending:
+            previous = pending[row_id]
+            if previous is None:
+                # the previous operations cancelled out
+                pending[row_id] = command
+            else:
+                pending[row_id] = COMPACTION.get((previous, command), command)
+        else:
+            pending[row_id] = command
+
+
+def _pending_query(session, content_type_id: int):
+    return session.query(Operation.row_id, Operation.command).\
+        filter(Operation.content_type_id == content_type_id,
+               Operation.version_id == None).\
+        order_by(Operation.order)
+
+
+@core.session_closing
+def model_status(model: SQLClass, session=None) -> Dict[Any, str]:
+    """
+    Returns a dictionary mapping the primary key of each row of
+    *model* pending synchronization to its pending command. Rows not
+    present are synched.
+
+    Raises a TypeError if *model* isn't being tracked.
+    """
+    pending: Dict[Any, Optional[str]] = {}
+    _merge(pending, _pending_query(session, _content_type_id(model)))
+    return dict((row_id, command) for row_id, command in pending.items()
+                if command is not None)
+
+
+@core.session_closing
+def sync_status(objects: Iterable[SQLClass], session=None) -> List[Optional[str]]:
+    """
+    Returns the pending command of each of the tracked *objects*, in
+    order, or ``None`` for the synched ones. Objects without a primary
+    key (not yet flushed) are reported as pending inserts.
+
+    Raises a TypeError if an object isn't being tracked.
+    """
+    objects = list(objects)
+    keys: Dict[SQLClass, Set[Any]] = {}
+    for obj in objects:
+        _content_type_id(type(obj))
+        pk = _pk(obj)
+        if pk is not None:
+            keys.setdefault(type(obj), set()).add(pk)
+    pending: Dict[SQLClass, Dict[Any, Optional[str]]] = {}
+    for model, pks in keys.items():
+        model_pending = pending.setdefault(model, {})
+        query = _pending_query(session, _content_type_id(model))
+        for batch in grouper(pks, core.MAX_SQL_VARIABLES):
+            _merge(model_pending, query.filter(Operation.row_id.in_(batch)))
+    result = []
+    for obj in objects:
+        pk = _pk(obj)
+        result.append('i' if pk is None else
+                      pending[type(obj)].get(pk, None))
+    return result
+
+
+def _models(counts: Dict[int, int]) -> Dict[SQLClass, int]:
+    return dict((core.synched_models.ids[content_type_id].model, count)
+                for content_type_id, count in counts.items()
+                if content_type_id in core.synched_models.ids and count)
+
+
+@core.session_closing
+def pending_summary(session=None) -> Dict[SQLClass, int]:
+    """
+    Returns a dictionary mapping each tracked model with pending
+    operations to the amount of its rows that have them. Operations
+    that would cancel out when compressed are counted as well.
+    """
+    return _models(dict(
+        session.query(Operation.content_type_id,
+                      func.count(func.distinct(Operation.row_id))).\
+        filter(Operation.version_id == None).\
+        group_by(Operation.content_type_id)))
+
+
+class PendingCounter(object):
+    """
+    The rows with pending operations, kept in memory.
+
+    The rows are loaded outside the lock, so the operations registered
+    while a load runs are recorded and replayed over its result. A load
+    that began before an invalidation isn't kept.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows: Optional[Dict[int, Set[Any]]] = None
+        self._generation = 0
+        #: Operations registered during a load, or None if none runs.
+        self._added: Optional[List[Tuple[int, List[Any]]]] = None
+
+    def _load(self) -> Dict[int, Set[Any]]:
+        with self._lock:
+            if self._rows is not None:
+                return self._rows
+            generation = self._generation
+            if self._added is None:
+                self._added = []
+        session = core.Session()
+        try:
+            loaded: Dict[int, Set[Any]] = {}
+            for content_type_id, row_id in session.query(
+                    Operation.content_type_id, Operation.row_id).\
+                    filter(Operation.version_id == None).distinct():
+                loaded.setdefault(content_type_id, set()).add(row_id)
+        finally:
+            session.close()
+        with self._lock:
+            if self._rows is None and self._generation == generation:
+                for content_type_id, row_ids in self._added:
+                    loaded.setdefault(content_type_id, set()).update(row_ids)
+                self._rows = loaded
+                self._added = None
+            return self._rows if self._rows is not None else loaded
+
+    def summary(self) -> Dict[SQLClass, int]:
+        "Same as :func:`pending_summary`, from memory."
+        rows = self._load()
+        with self._lock:
+            return _models(dict((content_type_id, len(row_ids))
+                                for content_type_id, row_ids in rows.items()))
+
+    def is_pending(self, obj: SQLClass) -> bool:
+        "Returns whether the tracked *obj* has pending operations."
+        row_ids = self._load().get(_content_type_id(type(obj)), ())
+        return _pk(obj) in row_ids
+
+    def add(self, content_type_id: int, row_ids: Iterable[Any]) -> None:
+        "Registers committed unversioned operations."
+        with self._lock:
+            if self._rows is not None:
+                self._rows.setdefault(content_type_id, set()).update(row_ids)
+            elif self._added is not None:
+                self._added.append((content_type_id, list(row_ids)))
+
+    def invalidate(self) -> None:
+        "Makes the counter reload on the next read."
+        with self._lock:
+            self._rows = None
+            self._generation += 1
+            if self._added is not None:
+                # the loads running are discarded
+                self._added = []
+
+
+#: The pending rows of this process.
+counter = PendingCounter()
+
+
+def _after_flush(session, flush_context):
+    if any(isinstance(obj, Operation)
+           for objects in (session.dirty, session.deleted) for obj in objects):
+        counter.invalidate()
+
+
+def _after_bulk(context):
+    if context.mapper.class_ is Operation:
+        counter.invalidate()
+
+
+def _commit(connection):
+    for content_type_id, row_ids in connection.info.pop(
+            statements.WRITTEN_KEY, ()):
+        counter.add(content_type_id, row_ids)
+
+
+def _rollback(connection):
+    connection.info.pop(statements.WRITTEN_KEY, None)
+
+
+event.listen(GlobalSession, 'after_flush', _after_flush)
+event.listen(GlobalSession, 'after_bulk_delete', _after_bulk)
+event.listen(GlobalSession, 'after_bulk_update', _after_bulk)
+event.listen(Engine, 'commit', _commit)
+event.listen(Engine, 'rollback', _rollback)
@@ -6,7 +6,7 @@ import logging
 import inspect
 import warnings
 from collections import deque
-from typing import Optional, Callable, Deque, Union, List
+from typing import Any, Dict, Optional, Callable, Deque, Tuple, Union, List
 
 from sqlalchemy.ext.declarative import DeclarativeMeta
 
@@ -16,8 +16,12 @@ from sqlalchemy.engine import Connection
 from sqlalchemy.orm import Mapper
 from sqlalchemy.orm.session import Session as GlobalSession, Session
 
+from dbsync.lang import grouper
 from dbsync import core
+from dbsync import statements # tracks bulk and Core statements
 from dbsync.models import Operation, SkipOperation, call_before_tracking_fn, call_after_tracking_fn
+from dbsync.client.compression import COMPACTION
+from dbsync.client.status import counter
 from dbsync.logs import get_logger
 from sqlalchemy.sql import Join
 
@@ -32,21 +36,79 @@ core.mode = 'client'
 #: Operations to be flushed to the database after a commit.
 _operations_queue: Deque[Operation] = deque()
 
+#: Whether to keep at most one unversioned operation per row, merging
+#  each tracked operation with the pending one (see
+#  ``compression.COMPACTION``). The local log is then bounded by the
+#  amount of distinct rows changed since the last push.
+COMPACT_LOG = False
+
 
 def flush_operations(committed_session):
-    """Flush operations after a commit has been issued."""
+    """
+    Flush operations after a commit has been issued.
+
+    The after-tracking hooks run first for every queued operation,
+    then the operations are written with a single bulk insert and
+    registered in ``status.counter``.
+    """
     if not _operations_queue or \
             getattr(committed_session, core.INTERNAL_SESSION_ATTR, False):
         return
     if not core.listening:
         logger.warning("dbsync is disabled; aborting flush_operations")
         return
+    ops = list(_operations_queue)
+    _operations_queue.clear()
     with core.committing_context() as session:
-        while _operations_queue:
-            op = _operations_queue.popleft()
-            session.add(op)
+        if COMPACT_LOG:
+            ops = _compacted(ops, session)
+        for op in ops:
             call_after_tracking_fn(session, op, op._target)
-            session.flush()
+        session.bulk_save_objects(ops)
+    for op in ops:
+        counter.add(op.content_type_id, (op.row_id,))
+
+
+def _compacted(ops: List[Operation], session) -> List[Operation]:
+    """
+    Merges the queued operations *ops* with the unversioned
+    operations of the same rows, which are fetched in batches.
+    Returns the operations that still have to be inserted.
+    """
+    pending: Dict[Tuple[int, Any], Operation] = {}
+    row_ids = set(op.row_id for op in ops)
+    for batch in grouper(row_ids, core.MAX_SQL_VARIABLES):
+        for op in session.query(Operation).\
+                filter(Operation.version_id == None,
+                       Operation.row_id.in_(batch)).\
+                order_by(Operation.order):
+            pending[(op.content_type_id, op.row_id)] = op
+    new: List[Operation] = []
+    latest: Dict[Tuple[int, Any], Operation] = {}
+    dropped = set()
+    for op in ops:
+        key = (op.content_type_id, op.row_id)
+        queued = latest.get(key, None)
+        previous = queued or pending.get(key, None)
+        if previous is not None and \
+                (previous.command, op.command) in COMPACTION:
+            command = COMPACTION[(previous.command, op.command)]
+            if command == previous.command:
+                if queued is None:
+                    call_after_tracking_fn(session, previous, op._target)
+                continue
+            if queued is not None:
+                dropped.add(id(queued))
+                del latest[key]
+            else:
+                session.delete(previous)
+                del pending[key]
+            if command is None:
+                continue
+            op.command = command
+        new.append(op)
+        latest[key] = op
+    return [op for op in new if id(op) not in dropped]
 
 
 def empty_queue(*args):
@@ -0,0 +1,306 @@
+"""
+Change capture through database triggers.
+
+As an alternative to the ORM listeners installed by ``track``,
+:func:`enable_trigger_tracking` makes the database itself register
+the operations: each insert, update or delete on a tracked table
+appends a row to the operations table in the same transaction. Writes
+done through Core or raw SQL are tracked as well, and bulk writes
+don't go through python callbacks.
+
+Writes from dbsync's internal sessions (merge, repair, ...) and those
+done while listening is disabled aren't tracked, just like with the
+listeners:
+
+- In SQLite the triggers are ``TEMP`` triggers, created on each
+  connection of the engine along with a ``dbsync_tracking()``
+  function that reads a flag of the connection. Writes from
+  connections not opened by the engine (e.g. the sqlite3 shell)
+  aren't tracked.
+- In PostgreSQL the triggers are permanent, and they're suppressed
+  by the ``dbsync.suppress_tracking`` setting, local to the
+  transaction.
+
+The triggers are installed on each model's own table (the right
+table of joined models). Extension tracking hooks
+(``before_tracking_fn`` and ``after_tracking_fn``) can't run inside
+the database; they're applied in batch after each commit, see
+:func:`apply_tracking_hooks`. The operations written by the triggers
+aren't seen by ``status.counter`` either, so each tracked commit makes
+it reload.
+"""
+
+import contextlib
+from typing import Iterable, List, Optional, Set
+
+from sqlalchemy import event, func, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm.session import Session as GlobalSession
+
+from dbsync.lang import *
+from dbsync import core, statements
+from dbsync.utils import query_model
+from dbsync.models import Operation, SkipOperation, SQLClass, \
+    call_before_tracking_fn, call_after_tracking_fn, \
+    get_model_extensions_for_class
+from dbsync.client.status import counter
+from dbsync.logs import get_logger
+
+
+logger = get_logger(__name__)
+
+#: Connection info key of the flag that suppresses tracking in SQLite.
+SUPPRESSION_FLAG = statements.UNTRACKED_FLAG
+
+#: Setting that suppresses tracking in PostgreSQL.
+SUPPRESSION_SETTING = "dbsync.suppress_tracking"
+
+#: Models tracked by triggers.
+trigger_models: Set[SQLClass] = set()
+
+#: Order of the last operation the tracking hooks were applied to.
+_hooked_order: Optional[int] = None
+
+
+def _names(model, dialect):
+    quote = dialect.identifier_preparer.quote
+    table = model.__table__
+    return (quote(table.name),
+            core.synched_models.metadata[model].entity_name,
+            quote(list(table.primary_key.columns)[0].name),
+            [quote(c.name) for c in table.columns],
+            core.synched_models.models[model].id)
+
+
+def _operation_insert(dialect, row, content_type_id, command):
+    quote = dialect.identifier_preparer.quote
+    return ("INSERT INTO {0} ({1}, {2}, {3}) "
+            "VALUES ({4}, {5}, '{6}');").format(
+                quote(Operation.__table__.name), quote('row_id'),
+                quote('content_type_id'), quote('command'),
+                row, content_type_id, command)
+
+
+def sqlite_triggers(model, dialect) -> List[str]:
+    "Returns the statements creating the SQLite triggers of *model*."
+    table, name, pk, columns, ct_id = _names(model, dialect)
+    tracking = "dbsync_tracking()"
+    changed = " OR ".join("OLD.{0} IS NOT NEW.{0}".format(c) for c in columns)
+    return [
+        "CREATE TEMP TRIGGER IF NOT EXISTS dbsync_{0}_i AFTER INSERT ON main.{1} "
+        "WHEN {2} BEGIN {3} END;".format(
+            name, table, tracking,
+            _operation_insert(dialect, "NEW." + pk, ct_id, 'i')),
+        "CREATE TEMP TRIGGER IF NOT EXISTS dbsync_{0}_u AFTER UPDATE ON main.{1} "
+        "WHEN {2} AND ({3}) BEGIN {4} END;".format(
+            name, table, tracking, changed,
+            _operation_insert(dialect, "NEW." + pk, ct_id, 'u')),
+        "CREATE TEMP TRIGGER IF NOT EXISTS dbsync_{0}_d AFTER DELETE ON main.{1} "
+        "WHEN {2} BEGIN {3} END;".format(
+            name, table, tracking,
+            _operation_insert(dialect, "OLD." + pk, ct_id, 'd'))]
+
+
+def postgresql_triggers(model, dialect) -> List[str]:
+    "Returns the statements creating the PostgreSQL trigger of *model*."
+    table, name, pk, _, ct_id = _names(model, dialect)
+    return [
+        """CREATE OR REPLACE FUNCTION dbsync_track_{0}() RETURNS trigger AS $$
+BEGIN
+    IF current_setting('{1}', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'INSERT' THEN
+        {2}
+    ELSIF TG_OP = 'UPDATE' THEN
+        IF NEW IS DISTINCT FROM OLD THEN
+            {3}
+        END IF;
+    ELSE
+        {4}
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;""".format(
+            name, SUPPRESSION_SETTING,
+            _operation_insert(dialect, "NEW." + pk, ct_id, 'i'),
+            _operation_insert(dialect, "NEW." + pk, ct_id, 'u'),
+            _operation_insert(dialect, "OLD." + pk, ct_id, 'd')),
+        "DROP TRIGGER IF EXISTS dbsync_{0} ON {1};".format(name, table),
+        "CREATE TRIGGER dbsync_{0} AFTER INSERT OR UPDATE OR DELETE ON {1} "
+        "FOR EACH ROW EXECUTE PROCEDURE dbsync_track_{0}();".format(name, table)]
+
+
+def _sqlite_connect(dbapi_connection, connection_record):
+    "Creates the temporary triggers in each new SQLite connection."
+    dialect = core.get_engine().dialect
+    info = connection_record.info
+    dbapi_connection.create_function(
+        "dbsync_tracking", 0, lambda: 0 if info.get(SUPPRESSION_FLAG) else 1)
+    cursor = dbapi_connection.cursor()
+    try:
+        for model in trigger_models:
+            for statement in sqlite_triggers(model, dialect):
+                cursor.execute(statement)
+    finally:
+        cursor.close()
+
+
+def enable_trigger_tracking(models: Optional[Iterable[SQLClass]] = None,
+                            engine: Optional[Engine] = None) -> None:
+    """
+    Replaces the ORM listeners of *models* (by default every model
+    tracked for pushing) with database triggers.
+    """
+    global _hooked_order
+    engine = engine or core.get_engine()
+    if models is None:
+        models = [model for model in core.synched_models.model_handlers
+                  if model in core.pushed_models]
+    models = [model for model in models if model not in trigger_models]
+    for model in models:
+        handlers = core.synched_models.model_handlers.get(model, ())
+        for name, handler in zip(('after_insert', 'after_update', 'after_delete'),
+                                 handlers):
+            if event.contains(model, name, handler):
+                event.remove(model, name, handler)
+    trigger_models.update(models)
+
+    dialect = engine.dialect
+    if dialect.name == 'sqlite':
+        if not event.contains(engine, 'connect', _sqlite_connect):
+            event.listen(engine, 'connect', _sqlite_connect)
+        # pooled connections lack the triggers
+        engine.dispose()
+    elif dialect.name == 'postgresql':
+        with engine.begin() as connection:
+            for model in models:
+                for statement in postgresql_triggers(model, dialect):
+                    connection.execute(statement)
+    else:
+        raise ValueError("trigger tracking isn't supported in {0}".\
+                         format(dialect.name))
+    _hooked_order = engine.execute(
+        select([func.max(Operation.__table__.c.order)])).scalar() or 0
+    logger.info(f"tracking {len(trigger_models)} models with triggers")
+
+
+def disable_trigger_tracking(engine: Optional[Engine] = None) -> None:
+    "Removes the triggers and restores the ORM listeners."
+    global _hooked_order
+    engine = engine or core.get_engine()
+    dialect = engine.dialect
+    if dialect.name == 'sqlite':
+        if event.contains(engine, 'connect', _sqlite_connect):
+            event.remove(engine, 'connect', _sqlite_connect)
+        engine.dispose()
+    elif dialect.name == 'postgresql':
+        quote = dialect.identifier_preparer.quote
+        with engine.begin() as connection:
+            for model in trigger_models:
+                name = core.synched_models.metadata[model].entity_name
+                connection.execute("DROP TRIGGER IF EXISTS dbsync_{0} ON {1};".\
+                                   format(name, quote(model.__table__.name)))
+                connection.execute("DROP FUNCTION IF EXISTS dbsync_track_{0}();".\
+                                   format(name))
+    for model in trigger_models:
+        core.synched_models.register_handlers(
+            model, core.synched_models.model_handlers[model])
+    trigger_models.clear()
+    _hooked_order = None
+
+
+@contextlib.contextmanager
+def suppressed(connection):
+    """
+    Suppresses tracking for the writes done with *connection* (a
+    Core connection with an ongoing transaction) in the context.
+    """
+    if connection.dialect.name == 'postgresql':
+        connection.execute("SET LOCAL {0} = 'on'".format(SUPPRESSION_SETTING))
+    with statements.untracked(connection):
+        yield connection
+
+
+def _suppress(session, transaction, connection):
+    """
+    Suppresses tracking in the transactions of internal sessions. In
+    SQLite the connection flag is set by ``dbsync.statements``.
+    """
+    if not trigger_models or transaction.parent is not None:
+        return
+    if not getattr(session, core.INTERNAL_SESSION_ATTR, False) and \
+            core.listening:
+        return
+    if connection.dialect.name == 'postgresql':
+        connection.execute("SET LOCAL {0} = 'on'".format(SUPPRESSION_SETTING))
+
+
+def apply_tracking_hooks(session=None) -> int:
+    """
+    Runs the extension tracking hooks for the operations registered
+    by triggers since the last call. Operations for which a
+    ``before_tracking_fn`` raises ``SkipOperation`` are deleted.
+    Returns the amount of operations the hooks were applied to.
+    """
+    global _hooked_order
+    hooked = [model for model in trigger_models
+              if any(e.before_tracking_fn or e.after_tracking_fn
+                     for e in get_model_extensions_for_class(model))]
+    if not hooked or _hooked_order is None:
+        return 0
+    closeit = session is None
+    session = session or core.Session()
+    try:
+        ops = session.query(Operation).\
+            filter(Operation.order > _hooked_order,
+                   Operation.version_id == None,
+                   Operation.content_type_id.in_(
+                       [core.synched_models.models[m].id for m in hooked])).\
+            order_by(Operation.order).all()
+        for model in hooked:
+            ct_id = core.synched_models.models[model].id
+            pk = getattr(model, core.synched_models.metadata[model].pk)
+            model_ops = [op for op in ops if op.content_type_id == ct_id]
+            objects = {}
+            for batch in grouper(set(op.row_id for op in model_ops),
+                                 core.MAX_SQL_VARIABLES):
+                for obj in query_model(session, model).filter(pk.in_(batch)):
+                    objects[getattr(obj, pk.key)] = obj
+            for op in model_ops:
+                obj = objects.get(op.row_id, None)
+                if obj is None:
+                    continue # deleted, the hooks need the object
+                try:
+                    call_before_tracking_fn(session, op.command, obj)
+                except SkipOperation:
+                    session.delete(op)
+                    continue
+                call_after_tracking_fn(session, op, obj)
+        if ops:
+            _hooked_order = ops[-1].order
+        if closeit:
+            session.commit()
+        else:
+            session.flush()
+        return len(ops)
+    finally:
+        if closeit:
+            session.close()
+
+
+def _after_commit(session):
+    if trigger_models and \
+            not getattr(session, core.INTERNAL_SESSION_ATTR, False) and \
+            core.listening:
+        apply_tracking_hooks()
+
+
+def _commit(connection):
+    if trigger_models and not connection.info.get(SUPPRESSION_FLAG, False):
+        counter.invalidate()
+
+
+event.listen(GlobalSession, 'after_begin', _suppress)
+event.listen(GlobalSession, 'after_commit', _after_commit)
+event.listen(Engine, 'commit', _commit)
@@ -1,6 +1,9 @@
 import asyncio
 import importlib
 import json
+import os
+import tempfile
+import zlib
 from dataclasses import dataclass
 from datetime import datetime
 from typing import Optional, Dict, Any, Callable
@@ -13,14 +16,30 @@ from sqlalchemy.exc import OperationalError
 from dbsync import core, wscommon
 from dbsync.client import PushRejected, PullSuggested, UniqueConstraintError
 from dbsync.client.compression import compress
+from dbsync.client.maintenance import Maintenance
 from dbsync.client.net import post_request
-from dbsync.client.pull import BadResponseError, merge
+from dbsync.client.pull import BadResponseError, merge, PAYLOAD_CHUNK_SIZE
 from dbsync.client.register import RegisterRejected
+from dbsync.client.snapshot import SnapshotUnavailable, load_snapshot
+from dbsync.client.repair import (
+    REPAIR_CHUNK_SIZE,
+    REPAIR_PARALLEL_MODELS,
+    RepairRejected,
+    begin_streamed_repair,
+    pending_repair,
+    repair_dependencies,
+    load_repair_chunk,
+    finish_repair_model,
+    finish_streamed_repair,
+    local_merkle_tree,
+    repair_buckets,
+    finish_differential_repair)
 from dbsync.createlogger import create_logger
 from dbsync.messages.codecs import encode_dict, SyncdbJSONEncoder
 from dbsync.messages.pull import PullRequestMessage, PullMessage
 from dbsync.messages.push import PushMessage
 from dbsync.messages.register import RegisterMessage
+from dbsync.messages.store import PayloadStore
 from dbsync.models import Node, get_model_extensions_for_obj, Version, Operation
 from dbsync.socketclient import GenericWSClient
 from sqlalchemy.engine import Engine
@@ -30,6 +49,8 @@ from dbsync.wscommon import SerializationError
 
 wscommon.register_exception(PushRejected)
 wscommon.register_exception(PullSuggested)
+wscommon.register_exception(RepairRejected)
+wscommon.register_exception(SnapshotUnavailable)
 
 from logging import DEBUG
 import logging
@@ -43,6 +64,10 @@ class SyncClient(GenericWSClient):
     Session: Optional[sessionmaker] = None
     id: int = -1
     elapsed_rounds=0
+    maintenance: Optional[Maintenance] = None
+    #: run the maintenance in idle time after each successful sync
+    auto_maintenance: bool = True
+    syncing: int = 0
 
     def __post_init__(self):
         if not self.Session:
@@ -50,6 +75,10 @@ class SyncClient(GenericWSClient):
             self.Session = lambda: core.SessionClass(
                 bind=self.engine)  # to behave like core.Session() but dont set the internal flag
             # self.Session = sessionmaker(bind=self.engine)
+        if self.maintenance is None:
+            self.maintenance = Maintenance(self.engine,
+                                           idle=lambda: not self.syncing)
+        self._maintenance_task = None
 
     @property
     def register_url(self):
@@ -195,7 +224,16 @@ class SyncClient(GenericWSClient):
         return new_version_id
 
     async def run_pull(self, session: Optional[sqlalchemy.orm.session.Session] = None,
-                       extra_data: Dict[str, Any] = None, monitor: Optional[Callable[[Dict[str, Any]], None]] = None):
+                       extra_data: Dict[str, Any] = None, monitor: Optional[Callable[[Dict[str, Any]], None]] = None,
+                       store: Optional[PayloadStore] = None):
+        """
+        Requests a pull message and merges it. *store* is an optional
+        PayloadStore to keep the pulled objects in, instead of memory.
+
+        The payload is received in chunks of ``PAYLOAD_CHUNK_SIZE``
+        objects, each added to the message as it arrives, so with a
+        store only a chunk is decoded in memory at once.
+        """
         include_extensions = False
         if extra_data is None:
             extra_data = {}
@@ -212,17 +250,19 @@ class SyncClient(GenericWSClient):
         for op in compress():
             request_message.add_operation(op)
         data = request_message.to_json()
-        data.update({'extra_data': extra_data or {}})
+        data.update({'extra_data': extra_data or {},
+                     'payload_chunk_size': PAYLOAD_CHUNK_SIZE})
         msg = json.dumps(data,  cls=SyncdbJSONEncoder)
         logger.info("requesting PullMessage")
         await self.websocket.send(msg)
 
-        response_str = await self.websocket.recv()
-        response = json.loads(response_str)
+        response = json.loads(await self.websocket.recv())
         message = None
         try:
-            message = PullMessage(response)
-            logger.info(f"got PullMessage: {message} from response: {response_str}")
+            message = PullMessage(response, store=store)
+            if response.get('payload_chunked', False):
+                await self._receive_payload(message)
+            logger.info(f"got PullMessage: {message}")
         except KeyError:
             if monitor:
                 monitor({
@@ -239,13 +279,175 @@ class SyncClient(GenericWSClient):
                 'operations': len(message.operations)})
 
         logger.info("merging PullMessage...")
-        await merge(message, include_extensions=include_extensions, websocket=self.websocket)  #TODO: request_payload etc.
+        stats = await merge(message, include_extensions=include_extensions, websocket=self.websocket)  #TODO: request_payload etc.
         if monitor:
-            monitor({'status': "done"})
+            monitor({'status': "done",
+                     'max_blocking': stats.max_blocking,
+                     'duration': stats.duration})
         # return the response for the programmer to do what she wants
         # afterwards
         return response
 
+    async def _receive_payload(self, message):
+        """
+        Adds the payload chunks that follow a pull message to it, one
+        chunk at a time, until the ``payload_end`` message.
+        """
+        while True:
+            chunk = json.loads(await self.websocket.recv())
+            if chunk['type'] == "payload_end":
+                return message
+            message.add_encoded(chunk['model'], chunk['objects'])
+
+    async def run_repair(self, parallel: int = REPAIR_PARALLEL_MODELS,
+                         chunk_size: int = REPAIR_CHUNK_SIZE,
+                         include_extensions: bool = True,
+                         monitor: Optional[Callable[[Dict[str, Any]], None]] = None) -> Optional[int]:
+        """
+        Replaces the local database with the server's, streaming each
+        model in chunks over its own connection to ``/repair``. Up to
+        *parallel* models are downloaded at once, and a model waits
+        for the models it references to be loaded.
+
+        If a previous repair was interrupted, it's resumed from the
+        last chunk loaded. Returns the version identifier the local
+        database is left at.
+        """
+        pending = pending_repair()
+        if not pending:
+            begin_streamed_repair()
+            pending = pending_repair()
+        dependencies = repair_dependencies()
+        loaded = dict((name, asyncio.Event()) for name in dependencies)
+        for name, event in loaded.items():
+            if name not in pending:
+                event.set()
+        semaphore = asyncio.Semaphore(parallel)
+
+        async def stream(name):
+            for parent in dependencies.get(name, []):
+                await loaded[parent].wait()
+            async with semaphore:
+                async with websockets.connect(self.uri("repair"), max_size=None) as ws:
+                    await ws.send(json.dumps(dict(
+                        model=name,
+                        after=pending[name],
+                        chunk_size=chunk_size,
+                        include_extensions=include_extensions)))
+                    async for msg_ in ws:
+                        msg = json.loads(msg_)
+                        if msg['type'] == 'chunk':
+                            load_repair_chunk(name, msg['objects'], msg['last'],
+                                              include_extensions=include_extensions)
+                            if monitor:
+                                monitor({'status': "repairing", 'model': name,
+                                         'objects': len(msg['objects'])})
+                        elif msg['type'] == 'result':
+                            finish_repair_model(name, msg['latest_version_id'])
+                            break
+                    else:
+                        raise BadResponseError(
+                            "repair stream ended before the result", name)
+            loaded[name].set()
+
+        logger.info(f"repairing {len(pending)} models")
+        await asyncio.gather(*(stream(name) for name in pending))
+        latest_version_id = finish_streamed_repair()
+        if monitor:
+            monitor({'status': "done"})
+        return latest_version_id
+
+    async def run_differential_repair(self, include_extensions: bool = True,
+                                      monitor: Optional[Callable[[Dict[str, Any]], None]] = None) -> Optional[int]:
+        """
+        Repairs the local database fetching only the rows that differ
+        from the server's. For each model the hash trees of both
+        databases (see ``dbsync.merkle``) are compared over
+        ``/merkle``, descending only into the nodes whose digests
+        differ, and the rows in the differing leaf buckets are
+        replaced with the server's. Returns the version identifier
+        the local database is left at.
+        """
+        latest_version_id = None
+        async with websockets.connect(self.uri("merkle"), max_size=None) as ws:
+            async def ask(**request):
+                await ws.send(json.dumps(request))
+                response = json.loads(await ws.recv())
+                if response.get('type', None) != request['type']:
+                    raise BadResponseError(
+                        "unexpected differential repair response", response)
+                return response
+
+            for name in repair_dependencies():
+                tree = await ask(type="tree", model=name)
+                latest_version_id = tree['latest_version_id']
+                local = local_merkle_tree(name, tree['depth'])
+                if local.root == int(tree['root'], 16):
+                    continue
+                prefixes = [""]
+                for _ in range(tree['depth']):
+                    if not prefixes:
+                        break
+                    theirs = await ask(type="children", model=name,
+                                       prefixes=prefixes)
+                    prefixes = local.differing(
+                        prefixes,
+                        dict((prefix, int(digest, 16))
+                             for prefix, digest in theirs['digests'].items()))
+                if not prefixes:
+                    continue
+                rows = await ask(type="rows", model=name, buckets=prefixes,
+                                 include_extensions=include_extensions)
+                repaired = repair_buckets(name, prefixes, tree['depth'],
+                                          rows['objects'],
+                                          include_extensions=include_extensions)
+                logger.info(f"differential repair of {name}: "
+                            f"{len(prefixes)} buckets, {repaired} rows")
+                if monitor:
+                    monitor({'status': "repairing", 'model': name,
+                             'buckets': len(prefixes), 'objects': repaired})
+            await ws.send(json.dumps(dict(type="done")))
+        finish_differential_repair(latest_version_id)
+        if monitor:
+            monitor({'status': "done"})
+        return latest_version_id
+
+    async def run_bootstrap(self, monitor: Optional[Callable[[Dict[str, Any]], None]] = None) -> Optional[int]:
+        """
+        Replaces the local database with the snapshot kept by the
+        server, downloading it from ``/snapshot`` and loading it with
+        ``dbsync.client.snapshot.load_snapshot``. Returns the version
+        identifier of the snapshot.
+        """
+        fd, path = tempfile.mkstemp(prefix="dbsync-snapshot-", suffix=".db")
+        try:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)  # gzip
+            with os.fdopen(fd, 'wb') as f:
+                async with websockets.connect(self.uri("snapshot"), max_size=None) as ws:
+                    header = json.loads(await ws.recv())
+                    received = 0
+                    async for msg in ws:
+                        if isinstance(msg, bytes):
+                            f.write(decompressor.decompress(msg))
+                            received += len(msg)
+                            if monitor:
+                                monitor({'status': "downloading",
+                                         'received': received,
+                                         'size': header['size']})
+                        elif json.loads(msg)['type'] == 'result':
+                            break
+                    else:
+                        raise BadResponseError("snapshot transfer interrupted")
+                f.write(decompressor.flush())
+            if monitor:
+                monitor({'status': "loading"})
+            version_id = load_snapshot(path)
+        finally:
+            os.remove(path)
+        if monitor:
+            monitor({'status': "done"})
+        return version_id
+
     async def synchronize(self, id=None):
         """
 
@@ -256,6 +458,18 @@ class SyncClient(GenericWSClient):
             tries because of overlapping sync ops
         """
         tries = 15
+        self.syncing += 1
+        try:
+            _round = await self._synchronize(tries, id)
+        finally:
+            self.syncing -= 1
+        if _round is not None:
+            self.maintenance.request()
+            if self.auto_maintenance:
+                self.schedule_maintenance()
+        return _round
+
+    async def _synchronize(self, tries, id):
         for _round in range(tries):
             try:
                 logger.info(f"-- round {_round} for {id}: try push")
@@ -275,6 +489,35 @@ class SyncClient(GenericWSClient):
             except Exception as ex:
                 raise
 
+    async def run_maintenance(self, budget=None):
+        """
+        Runs the due maintenance chores for at most *budget* seconds,
+        yielding to the event loop between steps. Returns the report,
+        or ``None`` if no maintenance was due.
+        """
+        if self.syncing or not self.maintenance.due():
+            return None
+        return await self.maintenance.run(budget)
+
+    def schedule_maintenance(self):
+        """
+        Schedules the maintenance in the background, one budget at a
+        time, until it's done or a synchronization starts.
+        """
+        if self._maintenance_task is not None and \
+                not self._maintenance_task.done():
+            return self._maintenance_task
+
+        async def idle_maintenance():
+            while not self.syncing:
+                report = await self.run_maintenance()
+                if report is None or report.finished:
+                    return report
+                await asyncio.sleep(self.maintenance.budget)
+
+        self._maintenance_task = asyncio.ensure_future(idle_maintenance())
+        return self._maintenance_task
+
     async def call(self, route, action=None, timeout=600, *a, **kw):
         logger.warn(f"CALL: {route}")
         url = f"{self.base_uri}/{route}"
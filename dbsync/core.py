@@ -18,7 +18,9 @@ try:
 except ImportError:
     from typing import _Protocol as Protocol
 
-from sqlalchemy import Table, Column, event
+from sqlalchemy import Table, Column, event, func
+from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.sql.util import sort_tables
 
 logging.getLogger('dbsync').addHandler(logging.NullHandler())
 
@@ -28,8 +30,8 @@ from sqlalchemy.engine import Engine
 
 from dbsync.lang import *
 from dbsync.utils import get_pk, query_model, copy, class_mapper
-from dbsync.models import ContentType, Operation, Version, SQLClass, _has_delete_functions, _has_extensions, \
-    delete_extensions, save_extensions
+from dbsync.models import ContentType, Operation, OperationMixin, Version, SQLClass, _has_delete_functions, \
+    _has_extensions, delete_extensions, save_extensions
 from dbsync import dialects
 from dbsync.logs import get_logger
 
@@ -150,6 +152,41 @@ class tracked_record:
 
 null_model = tracked_record()
 
+
+@dataclass(frozen=True)
+class model_metadata:
+    """
+    Schema information of a synchronized model, derived once from its
+    mapper when the model is installed.
+
+    *parents* holds a (parent model, foreign key column name) pair
+    for each foreign key pointing to another synchronized model, and
+    *children* a (child model, foreign key column names) pair for
+    each synchronized model pointing to this one. *unique* holds the
+    column names of each unique constraint, including both tables of
+    a joined table.
+    """
+    model: SQLClass
+    table: Union[Table, Join]
+    entity_name: str
+    pk: str
+    unique: Tuple[Tuple[str, ...], ...] = ()
+    parents: Tuple[Tuple[SQLClass, str], ...] = ()
+    children: Tuple[Tuple[SQLClass, Tuple[str, ...]], ...] = ()
+
+
+def _unique_constraints(table: Union[Table, Join]) -> Tuple[Tuple[str, ...], ...]:
+    constraints = table.left.constraints.union(table.right.constraints) \
+        if isinstance(table, Join) else table.constraints
+    return tuple(tuple(col.name for col in constraint.columns)
+                 for constraint in constraints
+                 if isinstance(constraint, UniqueConstraint))
+
+
+def _entity_name(table: Union[Table, Join]) -> str:
+    return table.right.name if isinstance(table, Join) else table.name
+
+
 ModelHandler = Callable[[str], Any]
 @dataclass
 class SyncedModels:
@@ -157,6 +194,10 @@ class SyncedModels:
     models: Dict[DeclarativeMeta, tracked_record] = field(default_factory=dict)
     ids: Dict[int, tracked_record] = field(default_factory=dict)
     model_names: Dict[str, tracked_record] = field(default_factory=dict)
+    #: Schema information of each model, see :class:`model_metadata`.
+    metadata: Dict[DeclarativeMeta, model_metadata] = field(default_factory=dict)
+    #: The models sorted so that parents come before their children.
+    order: Tuple[DeclarativeMeta, ...] = ()
     model_handlers: Dict[
         DeclarativeMeta,
         Tuple
@@ -179,6 +220,55 @@ class SyncedModels:
         self.models[model] = record
         self.tables[tname] = record
         self.ids[ct_id] = record
+        self._build_metadata()
+
+    def _build_metadata(self) -> None:
+        """
+        Rebuilds the schema information of every installed model,
+        since foreign key edges depend on which models are tracked.
+        """
+        tables = dict((class_mapper(model).mapped_table, model)
+                      for model in self.models)
+        # foreign keys may point to the own table of a joined model
+        targets = dict(tables)
+        targets.update((model.__table__, model) for model in self.models)
+        parents = dict((model, tuple(
+            (targets[fk.column.table], fk.parent.name)
+            for fk in table.foreign_keys
+            if fk.column.table in targets))
+                       for table, model in tables.items())
+        children = dict((model, []) for model in self.models)
+        for child, edges in parents.items():
+            fks = {}
+            for parent, fk in edges:
+                fks.setdefault(parent, []).append(fk)
+            for parent, names in fks.items():
+                children[parent].append((child, tuple(names)))
+        self.metadata = dict(
+            (model, model_metadata(
+                model=model,
+                table=table,
+                entity_name=_entity_name(table),
+                pk=get_pk(model),
+                unique=_unique_constraints(table),
+                parents=parents[model],
+                children=tuple(children[model])))
+            for table, model in tables.items())
+        by_table = dict((model.__table__, model) for model in self.models)
+        self.order = tuple(by_table[table]
+                           for table in sort_tables(list(by_table)))
+
+    def parent_references(self, obj: SQLClass) -> List[Tuple[DeclarativeMeta, Any]]:
+        """
+        Returns a list of pairs (parent model, primary key) that
+        reference the synchronized parents of *obj*.
+        """
+        for class_ in type(obj).__mro__:
+            meta = self.metadata.get(class_, None)
+            if meta is not None:
+                return [(parent, getattr(obj, fk))
+                        for parent, fk in meta.parents]
+        return []
 
     def register_handlers(self,
                           model: DeclarativeMeta,
@@ -203,6 +293,8 @@ class SyncedModels:
         self.model_names.clear()
         self.tables.clear()
         self.ids.clear()
+        self.metadata = {}
+        self.order = ()
 
 
 
@@ -228,13 +320,13 @@ def table_name_for_id(id: int) -> Optional[str]:
     return None
 
 
-def tracked_model(operation: Operation) -> Optional[SQLClass]:
+def tracked_model(operation: OperationMixin) -> Optional[SQLClass]:
     "Get's the tracked model (SA mapped class) for this operation."
     return synched_models.ids.get(operation.content_type_id, null_model).model
 
 
-# Injects synched models lookup into the Operation class.
-Operation.tracked_model = property(tracked_model)
+# Injects synched models lookup into the Operation classes.
+OperationMixin.tracked_model = property(tracked_model)
 
 
 class ModelList(Set):
@@ -457,8 +549,7 @@ def is_synched(obj, session=None):
     if type(obj) not in synched_models.models:
         raise TypeError("the given object of class {0} isn't being tracked". \
                         format(obj.__class__.__name__))
-    session = Session()
-    last_op = session.query(Operation). \
+    last_op = session.query(Operation.version_id). \
         filter(Operation.content_type_id == synched_models.models[type(obj)].id,
                Operation.row_id == getattr(obj, get_pk(obj))). \
         order_by(Operation.order.desc()).first()
@@ -473,5 +564,4 @@ def get_latest_version_id(session=None):
     """
     # assuming version identifiers grow monotonically
     # might need to order by 'created' datetime field
-    version = session.query(Version).order_by(Version.version_id.desc()).first()
-    return maybe(version, attr('version_id'), None)
+    return session.query(func.max(Version.version_id)).scalar()
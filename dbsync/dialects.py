@@ -12,6 +12,10 @@ from sqlalchemy import func, TypeDecorator, CHAR
 from sqlalchemy.dialects.postgresql import UUID
 
 from dbsync.utils import class_mapper, get_pk
+from dbsync.logs import get_logger
+
+
+logger = get_logger(__name__)
 
 
 class GUID(TypeDecorator):
@@ -60,41 +64,92 @@ from sqlalchemy.dialects.sqlite.base import SQLiteTypeCompiler
 SQLiteTypeCompiler.visit_JSONB = SQLiteTypeCompiler.visit_JSON
 
 
+#: Whether sync transactions switch SQLite databases to WAL journaling,
+#  which lets the application keep reading while a sync writes.
+SQLITE_WAL = True
+
+#: Pragmas set on the connection of a sync transaction in SQLite, and
+#  restored afterwards.
+SQLITE_SYNC_PRAGMAS = {
+    'synchronous': 1,  # NORMAL, safe in WAL mode
+    'cache_size': -64000,  # in KiB
+    'temp_store': 2,  # MEMORY
+}
+
+
+class TransactionState(object):
+    """
+    What :func:`begin_transaction` changed: the dedicated connection
+    the session was bound to and the statements that restore it.
+    """
+
+    def __init__(self, connection, bind):
+        self.connection = connection
+        self.bind = bind
+        self.restore = []
+
+
+def _pragma(connection, name):
+    return connection.execute("PRAGMA {0};".format(name)).scalar()
+
+
 def begin_transaction(session):
     """
-    Returns information of the state the database was on before the
-    transaction began.
+    Binds *session* to a dedicated connection and prepares it for a
+    sync transaction. Returns a :class:`TransactionState` to be given
+    to :func:`end_transaction`.
+
+    In SQLite the database is switched to WAL journaling (see
+    ``SQLITE_WAL``), foreign keys are disabled and the pragmas in
+    ``SQLITE_SYNC_PRAGMAS`` set, all only on that connection, and
+    the transaction is started with ``BEGIN IMMEDIATE``, so that
+    other connections can keep reading.
     """
-    engine = session.bind
-    dialect = engine.name
+    bind = session.bind
+    connection = bind.connect()
+    session.bind = connection
+    state = TransactionState(connection, bind)
+    dialect = connection.dialect.name
     if dialect == 'sqlite':
-        cursor = engine.execute("PRAGMA foreign_keys;")
-        state = cursor.fetchone()[0]
-        cursor.close()
-        engine.execute("PRAGMA foreign_keys = OFF;")
-        engine.execute("BEGIN EXCLUSIVE TRANSACTION;")
-        return state
-    if dialect == 'mysql':
-        # temporal by default
+        if SQLITE_WAL:
+            mode = _pragma(connection, "journal_mode = WAL")
+            if mode != 'wal':
+                logger.warning(f"couldn't switch to WAL journaling: {mode}")
+        foreign_keys = _pragma(connection, "foreign_keys")
+        connection.execute("PRAGMA foreign_keys = OFF;")
+        state.restore.append("PRAGMA foreign_keys = {0};".format(
+            int(foreign_keys) if foreign_keys in (0, 1) else 1))
+        for name, value in SQLITE_SYNC_PRAGMAS.items():
+            state.restore.append("PRAGMA {0} = {1};".format(
+                name, _pragma(connection, name)))
+            connection.execute("PRAGMA {0} = {1};".format(name, value))
+        connection.execute("BEGIN IMMEDIATE TRANSACTION;")
+    elif dialect == 'mysql':
         # see http://dev.mysql.com/doc/refman/5.7/en/using-system-variables.html
-        engine.execute("SET foreign_key_checks = 0;")
-        return None
-    if dialect == 'postgresql':
-        # defer constraints
-        engine.execute("SET CONSTRAINTS ALL DEFERRED;")
-        return None
-    return None
+        connection.execute("SET foreign_key_checks = 0;")
+        state.restore.append("SET foreign_key_checks = 1;")
+    elif dialect == 'postgresql':
+        # defer constraints, within the session's transaction
+        session.execute("SET CONSTRAINTS ALL DEFERRED;")
+    return state
 
 
 def end_transaction(state, session):
     """
-    *state* is whatever was returned by :func:`begin_transaction`
+    *state* is whatever was returned by :func:`begin_transaction`.
+    Restores the connection's settings and releases it.
     """
-    engine = session.bind
-    dialect = engine.name
-    if dialect == 'sqlite':
-        if state not in (0, 1): state = 1
-        engine.execute("PRAGMA foreign_keys = {0}".format(int(state)))
+    try:
+        if state.connection.dialect.name == 'sqlite' and \
+                getattr(state.connection.connection, 'in_transaction', False):
+            # the session didn't use the connection, so the transaction
+            # begun by begin_transaction holds nothing
+            state.connection.execute("ROLLBACK;")
+        for statement in state.restore:
+            state.connection.execute(statement)
+    finally:
+        state.connection.close()
+        session.bind = state.bind
 
 
 def max_local(sa_class, session):
@@ -102,7 +157,7 @@ def max_local(sa_class, session):
     Returns the maximum primary key used for the given table.
     """
     engine = session.bind
-    dialect = engine.name
+    dialect = engine.dialect.name
     table_name = class_mapper(sa_class).mapped_table.name
     # default, strictly incorrect query
     found = session.query(func.max(getattr(sa_class, get_pk(sa_class)))).scalar()
@@ -0,0 +1,68 @@
+"""
+.. module:: dbsync.indexes
+   :synopsis: Verification and creation of the synchronization indexes.
+
+The synchronization tables declare the indexes their hot queries
+need (see ``dbsync.models``), which ``create_all`` creates in new
+databases. Databases created by older versions lack them;
+:func:`missing_indexes` lists the ones absent and
+:func:`upgrade_indexes` creates them in place.
+"""
+
+from typing import List, Optional
+
+from sqlalchemy import inspect
+from sqlalchemy.engine import Engine
+
+from dbsync import core
+from dbsync.models import Operation, Version, UNVERSIONED_INDEX, \
+    unversioned_index_ddl
+from dbsync.logs import get_logger
+
+
+logger = get_logger(__name__)
+
+#: Dialects that support the partial index on unversioned operations.
+PARTIAL_INDEX_DIALECTS = ('sqlite', 'postgresql')
+
+#: Tables whose declared indexes are verified.
+INDEXED_TABLES = (Operation.__table__, Version.__table__)
+
+
+def missing_indexes(engine: Optional[Engine] = None) -> List[str]:
+    "Returns the names of the synchronization indexes absent in the database."
+    engine = engine or core.get_engine()
+    inspector = inspect(engine)
+    missing = []
+    for table in INDEXED_TABLES:
+        present = set(index['name'] for index in inspector.get_indexes(table.name))
+        missing.extend(index.name for index in sorted(table.indexes,
+                                                      key=lambda i: i.name)
+                       if index.name not in present)
+        if table is Operation.__table__ and \
+                engine.dialect.name in PARTIAL_INDEX_DIALECTS and \
+                UNVERSIONED_INDEX not in present:
+            missing.append(UNVERSIONED_INDEX)
+    return missing
+
+
+def upgrade_indexes(engine: Optional[Engine] = None) -> List[str]:
+    """
+    Creates the synchronization indexes absent in the database.
+    Returns the names of the indexes created.
+    """
+    engine = engine or core.get_engine()
+    missing = missing_indexes(engine)
+    if not missing:
+        return missing
+    indexes = dict((index.name, index)
+                   for table in INDEXED_TABLES for index in table.indexes)
+    with engine.begin() as connection:
+        for name in missing:
+            if name == UNVERSIONED_INDEX:
+                unversioned_index_ddl.execute(connection,
+                                              target=Operation.__table__)
+            else:
+                indexes[name].create(connection)
+            logger.info("created index %s", name)
+    return missing
@@ -37,17 +37,34 @@ def partial(f, *arguments):
 
 
 class Function(object):
-    "Composable function for attr and method usage."
-    def __init__(self, fn):
+    """
+    Composable function for attr and method usage.
+
+    Functions built from ``attr(name) == value`` and
+    ``attr(name).in_(values)`` keep a description of the comparison
+    in *comparison*, as a tuple (operator, attribute name, value), so
+    that stores able to index attributes can evaluate them without
+    calling the function on each element.
+    """
+    #: name of the attribute accessed, for functions built with attr
+    attribute = None
+    #: (operator, attribute, value) for simple attribute comparisons
+    comparison = None
+    def __init__(self, fn, attribute=None, comparison=None):
         self.fn = fn
         self.__name__ = fn.__name__ # e.g. for the wraps decorator
+        self.attribute = attribute
+        self.comparison = comparison
     def __call__(self, obj):
         return self.fn(obj)
     def __eq__(self, other):
         if isinstance(other, Function):
             return Function(lambda obj: self.fn(obj) == other(obj))
         else:
-            return Function(lambda obj: self.fn(obj) == other)
+            return Function(lambda obj: self.fn(obj) == other,
+                            comparison=maybe(self.attribute,
+                                             lambda a: ('==', a, other),
+                                             None))
     def __lt__(self, other):
         if isinstance(other, Function):
             return Function(lambda obj: self.fn(obj) < other(obj))
@@ -86,12 +103,15 @@ class Function(object):
         else:
             return Function(lambda obj: self.fn(obj) or other)
     def in_(self, collection):
-        return Function(lambda obj: self.fn(obj) in collection)
+        return Function(lambda obj: self.fn(obj) in collection,
+                        comparison=maybe(self.attribute,
+                                         lambda a: ('in', a, collection),
+                                         None))
 
 
 def attr(name):
     "For use in standard higher order functions."
-    return Function(lambda obj: getattr(obj, name))
+    return Function(lambda obj: getattr(obj, name), attribute=name)
 
 
 def method(name, *args, **kwargs):
@@ -0,0 +1,195 @@
+"""
+.. module:: dbsync.merkle
+   :synopsis: Hash trees over the rows of synchronized tables.
+
+A :class:`MerkleTree` summarizes the rows of a table so that two
+databases can find the rows they disagree on by exchanging a few
+digests instead of the rows themselves.
+
+Each row gets a digest computed from its encoded values, and lands in
+a bucket named after the first hex digits of a hash of its primary
+key. The digest of a bucket is the XOR of the digests of its rows, so
+it doesn't depend on the order rows are read in, and each tree node
+(a bucket prefix) is the XOR of its sixteen children. Both sides of
+the comparison must use the same *depth*, which the server decides
+from the size of the table.
+
+The rows are read with plain column selects, streamed in batches; the
+digests are computed in python over the same encoding used in
+messages, so that values compare equal across database backends. A
+tree built from rows also keeps the keys of each leaf bucket, so the
+rows in some buckets can be found without reading the table again
+(see :meth:`MerkleTree.bucket_pks`).
+"""
+
+import hashlib
+import json
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.engine import Connection
+
+from dbsync.utils import class_mapper, get_pk
+from dbsync.messages.codecs import SyncdbJSONEncoder, encode_dict, decode, \
+    types_dict
+
+
+#: Hexadecimal digits, one for each child of a tree node.
+DIGITS = "0123456789abcdef"
+
+#: Maximum depth of a tree (16 ** depth leaf buckets).
+MAX_DEPTH = 6
+
+#: Rows expected in each leaf bucket when choosing the depth.
+LEAF_SIZE = 8
+
+#: Amount of rows fetched at once.
+BATCH_SIZE = 1000
+
+
+def tree_depth(count: int) -> int:
+    "Returns the depth to use for a table of *count* rows."
+    depth = 1
+    while depth < MAX_DEPTH and (16 ** depth) * LEAF_SIZE < count:
+        depth += 1
+    return depth
+
+
+def _canonical(value: Any) -> str:
+    return json.dumps(value, cls=SyncdbJSONEncoder, sort_keys=True)
+
+
+def bucket(pk_key: str, depth: int) -> str:
+    "Returns the leaf bucket of the row with the canonical key *pk_key*."
+    return hashlib.md5(pk_key.encode('utf-8')).hexdigest()[:depth]
+
+
+def row_digest(encoded: Dict[str, Any]) -> int:
+    "Returns the digest of a row given as an encoded dictionary."
+    return int.from_bytes(
+        hashlib.sha1(_canonical(encoded).encode('utf-8')).digest()[:16],
+        'big')
+
+
+def _columns(model) -> List[Tuple[str, Any]]:
+    return [(prop.key, prop.columns[0])
+            for prop in class_mapper(model).column_attrs]
+
+
+def _stream(connection: Connection, query) -> Iterator[Any]:
+    result = connection.execution_options(stream_results=True).execute(query)
+    while True:
+        rows = result.fetchmany(BATCH_SIZE)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+
+
+def encoded_rows(model, connection: Connection) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Yields (canonical primary key, encoded dictionary) for each row
+    of *model*, reading only the mapped columns.
+    """
+    columns = _columns(model)
+    keys = [key for key, _ in columns]
+    pk = get_pk(model)
+    encode = encode_dict(model)
+    query = select([c for _, c in columns]).\
+        select_from(class_mapper(model).mapped_table)
+    for row in _stream(connection, query):
+        encoded = encode(dict(zip(keys, row)))
+        yield _canonical(encoded[pk]), encoded
+
+
+def bucket_pks(model, connection: Connection, buckets: Iterable[str],
+               depth: int) -> List[Any]:
+    "Returns the primary keys of the rows of *model* in *buckets*."
+    buckets = set(buckets)
+    pk = get_pk(model)
+    column = getattr(model, pk).property.columns[0]
+    encode = encode_dict(model)
+    query = select([column]).select_from(class_mapper(model).mapped_table)
+    return [value for (value,) in _stream(connection, query)
+            if bucket(_canonical(encode({pk: value})[pk]), depth) in buckets]
+
+
+class MerkleTree(object):
+    """
+    Digests of the rows of a table, by bucket prefix.
+
+    ``levels[i]`` maps prefixes of *i* digits to digests. Empty
+    buckets are left out (their digest is 0). ``keys`` maps each leaf
+    bucket to the canonical primary keys of its rows.
+    """
+
+    def __init__(self, depth: int, count: int = 0):
+        self.depth = depth
+        self.count = count
+        self.levels: List[Dict[str, int]] = [{} for _ in range(depth + 1)]
+        self.keys: Dict[str, List[str]] = {}
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Tuple[str, Dict[str, Any]]],
+                  depth: int) -> "MerkleTree":
+        "Builds a tree from (canonical primary key, encoded row) pairs."
+        tree = cls(depth)
+        leaves = tree.levels[depth]
+        for pk_key, encoded in rows:
+            b = bucket(pk_key, depth)
+            leaves[b] = leaves.get(b, 0) ^ row_digest(encoded)
+            tree.keys.setdefault(b, []).append(pk_key)
+            tree.count += 1
+        for level in range(depth - 1, -1, -1):
+            upper = tree.levels[level]
+            for prefix, digest in tree.levels[level + 1].items():
+                upper[prefix[:-1]] = upper.get(prefix[:-1], 0) ^ digest
+        return tree
+
+    @classmethod
+    def for_model(cls, model, connection: Connection,
+                  depth: Optional[int] = None) -> "MerkleTree":
+        """
+        Builds the tree of the table of *model*. If *depth* isn't
+        given it's chosen from the amount of rows.
+        """
+        if depth is None:
+            depth = tree_depth(connection.execute(
+                select([func.count()]).
+                select_from(class_mapper(model).mapped_table)).scalar())
+        return cls.from_rows(encoded_rows(model, connection), depth)
+
+    @property
+    def root(self) -> int:
+        return self.levels[0].get("", 0)
+
+    def children(self, prefixes: Iterable[str]) -> Dict[str, int]:
+        "Returns the non-empty children of the nodes at *prefixes*."
+        result = {}
+        for prefix in prefixes:
+            level = self.levels[len(prefix) + 1]
+            for digit in DIGITS:
+                digest = level.get(prefix + digit, 0)
+                if digest:
+                    result[prefix + digit] = digest
+        return result
+
+    def bucket_pks(self, model, buckets: Iterable[str]) -> List[Any]:
+        """
+        Returns the primary keys of the rows of *model* (the model
+        the tree was built from) in the leaf *buckets*.
+        """
+        decode_pk = decode(types_dict(model)[get_pk(model)])
+        return [decode_pk(json.loads(pk_key))
+                for b in set(buckets) for pk_key in self.keys.get(b, ())]
+
+    def differing(self, prefixes: Iterable[str],
+                  others: Dict[str, int]) -> List[str]:
+        """
+        Returns the children of the nodes at *prefixes* whose digest
+        differs from the one in *others* (the children of the same
+        nodes in another tree).
+        """
+        mine = self.children(prefixes)
+        return sorted(p for p in set(mine) | set(others)
+                      if mine.get(p, 0) != others.get(p, 0))
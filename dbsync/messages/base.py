@@ -3,13 +3,13 @@ Base functionality for synchronization messages.
 """
 
 import inspect
-from typing import Dict, Any, Union, Set, List
+from typing import Dict, Any, Iterable, Union, Set, List, Mapping
 
 from dbsync.lang import *
 from dbsync.utils import get_pk, properties_dict, construct_bare
 from dbsync.models import SQLClass, ExtensionField, Extension, \
     get_model_extensions_for_obj
-from dbsync.core import null_model, synched_models
+from dbsync.core import null_model, synched_models, MAX_SQL_VARIABLES
 
 from dbsync import models
 from dbsync.messages.codecs import decode_dict, encode_dict
@@ -89,13 +89,16 @@ class MessageQuery(object):
         to_filter = self.payload.get(self.target, None)
         if to_filter is None:
             return self
+        # collections kept in a payload store filter themselves lazily
+        filtered = to_filter.filter(predicate) \
+            if hasattr(to_filter, 'filter') \
+            else list(filter(predicate, to_filter))
         return MessageQuery(
             self.target,
             dict(
                 self.payload,
                 **{
-                    self.target: list(
-                        filter(predicate, to_filter))
+                    self.target: filtered
                 }
             )
         )
@@ -127,41 +130,76 @@ class MessageQuery(object):
 class BaseMessage(object):
     "The base type for messages with a payload."
 
-    #: dictionary of (model name, set of wrapped objects)
-    payload: Dict[str, Set]
+    #: dictionary of (model name, set of wrapped objects), or a
+    #  dbsync.messages.store.PayloadStore
+    payload: Mapping[str, Set]
 
-    def __init__(self, raw_data: Dict[str, Any] = None):
-        self.payload = {}
+    def __init__(self, raw_data: Dict[str, Any] = None, store=None):
+        """
+        *store* is an optional ``dbsync.messages.store.PayloadStore``
+        to keep the payload in, instead of memory.
+        """
+        self.payload = store if store is not None else {}
+        #: (model name, (object set, size, {pk: object})) for lookups
+        #  in an in-memory payload
+        self._indexes: Dict[str, Any] = {}
         if raw_data is not None:
             self._from_raw(raw_data)
 
     def _from_raw(self, data):
+        for k, v in list(data['payload'].items()):
+            self.add_encoded(k, v)
 
-        def getm(k):
-            res = synched_models.model_names.get(k, null_model).model
-            return res
-
-        payload_items = list(data['payload'].items())
-
-        kvms = [
-            (k, v, getm(k))
-            for (k, v)
-            in iter(payload_items)
-        ]
-
-        for (k, v, m) in \
-                [k_v_m
-                 for k_v_m in kvms
-                 if k_v_m[2] is not None
-                 ]:
-            # breakpoint()
-            self.payload[k] = set(
-                [ObjectType(k, dict_[get_pk(m)], **dict_) for dict_ in map(decode_dict(m), v)])
+    def add_encoded(self, name: str, dicts: Iterable[Dict[str, Any]]):
+        """
+        Adds objects of the model *name* given as encoded dictionaries,
+        as they come in a raw message. Payloads received in chunks are
+        added one chunk at a time.
+        """
+        model = synched_models.model_names.get(name, null_model).model
+        if model is None:
+            return self
+        if not isinstance(self.payload, dict):
+            # stores keep the objects encoded
+            self.payload.add_encoded(name, dicts)
+            return self
+        pk = get_pk(model)
+        self.payload.setdefault(name, set()).update(
+            ObjectType(name, dict_[pk], **dict_)
+            for dict_ in map(decode_dict(model), dicts))
+        return self
 
     def query(self, model):
         """Returns a query object for this message."""
         return MessageQuery(model, self.payload)
 
+    def get_objects(self, model: SQLClass, pks: Iterable[Any]) -> Dict[Any, Any]:
+        """
+        Returns a dictionary of (primary key, object mapped to *model*)
+        for the objects in the payload with any of the primary keys
+        *pks*. Stores answer through their index, in batches; in-memory
+        payloads are indexed by primary key once per model.
+        """
+        pks = set(pk for pk in pks if pk is not None)
+        if not isinstance(self.payload, dict):
+            found = {}
+            for batch in grouper(pks, MAX_SQL_VARIABLES):
+                for obj in self.query(model).\
+                        filter(attr('__pk__').in_(list(batch))):
+                    found[getattr(obj, get_pk(model))] = obj
+            return found
+        name = model.__name__
+        objects = self.payload.get(name, set())
+        cached = self._indexes.get(name, None)
+        if cached is None or cached[0] is not objects or \
+                cached[1] != len(objects):
+            cached = (objects, len(objects),
+                      dict((obj.__pk__, obj) for obj in objects))
+            self._indexes[name] = cached
+        index = cached[2]
+        return dict((pk, index[pk].to_mapped_object())
+                    for pk in pks if pk in index)
+
     def to_json(self) -> Dict[str, Any]:
         """Returns a JSON-friendly python dictionary."""
         encoded: Dict[str, Any] = {'payload': {}}
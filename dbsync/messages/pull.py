@@ -4,15 +4,13 @@ Pull message and related.
 
 import datetime
 
-from sqlalchemy import types
+from sqlalchemy import types, func, select, union_all
 from sqlalchemy.orm import Query
 
 from dbsync.utils import (
     properties_dict,
     object_from_dict,
     get_pk,
-    parent_references,
-    parent_objects,
     query_model)
 from dbsync.lang import *
 
@@ -22,7 +20,9 @@ from dbsync.core import (
     synched_models,
     pulled_models,
     get_latest_version_id)
-from dbsync.models import Operation, Version, call_filter_operations, SkipOperation, call_before_server_add_operation_fn
+from dbsync import models
+from dbsync.models import Operation, OperationRecord, Version, call_filter_operations, SkipOperation, \
+    call_before_server_add_operation_fn, operations_archive
 from dbsync.messages.base import MessageQuery, BaseMessage
 from dbsync.messages.codecs import encode, encode_dict, decode, decode_dict
 
@@ -30,6 +30,32 @@ from dbsync.createlogger import create_logger
 logger = create_logger("dbsync-server")
 
 
+def _operations_query(session, latest_version_id) -> Query:
+    """
+    Returns a query of the operations, reading the archive as well if
+    the node at *latest_version_id* is older than some archived
+    operations (see ``dbsync.server.archive``).
+    """
+    query = session.query(Operation)
+    if not models.archive_enabled:
+        return query
+    archived_through = session.execute(
+        select([func.max(operations_archive.c.version_id)])).scalar()
+    if archived_through is None or \
+            (latest_version_id is not None and
+             latest_version_id >= archived_through):
+        return query
+    columns = [c.name for c in operations_archive.columns]
+    hot = select([Operation.__table__.c[name] for name in columns])
+    archived = select([operations_archive.c[name] for name in columns])
+    if latest_version_id is not None:
+        hot = hot.where(Operation.__table__.c.version_id > latest_version_id)
+        archived = archived.where(
+            operations_archive.c.version_id > latest_version_id)
+    logger.info(f"reading archived operations after {latest_version_id}")
+    return query.select_entity_from(union_all(hot, archived).alias())
+
+
 class PullMessage(BaseMessage):
     """
     A pull message.
@@ -51,14 +77,17 @@ class PullMessage(BaseMessage):
     #: List of versions being pulled.
     versions = None
 
-    def __init__(self, raw_data=None):
+    def __init__(self, raw_data=None, store=None):
         """
         *raw_data* must be a python dictionary, normally the
         product of JSON decoding. If not given, the message will be
         empty and should be filled with the appropriate methods
         (add_*).
+
+        *store* is an optional ``dbsync.messages.store.PayloadStore``
+        that will hold the payload objects instead of memory.
         """
-        super(PullMessage, self).__init__(raw_data)
+        super(PullMessage, self).__init__(raw_data, store=store)
         if raw_data is not None:
             self._build_from_raw(raw_data)
         else:
@@ -68,7 +97,7 @@ class PullMessage(BaseMessage):
 
     def _build_from_raw(self, data):
         self.created = decode(types.DateTime())(data['created'])
-        self.operations = list(map(partial(object_from_dict, Operation),
+        self.operations = list(map(OperationRecord.from_dict,
                                    list(map(decode_dict(Operation), data['operations']))))
         self.versions = list(map(partial(object_from_dict, Version),
                                  list(map(decode_dict(Version), data['versions']))))
@@ -93,7 +122,7 @@ class PullMessage(BaseMessage):
         encoded = super(PullMessage, self).to_json()
         encoded['created'] = encode(types.DateTime())(self.created)
         encoded['operations'] = list(map(encode_dict(Operation),
-                                         list(map(properties_dict, self.operations))))
+                                         list(map(method('to_dict'), self.operations))))
         encoded['versions'] = list(map(encode_dict(Version),
                                        list(map(properties_dict, self.versions))))
         return encoded
@@ -136,9 +165,11 @@ class PullMessage(BaseMessage):
             self.add_object(obj)
             if swell:
                 # add parent objects to resolve possible conflicts in merge
-                for parent in parent_objects(obj, list(synched_models.models.keys()),
-                                             session):
-                    self.add_object(parent)
+                for pmodel, ppk in synched_models.parent_references(obj):
+                    parent = query_model(session, pmodel). \
+                        filter_by(**{get_pk(pmodel): ppk}).first()
+                    if parent is not None:
+                        self.add_object(parent)
         return self
 
     @session_closing
@@ -204,7 +235,7 @@ class PullMessage(BaseMessage):
         # per dep injection we must add the query for allowed_users
 
         self.versions = versions.all()
-        ops: Query = session.query(Operation)
+        ops: Query = _operations_query(session, request.latest_version_id)
         if request.latest_version_id is not None:
             ops = ops.filter(Operation.version_id > request.latest_version_id)
 
@@ -214,7 +245,6 @@ class PullMessage(BaseMessage):
         self.operations = []
         logger.info(f"request.latest_version_id = {request.latest_version_id}")
         logger.info(f"querying for {ops}")
-        logger.info(f"query result: {ops.all()}")
         for op in ops:
             model = op.tracked_model
             if model is None:
@@ -244,8 +274,7 @@ class PullMessage(BaseMessage):
                     getattr(model, get_pk(model)).in_(list(pks))).all():
                 self.add_object(obj, include_extensions=include_extensions)
                 # add parent objects to resolve conflicts in merge
-                for pmodel, ppk in parent_references(obj,
-                                                     list(synched_models.models.keys())):
+                for pmodel, ppk in synched_models.parent_references(obj):
                     parent_pks = required_parents.get(pmodel, set())
                     parent_pks.add(ppk)
                     required_parents[pmodel] = parent_pks
@@ -295,7 +324,7 @@ class PullRequestMessage(BaseMessage):
             self.operations = []
 
     def _build_from_raw(self, data):
-        self.operations = list(map(partial(object_from_dict, Operation),
+        self.operations = list(map(OperationRecord.from_dict,
                                    list(map(decode_dict(Operation), data['operations']))))
         self.latest_version_id = decode(types.Integer())(
             data['latest_version_id'])
@@ -312,7 +341,7 @@ class PullRequestMessage(BaseMessage):
         encoded['operations'] = list(
             map(
                 encode_dict(Operation),
-                list(map(properties_dict, self.operations))
+                list(map(method('to_dict'), self.operations))
             )
         )
         encoded['latest_version_id'] = encode(types.Integer())(
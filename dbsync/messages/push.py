@@ -11,10 +11,7 @@ from dbsync.createlogger import create_logger
 from dbsync.dialects import GUID
 from sqlalchemy import types
 from dbsync.utils import (
-    properties_dict,
-    object_from_dict,
     get_pk,
-    parent_objects,
     query_model)
 from dbsync.lang import *
 
@@ -23,7 +20,7 @@ from dbsync.core import (
     session_closing,
     synched_models,
     pushed_models)
-from dbsync.models import Node, Operation, SQLClass
+from dbsync.models import Node, Operation, OperationMixin, OperationRecord, SQLClass
 from dbsync.messages.base import MessageQuery, BaseMessage
 from dbsync.messages.codecs import encode, encode_dict, decode, decode_dict
 
@@ -70,8 +67,9 @@ class PushMessage(BaseMessage):
     #: The latest version
     latest_version_id: int
 
-    #: List of unversioned operations
-    operations: List[Operation]
+    #: List of unversioned operations (mapped operations when built
+    #  from the local log, records when decoded)
+    operations: List[OperationMixin]
 
     def __init__(self, raw_data: Dict[str, Any] = None) -> None:
         """
@@ -95,7 +93,7 @@ class PushMessage(BaseMessage):
         self.operations = \
             list(
                 map(
-                    partial(object_from_dict, Operation),
+                    OperationRecord.from_dict,
                     list(
                         map(
                             decode_dict(Operation), data.get('operations', [])
@@ -131,7 +129,7 @@ class PushMessage(BaseMessage):
             self.latest_version_id)
         if include_operations:
             encoded['operations'] = list(map(encode_dict(Operation),
-                                             list(map(properties_dict, self.operations))))
+                                             list(map(method('to_dict'), self.operations))))
         return encoded
 
     def _portion(self) -> str:
@@ -164,19 +162,22 @@ class PushMessage(BaseMessage):
         self._sign()
 
     def islegit(self, session):
-        """Checks whether the key for this message is proper."""
+        """
+        Checks whether the key for this message is proper. Only the
+        node's secret is read.
+        """
         if self.key is None or self.node_id is None:
             return False
-        node: Optional[Node] = session.query(Node).filter(Node.node_id == self.node_id).first()
-        if node is None:
+        secret: Optional[str] = session.query(Node.secret).\
+            filter(Node.node_id == self.node_id).scalar()
+        if secret is None:
             raise LookupError(f"node with id {self.node_id} not found")
-        text = node.secret + self._portion()
-        logger.debug(f"secret: {node.secret}")
+        text = secret + self._portion()
+        logger.debug(f"secret: {secret}")
         logger.debug(f"_portion: {self._portion()}")
 
         digest = hashlib.sha512(text.encode("utf-8")).hexdigest()
-        return node is not None and \
-               self.key == digest
+        return self.key == digest
 
     @session_closing
     def add_unversioned_operations(self, session=None, include_extensions=True):
@@ -0,0 +1,364 @@
+"""
+.. module:: messages.store
+   :synopsis: Disk-backed storage for message payloads.
+
+A :class:`PayloadStore` can take the place of the dictionary of sets
+that holds the payload of a message (``BaseMessage.payload``). The
+objects are kept encoded in a temporary SQLite file, indexed by model
+and primary key and by the foreign key columns of each model, and are
+decoded on demand. Only *cache_size* decoded objects are kept in
+memory, so the memory used by a message no longer grows with the
+amount of objects it carries.
+
+Queries built with ``message.query(model).filter(...)`` run against
+the store: filters of the form ``attr(name) == value`` or
+``attr(name).in_(values)`` over the primary key (``__pk__``) or a
+foreign key column are answered through the indexes, and every other
+predicate is applied to the objects as they are streamed from the
+file.
+"""
+
+import collections
+import json
+import os
+import sqlite3
+import tempfile
+from collections.abc import Mapping
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+from dbsync.lang import *
+from dbsync.utils import get_pk, class_mapper
+from dbsync.core import MAX_SQL_VARIABLES, null_model, synched_models
+from dbsync.messages.base import ObjectType
+from dbsync.messages.codecs import SyncdbJSONEncoder, encode_dict, decode_dict
+
+
+#: Default amount of decoded objects kept in memory by a store.
+DEFAULT_CACHE_SIZE = 1000
+
+#: Amount of rows read or written at once.
+BATCH_SIZE = 500
+
+
+_schema = """
+CREATE TABLE IF NOT EXISTS payload_object (
+    model TEXT NOT NULL,
+    pk TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (model, pk));
+CREATE TABLE IF NOT EXISTS payload_reference (
+    model TEXT NOT NULL,
+    "column" TEXT NOT NULL,
+    value TEXT NOT NULL,
+    pk TEXT NOT NULL,
+    PRIMARY KEY (model, pk, "column"));
+CREATE INDEX IF NOT EXISTS payload_reference_value
+    ON payload_reference (model, "column", value);
+"""
+
+
+def _key(encoded_value: Any) -> str:
+    "Storage key for a JSON-friendly value."
+    return json.dumps(encoded_value, cls=SyncdbJSONEncoder, sort_keys=True)
+
+
+class _ModelCodec(object):
+    "Encoding of the objects of a tracked model, for storage."
+
+    def __init__(self, model):
+        self.model = model
+        self.pk = get_pk(model)
+        self.encode = encode_dict(model)
+        self.decode = decode_dict(model)
+        self.references = [fk.parent.name for fk in
+                           class_mapper(model).mapped_table.foreign_keys]
+
+    def key(self, column: str, value: Any) -> str:
+        "Storage key for the python *value* of *column*."
+        return _key(self.encode({column: value}).get(column, value))
+
+    def column(self, attribute: str) -> str:
+        return self.pk if attribute == '__pk__' else attribute
+
+
+class StoredObjects(object):
+    """
+    The objects of a single model kept in a :class:`PayloadStore`,
+    optionally filtered. Stands in for the sets of wrapped objects of
+    an in-memory payload.
+    """
+
+    def __init__(self, store: "PayloadStore", name: str, predicates=()):
+        self.store = store
+        self.name = name
+        self.predicates = tuple(predicates)
+
+    def filter(self, predicate) -> "StoredObjects":
+        "Returns a new view with *predicate* applied."
+        return StoredObjects(self.store, self.name,
+                             self.predicates + (predicate,))
+
+    def add(self, obj: ObjectType) -> None:
+        self.store.add(self.name, obj)
+
+    def __contains__(self, obj: ObjectType) -> bool:
+        stored = self.store.get_object(self.name, obj.__pk__)
+        return stored is not None and \
+            all(predicate(stored) for predicate in self.predicates)
+
+    def __iter__(self) -> Iterator[ObjectType]:
+        # the first indexed predicate is answered by the store, the
+        # rest are applied to the objects read
+        indexed = lookup(
+            lambda p: self.store.indexed(
+                self.name, getattr(p, 'comparison', None)),
+            self.predicates)
+        comparison = maybe(indexed, attr('comparison'), None)
+        predicates = [p for p in self.predicates if p is not indexed]
+        for obj in self.store.objects(self.name, comparison):
+            if all(predicate(obj) for predicate in predicates):
+                yield obj
+
+    def __len__(self) -> int:
+        if not self.predicates:
+            return self.store.count(self.name)
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "<StoredObjects {0} ({1} filters)>".format(
+            self.name, len(self.predicates))
+
+
+class PayloadStore(Mapping):
+    """
+    Payload of a message kept in a SQLite file, mapping model names to
+    :class:`StoredObjects`.
+
+    If *path* isn't given, a temporary file is created and removed
+    when the store is closed. *cache_size* is the maximum amount of
+    decoded objects kept in memory.
+
+    Use it as the *store* argument of a message, and close it (or use
+    it as a context manager) once the message isn't needed anymore::
+
+        with PayloadStore(cache_size=500) as store:
+            message = PullMessage(response, store=store)
+            ...
+    """
+
+    def __init__(self, path: Optional[str] = None,
+                 cache_size: int = DEFAULT_CACHE_SIZE):
+        assert cache_size >= 0, "cache size can't be negative"
+        self.cache_size = cache_size
+        self._cache: Dict[Tuple[str, str], ObjectType] = \
+            collections.OrderedDict()
+        self._codecs: Dict[str, Optional[_ModelCodec]] = {}
+        self._temporary = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="dbsync-payload-", suffix=".db")
+            os.close(fd)
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("PRAGMA journal_mode = OFF")
+        self._connection.execute("PRAGMA synchronous = OFF")
+        self._connection.executescript(_schema)
+
+    def close(self) -> None:
+        "Closes the store, removing its file if it's a temporary one."
+        if self._connection is None:
+            return
+        self._connection.close()
+        self._connection = None
+        self._cache.clear()
+        if self._temporary and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def codec(self, name: str) -> Optional[_ModelCodec]:
+        "Returns the codec for the model *name*, or ``None``."
+        if name not in self._codecs:
+            model = synched_models.model_names.get(name, null_model).model
+            self._codecs[name] = _ModelCodec(model) \
+                if model is not None else None
+        return self._codecs[name]
+
+    def indexed(self, name: str, comparison) -> bool:
+        """
+        Whether the *comparison* (as kept by ``dbsync.lang.Function``)
+        can be answered through the indexes of the store.
+        """
+        codec = self.codec(name)
+        if codec is None or comparison is None:
+            return False
+        operator, attribute, value = comparison
+        if operator == 'in' and \
+                not isinstance(value, (list, tuple, set, frozenset)):
+            return False
+        column = codec.column(attribute)
+        return column == codec.pk or column in codec.references
+
+    # writing
+
+    def add_encoded(self, name: str, dicts: Iterable[Dict[str, Any]]) -> None:
+        """
+        Adds objects given as encoded dictionaries, as they come in a
+        raw message, to the store. Objects already in the store (by
+        primary key) are left untouched.
+        """
+        codec = self.codec(name)
+        if codec is None:
+            return
+        for batch in grouper(dicts, BATCH_SIZE):
+            objects = [(name, _key(d[codec.pk]),
+                        json.dumps(d, cls=SyncdbJSONEncoder))
+                       for d in batch]
+            references = [(name, column, _key(d[column]), pk)
+                          for d, (_, pk, _) in zip(batch, objects)
+                          for column in codec.references
+                          if d.get(column) is not None]
+            with self._connection:
+                self._connection.executemany(
+                    "INSERT OR IGNORE INTO payload_object (model, pk, data) "
+                    "VALUES (?, ?, ?)", objects)
+                self._connection.executemany(
+                    "INSERT OR IGNORE INTO payload_reference "
+                    "(model, \"column\", value, pk) VALUES (?, ?, ?, ?)",
+                    references)
+
+    def add(self, name: str, obj: ObjectType) -> None:
+        "Adds a wrapped object to the store."
+        codec = self.codec(name)
+        if codec is None:
+            return
+        self.add_encoded(name, [codec.encode(obj.to_dict())])
+
+    def discard(self, name: str) -> None:
+        "Removes all the objects of model *name*."
+        with self._connection:
+            self._connection.execute(
+                "DELETE FROM payload_object WHERE model = ?", (name,))
+            self._connection.execute(
+                "DELETE FROM payload_reference WHERE model = ?", (name,))
+        for key in [k for k in self._cache if k[0] == name]:
+            del self._cache[key]
+
+    # reading
+
+    def _decode(self, name: str, data: str) -> ObjectType:
+        codec = self.codec(name)
+        dict_ = codec.decode(json.loads(data))
+        return ObjectType(name, dict_[codec.pk], **dict_)
+
+    def get_object(self, name: str, pk: Any) -> Optional[ObjectType]:
+        """
+        Returns the object of model *name* with primary key *pk*, or
+        ``None``. Decoded objects are kept in a least-recently-used
+        cache of *cache_size* entries.
+        """
+        codec = self.codec(name)
+        if codec is None:
+            return None
+        key = (name, codec.key(codec.pk, pk))
+        obj = self._cache.get(key, None)
+        if obj is not None:
+            self._cache.move_to_end(key)
+            return obj
+        row = self._connection.execute(
+            "SELECT data FROM payload_object WHERE model = ? AND pk = ?",
+            key).fetchone()
+        if row is None:
+            return None
+        obj = self._decode(name, row[0])
+        if self.cache_size:
+            self._cache[key] = obj
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return obj
+
+    def objects(self, name: str, comparison=None) -> Iterator[ObjectType]:
+        """
+        Yields the objects of model *name*, narrowed by *comparison*
+        if it's indexed (see :meth:`indexed`). Objects are read in
+        batches, so only a batch is in memory at any time.
+        """
+        codec = self.codec(name)
+        if codec is None:
+            return
+        if not self.indexed(name, comparison):
+            yield from self._select(name, "", ())
+            return
+        operator, attribute, value = comparison
+        column = codec.column(attribute)
+        values = [value] if operator == '==' else list(value)
+        if column == codec.pk:
+            if len(values) == 1:
+                obj = self.get_object(name, values[0])
+                if obj is not None:
+                    yield obj
+                return
+            condition = "AND pk IN ({0})"
+        else:
+            condition = "AND pk IN (SELECT pk FROM payload_reference " \
+                "WHERE model = ? AND \"column\" = ? AND value IN ({0}))"
+        seen = set()
+        for batch in grouper(values, MAX_SQL_VARIABLES - 2):
+            params = ([] if column == codec.pk else [name, column]) + \
+                [codec.key(column, v) for v in batch]
+            for obj in self._select(
+                    name, condition.format(", ".join("?" for _ in batch)),
+                    params):
+                if obj.__pk__ not in seen:
+                    seen.add(obj.__pk__)
+                    yield obj
+
+    def _select(self, name, condition, params) -> Iterator[ObjectType]:
+        cursor = self._connection.execute(
+            "SELECT data FROM payload_object WHERE model = ? {0} "
+            "ORDER BY rowid".format(condition),
+            [name] + list(params))
+        rows = cursor.fetchmany(BATCH_SIZE)
+        while rows:
+            for (data,) in rows:
+                yield self._decode(name, data)
+            rows = cursor.fetchmany(BATCH_SIZE)
+
+    def count(self, name: str) -> int:
+        return self._connection.execute(
+            "SELECT count(*) FROM payload_object WHERE model = ?",
+            (name,)).fetchone()[0]
+
+    # mapping interface
+
+    def __getitem__(self, name: str) -> StoredObjects:
+        if self.codec(name) is None:
+            raise KeyError(name)
+        return StoredObjects(self, name)
+
+    def __setitem__(self, name: str, objects: Iterable[ObjectType]) -> None:
+        if isinstance(objects, StoredObjects) and objects.store is self:
+            if objects.name == name and not objects.predicates:
+                return
+            objects = list(objects)
+        self.discard(name)
+        for obj in objects:
+            self.add(name, obj)
+
+    def __contains__(self, name) -> bool:
+        return self._connection.execute(
+            "SELECT 1 FROM payload_object WHERE model = ? LIMIT 1",
+            (name,)).fetchone() is not None
+
+    def __iter__(self) -> Iterator[str]:
+        return iter([name for (name,) in self._connection.execute(
+            "SELECT DISTINCT model FROM payload_object")])
+
+    def __len__(self) -> int:
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return "<PayloadStore {0}>".format(self.path)
@@ -20,8 +20,10 @@ try:
 except ImportError:
     from typing import _Protocol as Protocol
 
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, BigInteger, Table
-from sqlalchemy.orm import relationship, backref, validates, Session, Mapper, Query
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, BigInteger, Table, Text, Boolean, \
+    Index, DDL, MetaData, event
+from sqlalchemy.orm import relationship, backref, validates, Session, Mapper, Query, \
+    selectinload
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.declarative.api import DeclarativeMeta
 from websockets import WebSocketServerProtocol, WebSocketCommonProtocol
@@ -372,6 +374,11 @@ class Version(Base):
     """
 
     __tablename__ = "versions"
+    __table_args__ = (
+        # latest version of each node, used by trim
+        Index("ix_{0}versions_node".format(tablename_prefix),
+              "node_id", "version_id"),
+    )
 
     version_id = Column(Integer, primary_key=True)
     node_id = Column(Integer, ForeignKey(Node.__tablename__ + ".node_id"))
@@ -384,6 +391,25 @@ class Version(Base):
             format(self.version_id, self.created)
 
 
+class TrimMark(Base):
+    """
+    A trim of the server history.
+
+    Operations up to ``version_id`` were deleted, so nodes that didn't
+    pull up to it must repair instead.
+    """
+
+    __tablename__ = "trim_marks"
+
+    mark_id = Column(Integer, primary_key=True)
+    version_id = Column(Integer, nullable=False)
+    trimmed = Column(DateTime)
+
+    def __repr__(self):
+        return "<TrimMark version_id: {0}, trimmed: {1}>". \
+            format(self.version_id, self.trimmed)
+
+
 class OperationError(Exception): pass
 
 
@@ -394,46 +420,20 @@ class SkipOperation(Exception):
     """
 
 
-class Operation(Base):
+class OperationMixin(object):
     """
-    A database operation (insert, delete or update).
-
-    The operations are grouped in versions and ordered as they are
-    executed.
+    Behaviour shared by the persistent :class:`Operation` and the
+    lightweight :class:`OperationRecord`.
     """
 
-    __tablename__ = "operations"
-
-    # row_id = Column(Integer)
-    row_id = Column(GUID)
-    version_id = Column(
-        Integer,
-        ForeignKey(Version.__tablename__ + ".version_id"),
-        nullable=True)
-    content_type_id = Column(BigInteger)
-    tracked_model: DeclarativeMeta = None  # to be injected
-    command = Column(String(1))
-    order = Column(Integer, primary_key=True)
-    version = relationship(Version, backref=backref("operations", lazy="joined"))
-    whitelist = Column(JSONB)
-    """
-    is a binary JSON (Fallback to normal JSON for SQLite) field that holds
-    an array of user ids to be allowed to pull that object
-    dbsync does not fill or test this field, this has to be accomplished
-    by extensions
-    """
+    __slots__ = ()
 
     command_options = ('i', 'u', 'd')
-    _target: SQLClass
-    """temp reference to the operation target for after_tracking_fn"""
+    tracked_model: DeclarativeMeta = None  # to be injected
 
-    @validates('command')
-    def validate_command(self, key, command):
-        assert command in self.command_options
-        return command
-
-    def __repr__(self):
-        return f"<Operation row_id: {self.row_id}, model: {self.tracked_model}, command: {self.command}, version:{self.version}>"
+    def to_dict(self) -> Dict[str, Any]:
+        "Returns a dictionary with the operation fields."
+        return dict((k, getattr(self, k)) for k in OperationRecord.__slots__)
 
     def references(self, obj):
         "Whether this operation references the given object or not."
@@ -613,3 +613,162 @@ class Operation(Base):
                 operation)
 
         return res
+
+
+class Operation(Base, OperationMixin):
+    """
+    A database operation (insert, delete or update).
+
+    The operations are grouped in versions and ordered as they are
+    executed.
+    """
+
+    __tablename__ = "operations"
+    __table_args__ = (
+        # operations after a version (fill_for) or up to one (trim)
+        Index("ix_{0}operations_version".format(tablename_prefix),
+              "version_id", "order"),
+        # history of a row (is_synched, compress, conflicts)
+        Index("ix_{0}operations_row".format(tablename_prefix),
+              "content_type_id", "row_id", "order"),
+    )
+
+    # row_id = Column(Integer)
+    row_id = Column(GUID)
+    version_id = Column(
+        Integer,
+        ForeignKey(Version.__tablename__ + ".version_id"),
+        nullable=True)
+    content_type_id = Column(BigInteger)
+    command = Column(String(1))
+    order = Column(Integer, primary_key=True)
+    # loaded on access; queries that need the operations of many
+    # versions should ask for them, see with_operations
+    version = relationship(Version, backref=backref("operations", lazy="select"))
+    whitelist = Column(JSONB)
+    """
+    is a binary JSON (Fallback to normal JSON for SQLite) field that holds
+    an array of user ids to be allowed to pull that object
+    dbsync does not fill or test this field, this has to be accomplished
+    by extensions
+    """
+
+    _target: SQLClass
+    """temp reference to the operation target for after_tracking_fn"""
+
+    @validates('command')
+    def validate_command(self, key, command):
+        assert command in self.command_options
+        return command
+
+    def __repr__(self):
+        return f"<Operation row_id: {self.row_id}, model: {self.tracked_model}, command: {self.command}, version:{self.version_id}>"
+
+
+def with_operations(loader=selectinload):
+    """
+    Returns a loader option that fetches the operations of the
+    versions of a query along with them, instead of on access, e.g.
+    ``session.query(Version).options(with_operations())``. *loader*
+    is the loading strategy (``selectinload``, ``joinedload`` or
+    ``subqueryload``).
+    """
+    return loader(Version.operations)
+
+
+#: Name of the partial index over the unversioned operations.
+UNVERSIONED_INDEX = "ix_{0}operations_unversioned".format(tablename_prefix)
+
+#: Creates the partial index over the unversioned operations (the
+#  local log) in the databases that support partial indexes.
+unversioned_index_ddl = DDL(
+    'CREATE INDEX IF NOT EXISTS {0} ON %(table)s ("order") '
+    'WHERE version_id IS NULL'.format(UNVERSIONED_INDEX)).\
+    execute_if(dialect=('sqlite', 'postgresql'))
+
+event.listen(Operation.__table__, 'after_create', unversioned_index_ddl)
+
+#: Metadata of the server's operation archive, kept apart from
+#  ``Base.metadata`` so that ``create_all`` doesn't create it (see
+#  ``dbsync.server.archive``).
+archive_metadata = MetaData()
+
+#: Old server operations moved out of the operations table, keeping
+#  their order. Partitioned by version range in PostgreSQL.
+operations_archive = Table(
+    tablename_prefix + "operations_archive", archive_metadata,
+    Column("version_id", Integer, primary_key=True, autoincrement=False),
+    Column("order", Integer, primary_key=True, autoincrement=False),
+    Column("row_id", GUID),
+    Column("content_type_id", BigInteger),
+    Column("command", String(1)),
+    Column("whitelist", JSONB),
+    postgresql_partition_by="RANGE (version_id)")
+
+#: Whether pulls read the archive, set by ``dbsync.server.archive``.
+archive_enabled = False
+
+
+class OperationRecord(OperationMixin):
+    """
+    A lightweight operation, not bound to the ORM.
+
+    Operations transported in messages, compressed in memory and
+    compared during conflict detection are instances of this class.
+    It must be converted with ``to_operation`` before being written
+    to the operations log.
+    """
+
+    __slots__ = ('row_id', 'version_id', 'content_type_id', 'command',
+                 'order', 'whitelist')
+
+    def __init__(self, row_id=None, version_id=None, content_type_id=None,
+                 command=None, order=None, whitelist=None):
+        assert command is None or command in self.command_options
+        self.row_id = row_id
+        self.version_id = version_id
+        self.content_type_id = content_type_id
+        self.command = command
+        self.order = order
+        self.whitelist = whitelist
+
+    @classmethod
+    def from_dict(cls, dict_: Dict[str, Any]) -> "OperationRecord":
+        "Builds a record from a dictionary of operation fields."
+        return cls(**dict((k, v) for k, v in dict_.items()
+                          if k in cls.__slots__))
+
+    @classmethod
+    def from_operation(cls, op: OperationMixin) -> "OperationRecord":
+        "Builds a record from a mapped operation (or another record)."
+        return cls(**op.to_dict())
+
+    def to_operation(self) -> "Operation":
+        "Returns a mapped operation, ready to be added to a session."
+        return Operation(**self.to_dict())
+
+    def __repr__(self):
+        return f"<Operation row_id: {self.row_id}, model: {self.tracked_model}, command: {self.command}, version:{self.version_id}>"
+
+
+class RepairCursor(Base):
+    """
+    Progress of a streamed repair, for a single model.
+
+    The client keeps one cursor per synchronized model while a repair
+    is in course, so that an interrupted repair can continue from the
+    last chunk that was loaded.
+    """
+
+    __tablename__ = "repair_cursors"
+
+    model_name = Column(String(500), primary_key=True)
+    #: encoded primary key of the last row loaded, ``None`` if none yet
+    last_pk = Column(Text, nullable=True)
+    #: latest version on the server when the model was streamed
+    latest_version_id = Column(Integer, nullable=True)
+    finished = Column(Boolean, nullable=False, default=False)
+
+    def __repr__(self):
+        return "<RepairCursor model: {0}, last_pk: {1}, finished: {2}>". \
+            format(self.model_name, self.last_pk, self.finished)
@@ -0,0 +1,140 @@
+"""
+Archive of old server operations.
+
+The operations table is read by every push and pull, but nodes that
+sync regularly only need its latest versions. :func:`archive_operations`
+moves the operations older than a hot window of ``HOT_WINDOW``
+versions to ``models.operations_archive``, in batches, keeping the
+operations table small. In PostgreSQL the archive is partitioned by
+version range, with a partition of ``ARCHIVE_PARTITION_SIZE`` versions
+created as needed.
+
+Once :func:`enable_archive` is called (at every start of the server),
+``PullMessage.fill_for`` reads the archive as well for nodes whose
+version is older than the archived operations, and ``trim`` moves
+operations to the archive instead of deleting them.
+"""
+
+from typing import Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.engine import Engine
+
+from dbsync import core, models
+from dbsync.models import Operation, operations_archive, archive_metadata
+from dbsync.logs import get_logger
+
+
+logger = get_logger(__name__)
+
+#: Versions whose operations stay in the operations table.
+HOT_WINDOW = 10000
+
+#: Operations moved by each statement. Their keys are bound in two
+#  ``IN`` lists, so it's at most ``core.MAX_SQL_VARIABLES``.
+ARCHIVE_BATCH_SIZE = core.MAX_SQL_VARIABLES
+
+#: Versions in each partition of the archive, in PostgreSQL.
+ARCHIVE_PARTITION_SIZE = 100000
+
+#: Columns copied to the archive.
+COLUMNS = [c.name for c in operations_archive.columns]
+
+
+def enable_archive(engine: Optional[Engine] = None) -> None:
+    "Creates the archive if needed and makes pulls read it."
+    engine = engine or core.get_engine()
+    archive_metadata.create_all(engine)
+    if engine.dialect.name == 'postgresql':
+        quote = engine.dialect.identifier_preparer.quote
+        engine.execute("CREATE TABLE IF NOT EXISTS {0} PARTITION OF {1} DEFAULT".\
+                       format(quote(operations_archive.name + "_default"),
+                              quote(operations_archive.name)))
+    models.archive_enabled = True
+
+
+def _ensure_partitions(session, low: int, high: int) -> None:
+    "Creates the partitions holding the versions from *low* to *high*."
+    bind = session.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return
+    quote = bind.dialect.identifier_preparer.quote
+    start = (low // ARCHIVE_PARTITION_SIZE) * ARCHIVE_PARTITION_SIZE
+    while start <= high:
+        end = start + ARCHIVE_PARTITION_SIZE
+        session.execute(
+            "CREATE TABLE IF NOT EXISTS {0} PARTITION OF {1} "
+            "FOR VALUES FROM ({2}) TO ({3})".format(
+                quote("{0}_{1}".format(operations_archive.name, start)),
+                quote(operations_archive.name), start, end))
+        start = end
+
+
+def _move_batch(session, criterion, batch_size: int) -> int:
+    operations = Operation.__table__
+    rows = session.execute(
+        select([operations.c.order, operations.c.version_id]).
+        where(criterion).order_by(operations.c.order).limit(batch_size)).\
+        fetchall()
+    if not rows:
+        return 0
+    orders = [order for order, _ in rows]
+    versions = [version_id for _, version_id in rows]
+    _ensure_partitions(session, min(versions), max(versions))
+    session.execute(operations_archive.insert().from_select(
+        COLUMNS,
+        select([operations.c[name] for name in COLUMNS]).
+        where(operations.c.order.in_(orders))))
+    session.execute(operations.delete().where(operations.c.order.in_(orders)))
+    return len(orders)
+
+
+def move_operations(session, criterion, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """
+    Moves the operations matching *criterion* to the archive, in
+    batches (of at most ``core.MAX_SQL_VARIABLES``). Without a
+    *session*, each batch is committed on its own. Returns the amount
+    of operations moved.
+    """
+    batch_size = min(batch_size, core.MAX_SQL_VARIABLES)
+    moved = 0
+    while True:
+        if session is None:
+            with core.committing_context() as batch_session:
+                count = _move_batch(batch_session, criterion, batch_size)
+        else:
+            count = _move_batch(session, criterion, batch_size)
+        moved += count
+        if count < batch_size:
+            return moved
+
+
+def archive_operations(hot_window: int = HOT_WINDOW,
+                       batch_size: int = ARCHIVE_BATCH_SIZE,
+                       session=None) -> int:
+    """
+    Moves the operations of the versions before the last *hot_window*
+    ones to the archive. Returns the amount of operations moved.
+    """
+    latest = core.get_latest_version_id(session=session)
+    if latest is None or latest <= hot_window:
+        return 0
+    moved = move_operations(
+        session, Operation.__table__.c.version_id <= latest - hot_window,
+        batch_size)
+    logger.info("archived %s operations up to version %s",
+                moved, latest - hot_window)
+    return moved
+
+
+@core.session_closing
+def archived_range(session=None):
+    """
+    Returns the lowest and highest versions with archived operations,
+    or ``(None, None)`` if the archive is empty or disabled.
+    """
+    if not models.archive_enabled:
+        return None, None
+    return tuple(session.execute(
+        select([func.min(operations_archive.c.version_id),
+                func.max(operations_archive.c.version_id)])).fetchone())
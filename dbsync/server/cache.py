@@ -0,0 +1,103 @@
+"""
+.. module:: server.cache
+   :synopsis: In-process cache of hot server metadata.
+
+Each push checks the latest version identifier before doing any work.
+The :data:`cache` keeps a lower bound of it in memory, raised after
+each commit that created versions. Versions only grow, so a push
+based on an older version can be rejected without a query; pushes
+that pass this check are still verified against the database inside
+their transaction (see ``handlers.preceding_version_id``). Deleting
+versions through the ORM drops the bound; if the latest version is
+removed by other means (e.g. raw SQL), call ``cache.clear()``.
+
+Node secrets aren't cached, since other processes may change or
+delete nodes; they're read with a single column query. The content
+type maps need no caching, since they live in
+``core.synched_models``.
+"""
+
+import threading
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm.session import Session as GlobalSession
+
+from dbsync.models import Version
+from dbsync.logs import get_logger
+
+
+logger = get_logger(__name__)
+
+#: Session info key of the versions created in the transaction.
+NEW_VERSIONS_KEY = "dbsync_new_versions"
+
+
+class MetadataCache(object):
+    "Hot metadata shared by the requests handled by this process."
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latest_version_id: Optional[int] = None
+
+    @property
+    def latest_version_id(self) -> Optional[int]:
+        "A lower bound of the latest version identifier, if known."
+        return self._latest_version_id
+
+    def note_version(self, version_id: Optional[int]) -> None:
+        "Registers a committed version identifier."
+        if version_id is None:
+            return
+        with self._lock:
+            if self._latest_version_id is None or \
+                    version_id > self._latest_version_id:
+                self._latest_version_id = version_id
+
+    def forget_versions(self) -> None:
+        with self._lock:
+            self._latest_version_id = None
+
+    def clear(self) -> None:
+        "Drops every cached value."
+        with self._lock:
+            self._latest_version_id = None
+
+
+#: The metadata cache of this process.
+cache = MetadataCache()
+
+
+def _after_flush(session, flush_context):
+    new_versions = session.info.get(NEW_VERSIONS_KEY, []) + \
+        [obj.version_id for obj in session.new if isinstance(obj, Version)]
+    deleted = set(obj.version_id for obj in session.deleted
+                  if isinstance(obj, Version))
+    if deleted.difference(new_versions):
+        cache.forget_versions()
+    # versions created and deleted in this transaction were never noted
+    new_versions = [v for v in new_versions if v not in deleted]
+    if new_versions:
+        session.info[NEW_VERSIONS_KEY] = new_versions
+    else:
+        session.info.pop(NEW_VERSIONS_KEY, None)
+
+
+def _after_commit(session):
+    for version_id in session.info.pop(NEW_VERSIONS_KEY, []):
+        cache.note_version(version_id)
+
+
+def _after_soft_rollback(session, previous_transaction):
+    session.info.pop(NEW_VERSIONS_KEY, None)
+
+
+def _after_bulk_delete(delete_context):
+    if delete_context.mapper.class_ is Version:
+        cache.forget_versions()
+
+
+event.listen(GlobalSession, 'after_flush', _after_flush)
+event.listen(GlobalSession, 'after_commit', _after_commit)
+event.listen(GlobalSession, 'after_soft_rollback', _after_soft_rollback)
+event.listen(GlobalSession, 'after_bulk_delete', _after_bulk_delete)
@@ -3,11 +3,9 @@
    :synopsis: Conflict detection for the centralized push operation.
 """
 
-from sqlalchemy.schema import UniqueConstraint
-from sqlalchemy.sql import Join
-
 from dbsync.lang import *
-from dbsync.utils import get_pk, class_mapper, query_model, column_properties
+from dbsync.utils import unique_matches
+from dbsync.core import synched_models, MAX_SQL_VARIABLES
 
 
 def find_unique_conflicts(push_message, session):
@@ -21,37 +19,46 @@ def find_unique_conflicts(push_message, session):
         columns: tuple of column names in the unique constraint
         new_values: tuple of values that can be used to update the
                     conflicting object.
-    """
-    conflicts = []
-
-    for pk, model in ((op.row_id, op.tracked_model)
-                      for op in push_message.operations
-                      if op.command != 'd'):
-        if model is None: continue
 
-        mt = class_mapper(model).mapped_table
-        if isinstance(mt, Join):
-            constraints = mt.left.constraints.union(mt.right.constraints)
-        else:
-            constraints = mt.constraints
+    The pushed objects are read from the message by primary key, and
+    the database is queried once per model and unique constraint, for
+    each batch of pushed objects.
+    """
+    pushed = {}
+    for op in push_message.operations:
+        if op.command == 'd' or op.tracked_model is None: continue
+        pushed.setdefault(op.tracked_model, []).append(op.row_id)
 
-        for constraint in [c for c in constraints if isinstance(c, UniqueConstraint)]:
+    conflicts = []
+    for model, model_pks in pushed.items():
+        meta = synched_models.metadata[model]
+        if not meta.unique: continue
+        for pks in grouper(model_pks, MAX_SQL_VARIABLES):
+            conflicts.extend(_batch_unique_conflicts(
+                model, pks, push_message, session))
+    return conflicts
 
-            unique_columns = tuple(col.name for col in constraint.columns)
-            remote_obj = push_message.query(model).\
-                filter(attr('__pk__') == pk).first()
-            remote_values = tuple(getattr(remote_obj, col, None)
-                                  for col in unique_columns)
 
-            if all(value is None for value in remote_values): continue
-            local_obj = query_model(session, model).\
-                filter_by(**dict(list(zip(unique_columns, remote_values)))).first()
+def _batch_unique_conflicts(model, pks, push_message, session):
+    "Returns the unique conflicts of the pushed objects with keys *pks*."
+    meta = synched_models.metadata[model]
+    push_objects = push_message.get_objects(model, pks)
+    conflicts = []
+    for unique_columns in meta.unique:
+        remote_values = dict(
+            (pk, tuple(getattr(push_objects.get(pk, None), col, None)
+                       for col in unique_columns))
+            for pk in pks)
+        local_objects = unique_matches(
+            model, unique_columns, set(remote_values.values()), session)
+        for pk in pks:
+            local_obj = local_objects.get(remote_values[pk], None)
             if local_obj is None: continue
-            local_pk = getattr(local_obj, get_pk(model))
+            local_pk = getattr(local_obj, meta.pk)
             if local_pk == pk: continue
 
-            push_obj = push_message.query(model).\
-                filter(attr('__pk__') == local_pk).first()
+            push_obj = push_objects.get(local_pk, None) or \
+                push_message.get_objects(model, [local_pk]).get(local_pk, None)
             if push_obj is None: continue # push will fail
 
             conflicts.append(
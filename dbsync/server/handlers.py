@@ -15,14 +15,15 @@ tasked to send the HTTP response).
 """
 
 import datetime
-from typing import Optional, Dict, Any
+import threading
+from typing import Optional, Dict, Any, Tuple
 
+from sqlalchemy import func
 from sqlalchemy.orm import make_transient, Session
 
 from dbsync.lang import *
 from dbsync.utils import (
     generate_secret,
-    properties_dict,
     column_properties,
     get_pk,
     query_model,
@@ -37,7 +38,11 @@ from dbsync.messages.base import BaseMessage
 from dbsync.messages.register import RegisterMessage
 from dbsync.messages.pull import PullMessage, PullRequestMessage
 from dbsync.messages.push import PushMessage
+from dbsync.messages.codecs import encode, types_dict
+from dbsync.merkle import MerkleTree
 from dbsync.server.conflicts import find_unique_conflicts
+from dbsync.server.cache import cache
+from dbsync.server.trim import repair_required
 from dbsync.logs import get_logger
 
 
@@ -78,6 +83,118 @@ def handle_repair(data=None, session=None):
     return response
 
 
+#: Default amount of rows sent in each chunk of a streamed repair.
+REPAIR_CHUNK_SIZE = 1000
+
+
+def repair_chunks(model, after=None, chunk_size=REPAIR_CHUNK_SIZE,
+                  include_extensions=True, session=None):
+    """
+    Yields the rows of *model* in chunks of at most *chunk_size*,
+    ordered by primary key and starting after the primary key *after*
+    (a decoded value, or ``None`` to start from the beginning).
+
+    Each chunk is a pair (list of encoded objects, encoded primary
+    key of the last object), ready to be sent to the node.
+    """
+    pk_name = get_pk(model)
+    pk = getattr(model, pk_name)
+    pk_type = types_dict(model)[pk_name]
+    while True:
+        query = query_model(session, model).order_by(pk)
+        if after is not None:
+            query = query.filter(pk > after)
+        objects = query.limit(chunk_size).all()
+        if not objects:
+            return
+        message = BaseMessage()
+        for obj in objects:
+            message.add_object(obj, include_extensions=include_extensions)
+        after = getattr(objects[-1], pk_name)
+        yield (message.to_json()['payload'].get(model.__name__, []),
+               encode(pk_type)(after))
+        session.expunge_all()
+
+
+#: Hash trees of the synchronized models, by model name, along with
+#  the latest version identifier they reflect.
+_merkle_trees: Dict[str, Tuple[int, MerkleTree]] = {}
+_merkle_lock = threading.Lock()
+
+
+def merkle_tree(model, session) -> Tuple[MerkleTree, Optional[int]]:
+    """
+    Returns the hash tree of *model* and the latest version
+    identifier. Trees are kept until a new version is created, so
+    writes that don't create versions (e.g. done while listening is
+    disabled) aren't reflected until then.
+    """
+    name = model.__name__
+    latest_version_id = core.get_latest_version_id(session=session)
+    with _merkle_lock:
+        cached = _merkle_trees.get(name, None)
+    if latest_version_id is not None and cached is not None and \
+            cached[0] == latest_version_id:
+        return cached[1], latest_version_id
+    # read after the version, so the tree is at least as recent
+    tree = MerkleTree.for_model(model, session.connection())
+    if latest_version_id is not None:
+        with _merkle_lock:
+            _merkle_trees[name] = (latest_version_id, tree)
+    return tree, latest_version_id
+
+
+def handle_merkle_request(request, trees, session=None):
+    """
+    Answers a step of a differential repair (see ``dbsync.merkle``).
+
+    *request* is a dictionary with a *type* and a *model* name:
+
+    - ``tree`` answers the depth, row count and root digest of the
+      tree of the model (see :func:`merkle_tree`), plus the latest
+      version identifier.
+    - ``children`` answers the digests of the children of the given
+      *prefixes*.
+    - ``rows`` answers the encoded objects in the given leaf
+      *buckets*, found with the keys kept in the tree.
+
+    *trees* is a dictionary kept by the caller for the duration of
+    the exchange, holding the trees used.
+    """
+    model = core.synched_models.model_names.\
+        get(request.get('model', None), core.null_model).model
+    if model is None:
+        return None
+    name = model.__name__
+    kind = request['type']
+    if kind == 'tree':
+        tree, latest_version_id = merkle_tree(model, session)
+        trees[name] = tree
+        return dict(type="tree", model=name, depth=tree.depth,
+                    count=tree.count, root=format(tree.root, 'x'),
+                    latest_version_id=latest_version_id)
+    tree = trees.get(name, None)
+    if tree is None:
+        return None
+    if kind == 'children':
+        return dict(type="children", model=name,
+                    digests=dict((prefix, format(digest, 'x'))
+                                 for prefix, digest in
+                                 tree.children(request['prefixes']).items()))
+    if kind == 'rows':
+        pks = tree.bucket_pks(model, request['buckets'])
+        message = BaseMessage()
+        for batch in grouper(pks, core.MAX_SQL_VARIABLES):
+            for obj in query_model(session, model).\
+                    filter(getattr(model, get_pk(model)).in_(batch)):
+                message.add_object(
+                    obj,
+                    include_extensions=request.get('include_extensions', True))
+        return dict(type="rows", model=name,
+                    objects=message.to_json()['payload'].get(name, []))
+    return None
+
+
 @core.with_transaction()
 def handle_register(user_id=None, node_id=None, session=None):
     """
@@ -122,6 +239,10 @@ def handle_pull(data, swell=False, include_extensions=True):
         request_message = PullRequestMessage(data)
     except KeyError:
         raise PullRejected("request object isn't a valid PullRequestMessage", data)
+    if repair_required(request_message.latest_version_id):
+        raise PullRejected("the operations after version {0} were trimmed, "
+                           "a repair is required".\
+                           format(request_message.latest_version_id))
 
     message = PullMessage()
     message.fill_for(
@@ -142,6 +263,35 @@ before_push = EventRegister()
 after_push = EventRegister()
 
 
+def preceding_version_id(version: Version, given: Optional[int],
+                         session: Session) -> Optional[int]:
+    """
+    Returns the latest version identifier before the flushed *version*
+    created by a push based on *given*. Version identifiers increase,
+    so if *version* is the one right after *given*, that's *given* and
+    the database isn't queried.
+    """
+    if version.version_id == (given or 0) + 1:
+        return given
+    return session.query(func.max(Version.version_id)).\
+        filter(Version.version_id < version.version_id).scalar()
+
+
+def _check_version(latest_version_id: Optional[int],
+                   given: Optional[int]) -> None:
+    if latest_version_id == given:
+        return
+    exc = "version identifier isn't the latest one; "\
+        "given: %s" % given
+    if latest_version_id is None:
+        raise PushRejected(exc)
+    if given is None:
+        raise PullSuggested(exc)
+    if given < latest_version_id:
+        raise PullSuggested(exc)
+    raise PushRejected(exc)
+
+
 @core.with_transaction()
 def handle_push(data: Dict[str, Any], session: Optional[Session] = None) -> Dict[str, int]:
     """
@@ -153,29 +303,37 @@ def handle_push(data: Dict[str, Any], session: Optional[Session] = None) -> Dict
 
     *data* must be a dictionary-like object, usually the product of
     parsing a JSON string.
+
+    Pushes based on a version older than the one known to this process
+    are rejected right away. Otherwise the version is verified with
+    the new version, once flushed (see :func:`preceding_version_id`).
     """
     message: PushMessage
     try:
         message = PushMessage(data)
     except KeyError:
         raise PushRejected("request object isn't a valid PushMessage", data)
-    latest_version_id = core.get_latest_version_id(session=session)
-    if latest_version_id != message.latest_version_id:
-        exc = "version identifier isn't the latest one; "\
-            "given: %s" % message.latest_version_id
-        if latest_version_id is None:
-            raise PushRejected(exc)
-        if message.latest_version_id is None:
-            raise PullSuggested(exc)
-        if message.latest_version_id < latest_version_id:
-            raise PullSuggested(exc)
-        raise PushRejected(exc)
+    known_version_id = cache.latest_version_id
+    if known_version_id is not None and \
+            (message.latest_version_id or 0) < known_version_id:
+        raise PullSuggested("version identifier isn't the latest one; "
+                            "given: %s" % message.latest_version_id)
     if not message.operations:
+        _check_version(core.get_latest_version_id(session=session),
+                       message.latest_version_id)
         return {}
         # raise PushRejected("message doesn't contain operations")
     if not message.islegit(session):
         raise PushRejected("message isn't properly signed")
 
+    # the new version, which tells whether other pushes came first
+    version = Version(created=datetime.datetime.now(), node_id=message.node_id)
+    session.add(version)
+    session.flush()
+    _check_version(
+        preceding_version_id(version, message.latest_version_id, session),
+        message.latest_version_id)
+
     for listener in before_push:
         listener(session, message)
 
@@ -210,15 +368,10 @@ def handle_push(data: Dict[str, Any], session: Optional[Session] = None) -> Dict
         raise PushRejected("at least one operation couldn't be performed",
                            *e.args)
 
-    # III) insert a new version
-    version = Version(created=datetime.datetime.now(), node_id=message.node_id)
-    session.add(version)
-
-    # IV) insert the operations, discarding the 'order' column
+    # III) insert the operations, discarding the 'order' column
     for op in sorted(operations, key=attr('order')):
-        new_op = Operation()
-        for k in [k for k in properties_dict(op) if k != 'order']:
-            setattr(new_op, k, getattr(op, k))
+        new_op = op.to_operation()
+        new_op.order = None
         session.add(new_op)
         new_op.version = version
         session.flush()
@@ -0,0 +1,225 @@
+"""
+.. module:: server.snapshot
+   :synopsis: Prebuilt SQLite snapshots of the synchronized tables.
+
+A snapshot is a SQLite file holding the rows of every synchronized
+table plus the version they correspond to. New nodes download it
+(gzip compressed) and load it with
+``dbsync.client.snapshot.load_snapshot``, instead of fetching the
+whole database through a repair.
+
+The snapshot is built once with :func:`build_snapshot` (or, from a
+coroutine, :func:`ensure_snapshot`) and kept up to
+date with :func:`refresh_snapshot`, which only applies the changes
+registered in the operations log since the snapshot's version. The
+programmer is tasked to call :func:`refresh_snapshot` periodically
+(e.g. after each push or from a scheduled job).
+"""
+
+import asyncio
+import gzip
+import os
+import shutil
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import Column, MetaData, Table, create_engine, func, select
+from sqlalchemy.engine import Connection, Engine
+
+from dbsync.lang import *
+from dbsync import core
+from dbsync.models import Operation, Version
+from dbsync.logs import get_logger
+
+
+logger = get_logger(__name__)
+
+#: Amount of rows copied at once.
+SNAPSHOT_BATCH_SIZE = 1000
+
+#: Suffix of the compressed snapshot served to the nodes.
+COMPRESSED_SUFFIX = ".gz"
+
+#: Builds in progress in this process, by path.
+_builds: Dict[str, "asyncio.Future"] = {}
+
+
+def _snapshot_tables(metadata: MetaData) -> Dict[int, Tuple[Table, Table]]:
+    """
+    Returns a dictionary of (content type id, (server table, snapshot
+    table)). The snapshot tables are copies of the synchronized tables
+    with their columns only, since constraints are enforced by the
+    node's own schema.
+    """
+    tables = {}
+    for model, record in core.synched_models.models.items():
+        table = model.__table__
+        tables[record.id] = (table, Table(
+            table.name, metadata,
+            *[Column(c.name, c.type, key=c.name, primary_key=c.primary_key)
+              for c in table.columns]))
+    return tables
+
+
+def _versions_table(metadata: MetaData) -> Table:
+    table = Version.__table__
+    return Table(table.name, metadata,
+                 *[Column(c.name, c.type, key=c.name, primary_key=c.primary_key)
+                   for c in table.columns])
+
+
+def _snapshot_engine(path: str) -> Engine:
+    return create_engine("sqlite:///{0}".format(path))
+
+
+def _copy_rows(source: Connection, target: Connection,
+               table: Table, copy: Table, whereclause=None) -> int:
+    "Copies the rows of *table* into *copy*, in batches."
+    query = select([table])
+    if whereclause is not None:
+        query = query.where(whereclause)
+    result = source.execution_options(stream_results=True).execute(query)
+    names = [c.name for c in table.columns]
+    count = 0
+    while True:
+        rows = result.fetchmany(SNAPSHOT_BATCH_SIZE)
+        if not rows:
+            break
+        target.execute(copy.insert(), [dict(zip(names, row)) for row in rows])
+        count += len(rows)
+    return count
+
+
+def _set_version(source: Connection, target: Connection,
+                 versions: Table, version_id: Optional[int]) -> None:
+    target.execute(versions.delete())
+    if version_id is not None:
+        _copy_rows(source, target, Version.__table__, versions,
+                   Version.__table__.c.version_id == version_id)
+
+
+def _compress(path: str) -> None:
+    "Writes the compressed copy of the snapshot served to the nodes."
+    compressed = path + COMPRESSED_SUFFIX
+    building = "{0}.{1}.tmp".format(compressed, os.getpid())
+    with open(path, 'rb') as src, gzip.open(building, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.replace(building, compressed)
+
+
+def snapshot_version(path: str) -> Optional[int]:
+    "Returns the version identifier of the snapshot at *path*."
+    engine = _snapshot_engine(path)
+    try:
+        return engine.execute(
+            "SELECT max(version_id) FROM {0}".format(
+                Version.__table__.name)).scalar()
+    finally:
+        engine.dispose()
+
+
+def build_snapshot(path: str) -> Optional[int]:
+    """
+    Builds a snapshot of the synchronized tables at *path*, replacing
+    any previous one, and its compressed copy. Returns the version
+    identifier of the snapshot.
+
+    Rows are streamed from the server database, so this works the
+    same for any server backend.
+    """
+    # private to the process, should others build the same snapshot
+    building = "{0}.{1}.tmp".format(path, os.getpid())
+    if os.path.exists(building):
+        os.remove(building)
+    metadata = MetaData()
+    tables = _snapshot_tables(metadata)
+    versions = _versions_table(metadata)
+    engine = _snapshot_engine(building)
+    try:
+        metadata.create_all(engine)
+        with core.get_engine().connect() as source, \
+                engine.begin() as target:
+            # a single transaction, so that data and version match
+            with source.begin():
+                version_id = source.execute(
+                    select([func.max(Version.__table__.c.version_id)])).scalar()
+                for table, copy in tables.values():
+                    count = _copy_rows(source, target, table, copy)
+                    logger.info("snapshot: %s rows of %s", count, table.name)
+                _set_version(source, target, versions, version_id)
+    finally:
+        engine.dispose()
+    os.replace(building, path)
+    _compress(path)
+    return version_id
+
+
+async def ensure_snapshot(path: str) -> Optional[int]:
+    """
+    Builds the snapshot at *path* if there's no compressed copy yet,
+    in the event loop's default executor so that the loop keeps
+    serving other connections meanwhile. Concurrent calls for the same
+    *path* wait for a single build. Returns the version identifier of
+    the snapshot.
+    """
+    loop = asyncio.get_event_loop()
+    if not os.path.exists(path + COMPRESSED_SUFFIX):
+        build = _builds.get(path, None)
+        if build is None:
+            build = loop.run_in_executor(None, build_snapshot, path)
+            _builds[path] = build
+            build.add_done_callback(lambda _: _builds.pop(path, None))
+        # a cancelled request doesn't cancel the build others wait for
+        await asyncio.shield(build)
+    return await loop.run_in_executor(None, snapshot_version, path)
+
+
+@core.session_closing
+def refresh_snapshot(path: str, session=None) -> Optional[int]:
+    """
+    Brings the snapshot at *path* up to the latest version, applying
+    only the rows changed by the operations registered after the
+    snapshot's version. The snapshot is built from scratch if it
+    doesn't exist, or if the operations it needs were trimmed.
+    Returns the version identifier of the snapshot.
+    """
+    if not os.path.exists(path):
+        return build_snapshot(path)
+    current = snapshot_version(path)
+    latest = core.get_latest_version_id(session=session)
+    if latest == current:
+        return current
+    if current is None or session.query(Version).get(current) is None:
+        # the operations after the snapshot might be gone
+        return build_snapshot(path)
+
+    # every object touched is copied again from the server database,
+    # which leaves deleted objects out
+    changes = set(session.query(Operation.content_type_id, Operation.row_id).\
+                  filter(Operation.version_id > current,
+                         Operation.version_id <= latest))
+
+    metadata = MetaData()
+    tables = _snapshot_tables(metadata)
+    versions = _versions_table(metadata)
+    engine = _snapshot_engine(path)
+    source = session.connection()
+    try:
+        with engine.begin() as target:
+            for content_type_id, (table, copy) in tables.items():
+                row_ids = [row_id for (ct, row_id) in changes
+                           if ct == content_type_id]
+                if not row_ids:
+                    continue
+                pk = list(table.primary_key.columns)[0]
+                copy_pk = copy.c[pk.name]
+                for batch in grouper(row_ids, core.MAX_SQL_VARIABLES):
+                    target.execute(copy.delete().where(copy_pk.in_(batch)))
+                    # rows deleted on the server aren't found here
+                    _copy_rows(source, target, table, copy, pk.in_(batch))
+            _set_version(source, target, versions, latest)
+    finally:
+        engine.dispose()
+    _compress(path)
+    logger.info("snapshot refreshed from version %s to %s with %s changes",
+                current, latest, len(changes))
+    return latest
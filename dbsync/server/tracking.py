@@ -17,6 +17,7 @@ from sqlalchemy.sql import Join
 from sqlalchemy.orm.session import object_session
 
 from dbsync import core
+from dbsync import statements # tracks bulk and Core statements
 from dbsync.models import Operation, Version, SQLClass, call_after_tracking_fn, call_before_tracking_fn, SkipOperation
 from dbsync.logs import get_logger
 
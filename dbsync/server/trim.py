@@ -1,40 +1,187 @@
 """
 Trim the server synchronization tables to free space.
+
+The operations every node has already seen are deleted. A node's
+watermark is the last version it pushed or, if it never pushed, the
+last version created before it registered; every watermark is
+computed with a single aggregate query. Nodes that didn't push
+within the staleness horizon don't hold the trim back: they're
+reported in the result and will need a repair, since the operations
+they miss are gone. Each trim that deletes operations saves its
+watermark as a ``TrimMark``, which :func:`repair_required` compares
+against, since version identifiers may have gaps. If the archive is
+enabled (see ``dbsync.server.archive``) the operations are moved
+there instead of being deleted, and pulls still read them.
+
+Rows are deleted in batches of ``TRIM_BATCH_SIZE``, at most
+``core.MAX_SQL_VARIABLES`` since the keys of a batch are bound in a
+single ``IN`` list. Without a *session*, each batch is committed on
+its own, so that the tables aren't locked for the whole trim.
 """
 
+import datetime
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import aliased
+
 from dbsync.lang import *
-from dbsync import core
-from dbsync.models import Node, Version, Operation
+from dbsync import core, models
+from dbsync.models import Node, Version, Operation, TrimMark
+from dbsync.server.archive import move_operations
+from dbsync.logs import get_logger
+
+
+logger = get_logger(__name__)
+
+#: Nodes that didn't push for this long don't block the trim.
+STALENESS_HORIZON = datetime.timedelta(days=30)
+
+#: Rows deleted by each statement.
+TRIM_BATCH_SIZE = core.MAX_SQL_VARIABLES
+
+
+@dataclass
+class TrimResult:
+    #: Operations up to this version were deleted (None if nothing was).
+    watermark: Optional[int] = None
+    operations: int = 0
+    versions: int = 0
+    #: Nodes ignored for being stale, which will need a repair.
+    stale_nodes: List[int] = field(default_factory=list)
+
+
+def node_watermarks(session, horizon: Optional[datetime.timedelta] = STALENESS_HORIZON,
+                    now: Optional[datetime.datetime] = None):
+    """
+    Returns a list of (node_id, watermark, stale) triads, one for each
+    registered node, with a single query.
+    """
+    now = now or datetime.datetime.now()
+    pushed = session.query(Version.node_id.label('node_id'),
+                           func.max(Version.version_id).label('version_id'),
+                           func.max(Version.created).label('created')).\
+        group_by(Version.node_id).subquery()
+    previous = aliased(Version)
+    before_register = select([func.max(previous.version_id)]).\
+        where(previous.created <= Node.registered).\
+        correlate(Node).as_scalar()
+    rows = session.query(Node.node_id, Node.registered,
+                         pushed.c.version_id, pushed.c.created,
+                         before_register).\
+        outerjoin(pushed, pushed.c.node_id == Node.node_id)
+    watermarks = []
+    for node_id, registered, version_id, created, registered_at in rows:
+        last_seen = created or registered
+        stale = horizon is not None and last_seen is not None and \
+            now - last_seen > horizon
+        watermarks.append((node_id,
+                           version_id if version_id is not None else registered_at,
+                           stale))
+    return watermarks
+
+
+def _delete_batch(session, model, column, criterion, batch_size) -> int:
+    keys = [key for (key,) in
+            session.query(column).filter(criterion).limit(batch_size)]
+    if keys:
+        session.query(model).filter(column.in_(keys)).\
+            delete(synchronize_session=False)
+    return len(keys)
+
+
+def _delete_batches(session, model, column, criterion, batch_size) -> int:
+    "Deletes the rows matching *criterion* in batches of keys."
+    deleted = 0
+    while True:
+        if session is None:
+            with core.committing_context() as batch_session:
+                count = _delete_batch(batch_session, model, column,
+                                      criterion, batch_size)
+        else:
+            count = _delete_batch(session, model, column, criterion, batch_size)
+        deleted += count
+        if count < batch_size:
+            return deleted
 
 
-@core.session_committing
-def trim(session=None):
+def trim(session=None,
+         horizon: Optional[datetime.timedelta] = STALENESS_HORIZON,
+         batch_size: int = TRIM_BATCH_SIZE,
+         now: Optional[datetime.datetime] = None) -> TrimResult:
     """
     Clears space by deleting operations and versions that are no
     longer needed.
 
-    This might cause the server to answer incorrectly to pull requests
-    from nodes that were late to register. To go around that, a repair
-    should be enforced after the node's register.
+    Nodes that didn't push within *horizon* (``None`` disables it)
+    are left out of the computation and listed in the result. Nodes
+    that registered within the horizon and never pushed keep the
+    operations created after their registration.
 
-    Another problem with this procedure is that it won't clear space
-    if there's at least one abandoned node registered. The task of
-    keeping the nodes registry clean of those is left to the
-    programmer.
+    If *session* is given the deletes run in its transaction;
+    otherwise each batch is committed on its own.
     """
-    versions = [maybe(session.query(Version).\
-                          filter(Version.node_id == node.node_id).\
-                          order_by(Version.version_id.desc()).first(),
-                      attr('version_id'),
-                      None)
-                for node in session.query(Node)]
-    if not versions:
-        last_id = core.get_latest_version_id(session=session)
-        # all operations are versioned according to dbsync.server.track
-        session.query(Operation).delete()
-        session.query(Version).filter(Version.version_id != last_id).delete()
+    batch_size = min(batch_size, core.MAX_SQL_VARIABLES)
+    result = TrimResult()
+    query_session = session or core.Session()
+    try:
+        watermarks = node_watermarks(query_session, horizon, now)
+        result.stale_nodes = [node_id for node_id, _, stale in watermarks if stale]
+        active = [watermark for _, watermark, stale in watermarks if not stale]
+        if not active:
+            # all operations are versioned according to dbsync.server.track
+            result.watermark = core.get_latest_version_id(session=query_session)
+        elif None not in active:
+            result.watermark = min(active)
+        # else a node registered before any version blocks the trim
+    finally:
+        if session is None:
+            query_session.close()
+    if result.stale_nodes:
+        logger.warning("nodes %s are stale and will need a repair",
+                       result.stale_nodes)
+    if result.watermark is None:
+        return result
+    if models.archive_enabled:
+        result.operations = move_operations(
+            session, Operation.__table__.c.version_id <= result.watermark,
+            batch_size)
+    else:
+        # saved first, so that an interrupted trim still forces repairs
+        _save_mark(session, result.watermark)
+        result.operations = _delete_batches(
+            session, Operation, Operation.order,
+            Operation.version_id <= result.watermark, batch_size)
+    result.versions = _delete_batches(
+        session, Version, Version.version_id,
+        Version.version_id < result.watermark, batch_size)
+    logger.info("trimmed %s operations and %s versions up to version %s",
+                result.operations, result.versions, result.watermark)
+    return result
+
+
+def _save_mark(session, watermark: int) -> None:
+    if session is None:
+        with core.committing_context() as mark_session:
+            _save_mark(mark_session, watermark)
         return
-    if None in versions: return # dead nodes block the trim
-    minversion = min(versions)
-    session.query(Operation).filter(Operation.version_id <= minversion).delete()
-    session.query(Version).filter(Version.version_id < minversion).delete()
+    latest = session.query(func.max(TrimMark.version_id)).scalar()
+    if latest is None or latest < watermark:
+        session.add(TrimMark(version_id=watermark,
+                             trimmed=datetime.datetime.now()))
+        session.flush()
+
+
+@core.session_closing
+def repair_required(latest_version_id: Optional[int], session=None) -> bool:
+    """
+    Returns whether a node at *latest_version_id* missed operations
+    that were trimmed, and so must repair instead of pulling. A node
+    that never pulled (``None``) needs the whole history, so it must
+    repair if anything was trimmed.
+    """
+    trimmed = session.query(func.max(TrimMark.version_id)).scalar()
+    if trimmed is None:
+        return False
+    return (latest_version_id or 0) < trimmed
@@ -2,6 +2,7 @@ import asyncio
 import datetime
 import importlib
 import json
+import os
 from dataclasses import dataclass
 from typing import Optional, Dict, Any, List, Tuple
 
@@ -10,13 +11,21 @@ import sqlalchemy
 from dbsync import server, core
 from dbsync.client import PushRejected, PullSuggested
 from dbsync.core import with_transaction, with_transaction_async
-from dbsync.messages.codecs import SyncdbJSONEncoder
+from dbsync.lang import grouper
+from dbsync.messages.codecs import SyncdbJSONEncoder, decode, types_dict
 from dbsync.messages.pull import PullRequestMessage, PullMessage
 from dbsync.messages.push import PushMessage
-from dbsync.models import OperationError, Version, Operation, attr, SQLClass, call_after_tracking_fn
+from dbsync.models import OperationError, Version, Operation, OperationRecord, attr, SQLClass, \
+    call_after_tracking_fn
 from dbsync.server import before_push, after_push
 from dbsync.server.conflicts import find_unique_conflicts
-from dbsync.server.handlers import PullRejected
+from dbsync.server.cache import cache
+from dbsync.server.trim import repair_required
+from dbsync.client.repair import RepairRejected
+from dbsync.client.snapshot import SnapshotUnavailable
+from dbsync.server import snapshot
+from dbsync.server.handlers import PullRejected, REPAIR_CHUNK_SIZE, repair_chunks, \
+    handle_merkle_request, preceding_version_id
 from dbsync.socketserver import GenericWSServer, Connection
 import sqlalchemy as sa
 from sqlalchemy.engine import Engine
@@ -24,11 +33,14 @@ from sqlalchemy.engine import Engine
 from dbsync.createlogger import create_logger
 from sqlalchemy.orm import sessionmaker, make_transient
 
-from dbsync.utils import get_pk, properties_dict
+from dbsync.utils import get_pk
 
 import logging
 logger = create_logger("dbsync-server")
 
+#: Size of the binary messages a snapshot is sent in.
+SNAPSHOT_FRAME_SIZE = 2 ** 20
+
 
 class SyncServerConnection(Connection):
     ...
@@ -59,12 +71,28 @@ async def send_field_payload(connection: Connection, msg: Dict[str, Any]):
 class SyncServer(GenericWSServer):
     engine: Optional[Engine] = None
     Session: Optional[sessionmaker] = None
+    snapshot_path: Optional[str] = None
+    """SQLite snapshot served at /snapshot, see dbsync.server.snapshot"""
 
     def __post_init__(self):
         if not self.Session:
             self.Session = sessionmaker(bind=self.engine)
 
 
+def _check_push_version(latest_version_id: Optional[int],
+                        given: Optional[int]) -> None:
+    if latest_version_id == given:
+        return
+    exc = f"version identifier isn't the latest one; " \
+          f"incoming: {given}, on server:{latest_version_id}"
+    logger.warn(exc)
+    if latest_version_id is None:
+        raise PushRejected(exc)
+    if given is None or given < latest_version_id:
+        raise PullSuggested(exc)
+    raise PushRejected(exc)
+
+
 @SyncServer.handler("/push")
 @with_transaction_async()
 async def handle_push(connection: Connection, session: sqlalchemy.orm.Session) -> Optional[int]:
@@ -82,25 +110,28 @@ async def handle_push(connection: Connection, session: sqlalchemy.orm.Session) -
         # await connection.socket.send(f"answer is:{msg}")
         logger.info(f"message key={pushmsg.key}")
 
-        latest_version_id = core.get_latest_version_id(session=session)
-        logger.info(f"** version on server:{latest_version_id}, version in pushmsg:{pushmsg.latest_version_id}")
-        if latest_version_id != pushmsg.latest_version_id:
+        known_version_id = cache.latest_version_id
+        if known_version_id is not None and \
+                (pushmsg.latest_version_id or 0) < known_version_id:
             exc = f"version identifier isn't the latest one; " \
-                  f"incoming: {pushmsg.latest_version_id}, on server:{latest_version_id}"
-
-            if latest_version_id is None:
-                logger.warn(exc)
-                raise PushRejected(exc)
-            if pushmsg.latest_version_id is None:
-                logger.warn(exc)
-                raise PullSuggested(exc)
-            if pushmsg.latest_version_id < latest_version_id:
-                logger.warn(exc)
-                raise PullSuggested(exc)
-            raise PushRejected(exc)
+                  f"incoming: {pushmsg.latest_version_id}, known on server:{known_version_id}"
+            logger.warn(exc)
+            raise PullSuggested(exc)
         if not pushmsg.islegit(session):
             raise PushRejected("message isn't properly signed")
 
+        # the new version, which tells whether other pushes came first
+        if pushmsg.operations:
+            version = Version(created=datetime.datetime.now(), node_id=pushmsg.node_id)
+            session.add(version)
+            session.flush()
+            latest_version_id = preceding_version_id(
+                version, pushmsg.latest_version_id, session)
+        else:
+            version = None
+            latest_version_id = core.get_latest_version_id(session=session)
+        _check_push_version(latest_version_id, pushmsg.latest_version_id)
+
         for listener in before_push:
             listener(session, pushmsg)
 
@@ -127,9 +158,9 @@ async def handle_push(connection: Connection, session: sqlalchemy.orm.Session) -
 
         # II) perform the operations
         operations = [o for o in pushmsg.operations if o.tracked_model is not None]
-        post_operations: List[Tuple[Operation, SQLClass, Optional[SQLClass]]] = []
+        post_operations: List[Tuple[OperationRecord, SQLClass, Optional[SQLClass]]] = []
         try:
-            op: Operation
+            op: OperationRecord
             for op in operations:
                 (obj, old_obj) = await op.perform_async(pushmsg, session, pushmsg.node_id, connection.socket)
 
@@ -141,7 +172,7 @@ async def handle_push(connection: Connection, session: sqlalchemy.orm.Session) -
                         type="info",
                         op=dict(
                             row_id=op.row_id,
-                            version=op.version,
+                            version=op.version_id,
                             command=op.command,
                             content_type_id=op.content_type_id,
                         )
@@ -155,17 +186,17 @@ async def handle_push(connection: Connection, session: sqlalchemy.orm.Session) -
             raise PushRejected("at least one operation couldn't be performed",
                                *e.args)
 
-        # III) insert a new version
-        if post_operations: # only if operations have been done -> create the new version
-            version = Version(created=datetime.datetime.now(), node_id=pushmsg.node_id)
-            session.add(version)
+        # III) keep the new version only if operations have been done
+        if version is not None and not post_operations:
+            session.delete(version)
+            session.flush()
+            version = None
 
         # IV) insert the operations, discarding the 'order' column
         accomplished_operations = [op for (op, obj, old_obj) in post_operations]
         for op in sorted(accomplished_operations, key=attr('order')):
-            new_op = Operation()
-            for k in [k for k in properties_dict(op) if k != 'order']:
-                setattr(new_op, k, getattr(op, k))
+            new_op = op.to_operation()
+            new_op.order = None
             session.add(new_op)
             new_op.version = version
             session.flush()
@@ -221,6 +252,10 @@ async def handle_pull(connection: Connection):
         request_message = PullRequestMessage(data)
     except KeyError:
         raise PullRejected("request object isn't a valid PullRequestMessage", data)
+    if repair_required(request_message.latest_version_id):
+        raise PullRejected("the operations after version {0} were trimmed, "
+                           "a repair is required".\
+                           format(request_message.latest_version_id))
 
     message = PullMessage()
     message.fill_for(
@@ -232,7 +267,22 @@ async def handle_pull(connection: Connection):
 
     # sends the whole bunch to the client,
     # there it is received by client's run_pull and handled by pull.py/merge
-    await connection.socket.send(json.dumps(message.to_json(), indent=4,  cls=SyncdbJSONEncoder))
+    encoded = message.to_json()
+    chunk_size = data.get('payload_chunk_size', None)
+    if chunk_size:
+        # the payload follows in chunks, which the client adds to its
+        # store as they arrive instead of decoding it all at once
+        payload = encoded.pop('payload')
+        encoded.update(payload={}, payload_chunked=True)
+        await connection.socket.send(json.dumps(encoded, cls=SyncdbJSONEncoder))
+        for model_name, objects in payload.items():
+            for chunk in grouper(objects, int(chunk_size)):
+                await connection.socket.send(json.dumps(
+                    dict(type="payload", model=model_name, objects=list(chunk)),
+                    cls=SyncdbJSONEncoder))
+        await connection.socket.send(json.dumps(dict(type="payload_end")))
+    else:
+        await connection.socket.send(json.dumps(encoded, indent=4,  cls=SyncdbJSONEncoder))
 
     # fetch messages from client
     logger.debug(f"server listening for messages after sending object")
@@ -252,6 +302,136 @@ async def handle_pull(connection: Connection):
             logger.debug(f"response from server:{msg}")
 
 
+def _latest_version_id(server):
+    session = server.Session()
+    try:
+        return core.get_latest_version_id(session=session)
+    finally:
+        session.close()
+
+
+def _repair_chunk(server, model, after, chunk_size, include_extensions):
+    "Returns the first chunk of *model* after the key *after*, or None."
+    session = server.Session()
+    try:
+        return next(repair_chunks(
+            model,
+            after=after,
+            chunk_size=chunk_size,
+            include_extensions=include_extensions,
+            session=session), None)
+    finally:
+        session.close()
+
+
+@SyncServer.handler("/repair")
+async def handle_repair(connection: Connection):
+    """
+    Streams the rows of a synchronized model to the client, in chunks
+    ordered by primary key.
+
+    The client sends a request with the *model* name, the encoded
+    primary key of the last row it already has (*after*, or null),
+    the *chunk_size* and whether to *include_extensions*. The server
+    answers with messages of type ``chunk``, holding the encoded
+    *objects* and the *last* primary key among them, and ends the
+    stream with a ``result`` message carrying the latest version
+    identifier at the time the stream began.
+
+    Each chunk is read outside the event loop, with its own session.
+    Clients download several models at once by opening a connection
+    for each one.
+    """
+    request = json.loads(await connection.socket.recv())
+    model_name = request.get('model', None)
+    model = core.synched_models.model_names. \
+        get(model_name, core.null_model).model
+    if model is None:
+        raise RepairRejected("model isn't being synchronized", model_name)
+    chunk_size = int(request.get('chunk_size', None) or REPAIR_CHUNK_SIZE)
+    include_extensions = request.get('include_extensions', True)
+    decode_pk = decode(types_dict(model)[get_pk(model)])
+
+    loop = asyncio.get_event_loop()
+    latest_version_id = await loop.run_in_executor(
+        None, _latest_version_id, connection.server)
+    after = decode_pk(request.get('after', None))
+    while True:
+        chunk = await loop.run_in_executor(
+            None, _repair_chunk, connection.server, model, after,
+            chunk_size, include_extensions)
+        if chunk is None:
+            break
+        objects, last = chunk
+        await connection.socket.send(json.dumps(
+            dict(type="chunk", model=model_name, objects=objects, last=last),
+            cls=SyncdbJSONEncoder))
+        after = decode_pk(last)
+
+    await connection.socket.send(json.dumps(
+        dict(type="result", model=model_name,
+             latest_version_id=latest_version_id)))
+
+
+def _answer_merkle(server, request, trees):
+    session = server.Session()
+    try:
+        return handle_merkle_request(request, trees, session=session)
+    finally:
+        session.close()
+
+
+@SyncServer.handler("/merkle")
+async def handle_merkle(connection: Connection):
+    """
+    Serves a differential repair: answers each request of the client
+    with ``handle_merkle_request`` until it sends a ``done`` message.
+    Requests are answered outside the event loop, since building a
+    tree reads the whole table.
+    """
+    loop = asyncio.get_event_loop()
+    trees = {}
+    async for msg in connection.socket:
+        request = json.loads(msg)
+        if request['type'] == 'done':
+            break
+        response = await loop.run_in_executor(
+            None, _answer_merkle, connection.server, request, trees)
+        if response is None:
+            raise RepairRejected("invalid differential repair request",
+                                 request.get('type', None))
+        await connection.socket.send(
+            json.dumps(response, cls=SyncdbJSONEncoder))
+
+
+@SyncServer.handler("/snapshot")
+async def handle_snapshot(connection: Connection):
+    """
+    Sends the compressed snapshot of the synchronized tables, building
+    it first (outside the event loop) if there's none yet. The
+    transfer begins with a
+    ``snapshot`` message carrying the version identifier and size,
+    continues with binary messages of gzip data and ends with a
+    ``result`` message.
+    """
+    path = connection.server.snapshot_path
+    if path is None:
+        raise SnapshotUnavailable("the server doesn't keep a snapshot")
+    version_id = await snapshot.ensure_snapshot(path)
+
+    with open(path + snapshot.COMPRESSED_SUFFIX, 'rb') as f:
+        await connection.socket.send(json.dumps(
+            dict(type="snapshot",
+                 version_id=version_id,
+                 size=os.fstat(f.fileno()).st_size)))
+        while True:
+            data = f.read(SNAPSHOT_FRAME_SIZE)
+            if not data:
+                break
+            await connection.socket.send(data)
+    await connection.socket.send(json.dumps(dict(type="result")))
+
+
 @SyncServer.handler("/status")
 async def status(connection: Connection):
     logger.info("STATUS")
@@ -0,0 +1,360 @@
+"""
+.. module:: dbsync.statements
+   :synopsis: Tracking of bulk and Core DML statements.
+
+The ORM listeners installed by ``track`` only see objects flushed by
+a session's unit of work. Writes done with
+``Session.bulk_insert_mappings``, ``Session.bulk_update_mappings`` or
+Core statements (``table.insert().values([...])``,
+``table.update().where(...)``, ...) skip them, so this module listens
+to the statements executed by every engine and registers the
+operations of those that touch a tracked table.
+
+The primary keys of the affected rows are taken, in order of
+preference, from a ``RETURNING`` clause added to the statement (in
+databases that support it), from the compiled parameters (explicit
+values and python-side defaults), for inserts from a select, from
+that select, and for updates and deletes, from a select with the
+statement's criteria, both run right before the statement. The key
+generated by the database for a single row insert is read after the
+statement (``inserted_primary_key`` or, in SQLite, the row with the
+inserted rowid). Keys generated by the database for several rows
+without ``RETURNING`` can't be known, so those rows aren't tracked
+and a warning is logged. The
+operations of a statement are written with a single ``executemany``
+on the same connection, so they belong to the same transaction. In
+the server, each statement gets its own version.
+
+Statements executed during an ORM flush are left to the listeners,
+and those of dbsync's internal sessions, or executed while listening
+is disabled, aren't tracked. Extension tracking hooks
+(``before_tracking_fn`` and ``after_tracking_fn``) need objects, so
+they don't run for these operations.
+"""
+
+import contextlib
+import datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import event, select, literal_column
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm.session import Session as GlobalSession
+from sqlalchemy.sql.dml import Insert, Update, Delete
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter
+
+from dbsync import core
+from dbsync.models import Operation, Version, SQLClass
+from dbsync.logs import get_logger
+
+
+logger = get_logger(__name__)
+
+#: Connection info key of the flag that disables tracking of the
+#  writes done with the connection.
+UNTRACKED_FLAG = "dbsync_suppressed"
+
+#: Connection info key of the session using the connection.
+SESSION_KEY = "dbsync_session"
+
+#: Session info key set while the session flushes its unit of work.
+FLUSHING_KEY = "dbsync_flushing"
+
+#: Connection info key of the (content type id, row ids) pairs given
+#  unversioned operations in the connection's transaction, applied to
+#  ``dbsync.client.status.counter`` on commit.
+WRITTEN_KEY = "dbsync_written"
+
+#: Execution option under which a statement carries its pending
+#  operations from before to after its execution.
+PENDING_OPTION = "dbsync_pending"
+
+COMMANDS = ((Insert, 'i'), (Update, 'u'), (Delete, 'd'))
+
+
+def _command(statement) -> Optional[str]:
+    for class_, command in COMMANDS:
+        if isinstance(statement, class_):
+            return command
+    return None
+
+
+def _tracked_model(table) -> Optional[SQLClass]:
+    """
+    Returns the model of *table* if its writes are tracked by the ORM
+    listeners (models tracked by triggers don't need this).
+    """
+    record = core.synched_models.tables.get(getattr(table, 'name', None), None)
+    if record is None or record.model is None or \
+            record.model.__table__ is not table: # e.g. a copy in a snapshot
+        return None
+    handlers = core.synched_models.model_handlers.get(record.model, None)
+    if handlers is None or \
+            not event.contains(record.model, 'after_insert', handlers[0]):
+        return None
+    return record.model
+
+
+def _untracked(connection) -> bool:
+    if not core.listening or connection.info.get(UNTRACKED_FLAG, False):
+        return True
+    session = connection.info.get(SESSION_KEY, None)
+    return session is not None and session.info.get(FLUSHING_KEY, False)
+
+
+def _distill(multiparams, params) -> List[Dict[str, Any]]:
+    "Returns the parameter sets of an execution."
+    if not multiparams:
+        return [params] if params else []
+    if len(multiparams) == 1 and isinstance(multiparams[0], (list, tuple)):
+        return [p for p in multiparams[0] if isinstance(p, dict)]
+    return [p for p in multiparams if isinstance(p, dict)]
+
+
+def _supports_returning(connection) -> bool:
+    return bool(getattr(connection.dialect, 'implicit_returning', False))
+
+
+def _pk_bind(statement, pk) -> Optional[str]:
+    "Returns the parameter the criteria *pk* = :param use, if that's it."
+    criteria = statement._whereclause
+    if isinstance(criteria, BinaryExpression) and \
+            criteria.operator is operators.eq:
+        for column, bind in ((criteria.left, criteria.right),
+                             (criteria.right, criteria.left)):
+            if column is pk and isinstance(bind, BindParameter):
+                return bind.key
+    return None
+
+
+@contextlib.contextmanager
+def _nested(connection):
+    """
+    Keeps *connection* open while statements are run in the middle of
+    another execution (``Engine.execute`` closes its connection with
+    the first result otherwise).
+    """
+    close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        yield connection
+    finally:
+        connection.should_close_with_result = close_with_result
+
+
+def _affected_pks(connection, statement, pk, parameters) -> List[Any]:
+    """
+    Returns the primary keys of the rows an update or delete is about
+    to change.
+    """
+    key = _pk_bind(statement, pk)
+    if key is not None and parameters and all(key in p for p in parameters):
+        return [p[key] for p in parameters]
+    query = select([pk])
+    if statement._whereclause is not None:
+        query = query.where(statement._whereclause)
+    pks = []
+    with _nested(connection):
+        for p in parameters or [{}]:
+            pks.extend(row[0] for row in connection.execute(query, p))
+    return pks
+
+
+def _selected_pks(connection, statement, pk, parameters) -> Optional[List[Any]]:
+    """
+    Returns the primary keys of the rows an ``INSERT ... FROM SELECT``
+    is about to insert, read with its select, or ``None`` if the
+    select doesn't provide them.
+    """
+    names = [name if isinstance(name, str) else name.key
+             for name in statement.select_names]
+    if pk.key not in names:
+        return None
+    index = names.index(pk.key)
+    pks = []
+    with _nested(connection):
+        for p in parameters or [{}]:
+            pks.extend(row[index] for row in
+                       connection.execute(statement.select, p))
+    return pks
+
+
+def _before_execute(connection, clauseelement, multiparams, params):
+    command = _command(clauseelement)
+    if command is None or _untracked(connection):
+        return clauseelement, multiparams, params
+    model = _tracked_model(clauseelement.table)
+    if model is None:
+        return clauseelement, multiparams, params
+    pk = list(clauseelement.table.primary_key.columns)[0]
+    parameters = _distill(multiparams, params)
+    pending = {'model': model, 'command': command, 'pk': pk,
+               'returning': False, 'pks': None}
+    if clauseelement._returning is None and len(parameters) <= 1 and \
+            _supports_returning(connection) and \
+            (command != 'i' or clauseelement._has_multi_parameters or
+             clauseelement.select is not None):
+        # inserts of a single row report their key anyway
+        clauseelement = clauseelement.returning(pk)
+        pending['returning'] = True
+    elif command != 'i':
+        pending['pks'] = _affected_pks(connection, clauseelement, pk, parameters)
+    elif clauseelement.select is not None:
+        pending['pks'] = _selected_pks(connection, clauseelement, pk, parameters)
+        if pending['pks'] is None:
+            logger.warning("primary keys generated by the database can't be "
+                           "tracked in inserts from a select into %s; "
+                           "the statement isn't tracked", model)
+            return clauseelement, multiparams, params
+    clauseelement = clauseelement.execution_options(**{PENDING_OPTION: pending})
+    return clauseelement, multiparams, params
+
+
+def _inserted_pks(context, pk) -> List[Any]:
+    "Returns the primary keys of the rows inserted in *context*."
+    key = pk.key
+    pks = []
+    for parameters in context.compiled_parameters:
+        values = [v for k, v in parameters.items()
+                  if k == key or (k.startswith(key + "_m") and
+                                  k[len(key) + 2:].isdigit())]
+        pks.extend(values or [None])
+    return pks
+
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context,
+                          executemany):
+    pending = context.execution_options.get(PENDING_OPTION, None)
+    if pending is None:
+        return
+    if pending['returning']:
+        pks = [row[0] for row in cursor.fetchall()]
+    elif pending['pks'] is not None:
+        pks = pending['pks']
+    else:
+        pks = _inserted_pks(context, pending['pk'])
+        if pks == [None] and not executemany:
+            # a single row, whose key is read afterwards
+            pending['deferred'] = True
+            return
+    if None in pks:
+        logger.warning("primary keys generated by the database can't be "
+                       "tracked in bulk inserts of %s", pending['model'])
+        pks = [pk for pk in pks if pk is not None]
+    # written before an autocommit, in the same transaction
+    with _nested(connection):
+        write_operations(connection, pending['model'], pending['command'], pks)
+
+
+def _rowid_pks(connection, pk, result) -> List[Any]:
+    """
+    Returns the key of the row inserted in SQLite with *result*, read
+    with its rowid, or an empty list if it can't be known.
+    """
+    rowid = result.lastrowid
+    if connection.dialect.name != 'sqlite' or not rowid:
+        return []
+    query = select([pk]).where(literal_column("rowid") == rowid)
+    if connection.closed:
+        # autocommitted by Engine.execute
+        value = connection.engine.execute(query).scalar()
+    else:
+        with _nested(connection):
+            value = connection.execute(query).scalar()
+    return [value] if value is not None else []
+
+
+def _after_execute(connection, clauseelement, multiparams, params, result):
+    pending = result.context.execution_options.get(PENDING_OPTION, None)
+    if pending is None or not pending.get('deferred', False):
+        return
+    pks = list(result.inserted_primary_key[:1])
+    if pks == [None]:
+        pks = _rowid_pks(connection, pending['pk'], result)
+    if not pks:
+        logger.warning("the primary key generated by the database can't be "
+                       "tracked in an insert of %s", pending['model'])
+        return
+    if connection.closed:
+        # autocommitted by Engine.execute
+        with connection.engine.begin() as other:
+            write_operations(other, pending['model'], 'i', pks)
+    else:
+        write_operations(connection, pending['model'], 'i', pks)
+
+
+def write_operations(connection, model: SQLClass, command: str,
+                     pks: List[Any]) -> int:
+    """
+    Registers an operation *command* for each of *pks* in a single
+    statement. In the server they get a new version. Returns the
+    amount of operations written.
+    """
+    if not pks:
+        return 0
+    version_id = None
+    if core.mode == 'server':
+        version_id = connection.execute(
+            Version.__table__.insert().values(
+                created=datetime.datetime.now())).inserted_primary_key[0]
+    content_type_id = core.synched_models.models[model].id
+    connection.execute(
+        Operation.__table__.insert(),
+        [{'row_id': pk, 'version_id': version_id,
+          'content_type_id': content_type_id, 'command': command}
+         for pk in pks])
+    if version_id is None:
+        connection.info.setdefault(WRITTEN_KEY, []).append(
+            (content_type_id, pks))
+    logger.debug("tracked %s '%s' operations of %s from a statement",
+                 len(pks), command, model.__name__)
+    return len(pks)
+
+
+@contextlib.contextmanager
+def untracked(connection):
+    "Disables tracking of the writes done with *connection* in the context."
+    info = connection.info
+    previous = info.get(UNTRACKED_FLAG, None)
+    info[UNTRACKED_FLAG] = True
+    try:
+        yield connection
+    finally:
+        info[UNTRACKED_FLAG] = previous
+
+
+def _begin(session, transaction, connection):
+    "Links the connection to the session for the transaction."
+    if transaction.parent is not None:
+        return
+    info = connection.info
+    info[SESSION_KEY] = session
+    if getattr(session, core.INTERNAL_SESSION_ATTR, False) or \
+            not core.listening:
+        info[UNTRACKED_FLAG] = True
+    session.info.setdefault(SESSION_KEY, []).append(info)
+
+
+def _end(session, transaction):
+    if transaction.parent is None:
+        for info in session.info.pop(SESSION_KEY, []):
+            info.pop(SESSION_KEY, None)
+            info.pop(UNTRACKED_FLAG, None)
+        session.info.pop(FLUSHING_KEY, None)
+
+
+def _before_flush(session, flush_context, instances):
+    session.info[FLUSHING_KEY] = True
+
+
+def _after_flush(session, flush_context):
+    session.info.pop(FLUSHING_KEY, None)
+
+
+event.listen(Engine, 'before_execute', _before_execute, retval=True)
+event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+event.listen(Engine, 'after_execute', _after_execute)
+event.listen(GlobalSession, 'after_begin', _begin)
+event.listen(GlobalSession, 'after_transaction_end', _end)
+event.listen(GlobalSession, 'before_flush', _before_flush)
+event.listen(GlobalSession, 'after_flush_postexec', _after_flush)
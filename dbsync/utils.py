@@ -7,7 +7,7 @@ import random
 import inspect
 from typing import List, Optional, Tuple, Dict, Any
 
-from sqlalchemy import Table
+from sqlalchemy import Table, and_, or_
 from sqlalchemy.ext.declarative import DeclarativeMeta
 from sqlalchemy.orm import (
     object_mapper,
@@ -19,6 +19,8 @@ from sqlalchemy.orm import (
     state, Session, Query)
 from sqlalchemy.sql import Join
 
+from dbsync.lang import grouper
+
 
 def generate_secret(length=128):
     chars = "0123456789" \
@@ -124,6 +126,20 @@ def parent_objects(sa_object: "SQLClass", models: List[DeclarativeMeta], session
                             for m, val in parent_references(sa_object, models)) if obj is not None]
 
 
+def tuple_in(columns: List[Any], values: List[Tuple[Any, ...]]):
+    """
+    Returns a criterion matching rows whose *columns* are equal to any
+    of the tuples in *values*. A single column uses a plain ``IN``;
+    several columns use a disjunction of equalities, which works in
+    every backend and matches ``NULL`` values like ``filter_by`` does.
+    """
+    if len(columns) == 1:
+        return columns[0].in_([value for (value,) in values])
+    return or_(*(and_(*(column == value
+                        for column, value in zip(columns, tuple_)))
+                 for tuple_ in values))
+
+
 def query_model(session: Session, sa_class: DeclarativeMeta, only_pk=False) -> Query:
     """
     Returns a query for *sa_class* that doesn't load any relationship
@@ -140,6 +156,27 @@ def query_model(session: Session, sa_class: DeclarativeMeta, only_pk=False) -> Q
     return session.query(sa_class).options(*opts)
 
 
+def unique_matches(model: DeclarativeMeta, columns: Tuple[str, ...],
+                   values, session: Session) -> Dict[Tuple[Any, ...], "SQLClass"]:
+    """
+    Returns a dictionary of (unique values, object in database) for
+    the objects of *model* whose *columns* hold any of the tuples in
+    *values*, fetched with one query per batch of tuples. Tuples made
+    only of null values are left out.
+    """
+    from dbsync.core import MAX_SQL_VARIABLES
+    values = [tuple_ for tuple_ in values
+              if not all(value is None for value in tuple_)]
+    attributes = [getattr(model, column) for column in columns]
+    matches = {}
+    for batch in grouper(values, max(1, MAX_SQL_VARIABLES // len(columns))):
+        for obj in query_model(session, model).\
+                filter(tuple_in(attributes, list(batch))):
+            matches.setdefault(
+                tuple(getattr(obj, column) for column in columns), obj)
+    return matches
+
+
 class EventRegister(object):
 
     def __init__(self):
@@ -25,4 +25,8 @@ setup(
         'requests',
         'rfc3339',
     ],
+    extras_require={
+        # columnar operation batches (dbsync.batch)
+        'numpy': ['numpy'],
+    },
 )
@@ -0,0 +1,83 @@
+from nose.tools import *
+import uuid
+
+from sqlalchemy import event
+
+from dbsync import models, core
+from dbsync.messages.pull import PullMessage, PullRequestMessage
+from dbsync.server.archive import enable_archive, archive_operations
+from dbsync.server.trim import repair_required
+
+from tests.models import A, Session
+
+
+def setup():
+    pass
+
+@core.with_listening(False)
+def teardown():
+    models.archive_enabled = False
+    session = Session()
+    session.query(models.Operation).delete()
+    session.query(models.Version).delete()
+    session.execute(models.operations_archive.delete())
+    session.commit()
+
+
+def pulled_versions(latest_version_id):
+    request = PullRequestMessage()
+    request.latest_version_id = latest_version_id
+    message = PullMessage()
+    message.fill_for(request)
+    return [op.version_id for op in message.operations]
+
+
+@with_setup(setup, teardown)
+def test_archived_operations_are_pulled():
+    session = Session()
+    content_type_id = core.synched_models.models[A].id
+    for version_id in range(1, 6):
+        session.add(models.Version(version_id=version_id))
+        for _ in range(2):
+            session.add(models.Operation(version_id=version_id,
+                                         row_id=uuid.uuid4(),
+                                         content_type_id=content_type_id,
+                                         command='d'))
+    session.commit()
+
+    enable_archive()
+    assert archive_operations(hot_window=2, batch_size=4) == 6
+    session = Session()
+    assert sorted(set(op.version_id for op in session.query(models.Operation))) == [4, 5]
+
+    assert pulled_versions(4) == [5, 5]
+    assert pulled_versions(1) == [2, 2, 3, 3, 4, 4, 5, 5]
+    assert pulled_versions(None) == [v for v in range(1, 6) for _ in range(2)]
+    assert not repair_required(0)
+
+
+@with_setup(setup, teardown)
+def test_archive_batches_fit_in_sql_variables():
+    session = Session()
+    content_type_id = core.synched_models.models[A].id
+    for version_id in (1, 2):
+        session.add(models.Version(version_id=version_id))
+    session.flush()
+    session.bulk_insert_mappings(models.Operation, [
+        dict(version_id=1, row_id=uuid.uuid4(),
+             content_type_id=content_type_id, command='d')
+        for _ in range(core.MAX_SQL_VARIABLES + 50)])
+    session.commit()
+
+    enable_archive()
+    sizes = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        sizes.append(len(parameters))
+    engine = core.get_engine()
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        moved = archive_operations(hot_window=1, batch_size=5000)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    assert moved == core.MAX_SQL_VARIABLES + 50
+    assert max(sizes) <= core.MAX_SQL_VARIABLES
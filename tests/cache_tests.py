@@ -0,0 +1,139 @@
+from nose.tools import *
+import datetime
+
+from sqlalchemy import event
+
+from dbsync import models, core
+from dbsync.messages.push import PushMessage
+from dbsync.server.cache import cache
+from dbsync.server.handlers import handle_push, preceding_version_id, \
+    PullSuggested
+
+from tests.models import A, B, Session
+
+
+def addstuff():
+    a1 = A(name="first a")
+    a2 = A(name="second a")
+    b1 = B(name="first b", a=a1)
+    session = Session()
+    session.add_all([a1, a2, b1])
+    session.commit()
+
+def setup():
+    pass
+
+@core.with_listening(False)
+def teardown():
+    session = Session()
+    session.query(B).delete()
+    session.query(A).delete()
+    session.query(models.Operation).delete()
+    session.query(models.Version).delete()
+    session.commit()
+    cache.clear()
+
+
+def push_message(latest_version_id):
+    "A signed push of the unversioned operations."
+    session = Session()
+    message = PushMessage()
+    message.latest_version_id = latest_version_id
+    message.add_unversioned_operations()
+    message.set_node(session.query(models.Node).first())
+    session.close()
+    return message.to_json()
+
+
+class recording(object):
+    "Records the statements executed in the context."
+
+    def __enter__(self):
+        self.statements = []
+        event.listen(core.get_engine(), 'before_cursor_execute', self.record)
+        return self.statements
+
+    def __exit__(self, *args):
+        event.remove(core.get_engine(), 'before_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+
+@with_setup(setup, teardown)
+def test_version_bound():
+    cache.clear()
+    session = Session()
+    session.add(models.Version(created=datetime.datetime.now()))
+    session.flush()
+    session.rollback()
+    assert cache.latest_version_id is None
+
+    version = models.Version(created=datetime.datetime.now())
+    session.add(version)
+    session.commit()
+    assert cache.latest_version_id == version.version_id
+    cache.note_version(version.version_id - 1)
+    assert cache.latest_version_id == version.version_id
+
+    # a version dropped in the transaction that created it
+    unused = models.Version(created=datetime.datetime.now())
+    session.add(unused)
+    session.flush()
+    session.delete(unused)
+    session.commit()
+    assert cache.latest_version_id == version.version_id
+
+    session.delete(version)
+    session.commit()
+    assert cache.latest_version_id is None
+
+
+@with_setup(setup, teardown)
+def test_push_rejected_early():
+    addstuff()
+    data = push_message(3)
+    cache.note_version(5)
+    with recording() as statements:
+        assert_raises(PullSuggested, handle_push, data)
+    tables = (models.Version.__tablename__, models.Node.__tablename__,
+              models.Operation.__tablename__)
+    assert not any(table in statement
+                   for statement in statements for table in tables)
+
+
+@with_setup(setup, teardown)
+def test_preceding_version():
+    session = Session()
+    first = models.Version(created=datetime.datetime.now())
+    session.add(first)
+    session.flush()
+    with recording() as statements:
+        assert preceding_version_id(first, None, session) is None
+    assert statements == []
+    second = models.Version(created=datetime.datetime.now())
+    session.add(second)
+    session.flush()
+    # a push based on an outdated version
+    with recording() as statements:
+        assert preceding_version_id(second, None, session) == first.version_id
+    assert len(statements) == 1
+    session.rollback()
+
+
+@with_setup(setup, teardown)
+def test_push_uses_current_secret():
+    addstuff()
+    message = PushMessage(push_message(None))
+    session = Session()
+    assert message.islegit(session)
+    node = session.query(models.Node).first()
+    secret = node.secret
+    node.secret = "changed"
+    session.commit()
+    try:
+        assert not message.islegit(session)
+    finally:
+        node.secret = secret
+        session.commit()
+        session.close()
@@ -1,11 +1,21 @@
+import json
 import logging
 from nose.tools import *
 
 from dbsync import models, core
+import uuid
+
+from dbsync.messages.base import BaseMessage
+from dbsync.messages.codecs import SyncdbJSONEncoder
+from dbsync.client.pull import update_local_ids
 from dbsync.messages.pull import PullMessage
+from dbsync.messages.store import PayloadStore
 from dbsync.client.conflicts import (
     find_direct_conflicts,
-    find_dependency_conflicts)
+    find_dependency_conflicts,
+    related_local_ids_batch,
+    related_remote_ids_batch)
+from dbsync.utils import unique_matches
 
 from tests.models import A, B, Base, Session
 
@@ -101,3 +111,70 @@ def test_find_dependency_conflicts():
     logging.info(conflicts)
     logging.info(expected)
     assert repr(conflicts) == repr(expected)
+
+
+@with_setup(setup, teardown)
+def test_related_ids_batch():
+    addstuff()
+    session = Session()
+    a1, a2 = [session.query(A).filter(A.name == name).one()
+              for name in ("first a", "second a")]
+    ops = [models.Operation(row_id=a.id, content_type_id=ct_a_id, command='d')
+           for a in (a1, a2)]
+    expected = dict(
+        (op, set((b.id, ct_b_id) for b in session.query(B).
+                 filter(B.a_id == op.row_id)))
+        for op in ops)
+    assert [len(expected[op]) for op in ops] == [2, 1]
+    assert related_local_ids_batch(ops, session) == expected
+
+    message = BaseMessage()
+    for b in session.query(B):
+        message.add_object(b)
+    assert related_remote_ids_batch(ops, message) == expected
+
+    # answered through the reference index of a payload store, with
+    # the keys as decoded from a raw message
+    raw = json.loads(json.dumps(message.to_json(), cls=SyncdbJSONEncoder))
+    decoded_ops = [models.Operation(row_id=op.row_id.hex,
+                                    content_type_id=ct_a_id, command='d')
+                   for op in ops]
+    with PayloadStore() as store:
+        related = related_remote_ids_batch(decoded_ops,
+                                           BaseMessage(raw, store=store))
+        assert related == related_remote_ids_batch(decoded_ops,
+                                                   BaseMessage(raw))
+        assert [len(related[op]) for op in decoded_ops] == [2, 1]
+
+
+@with_setup(setup, teardown)
+def test_unique_matches():
+    addstuff()
+    session = Session()
+    matches = unique_matches(
+        A, ('name',), [("first a",), ("missing a",), (None,)], session)
+    assert list(matches) == [("first a",)]
+    assert matches[("first a",)].name == "first a"
+
+    matches = unique_matches(
+        B, ('name', 'data'),
+        [("first b", None), ("second b", "x"), ("third b", None)], session)
+    assert sorted(matches) == [("first b", None), ("third b", None)]
+
+
+@with_setup(setup, teardown)
+def test_update_local_ids():
+    addstuff()
+    session = Session()
+    a1, a2 = [session.query(A).filter(A.name == name).one()
+              for name in ("first a", "second a")]
+    new_ids = {a1.id: uuid.uuid4(), a2.id: uuid.uuid4()}
+    children = dict((a.id, sorted(b.name for b in a.bs)) for a in (a1, a2))
+    update_local_ids(new_ids, A, session)
+    session.commit()
+
+    session = Session()
+    for old_id, new_id in new_ids.items():
+        assert session.query(A).get(old_id) is None
+        assert sorted(b.name for b in session.query(B).
+                      filter(B.a_id == new_id)) == children[old_id]
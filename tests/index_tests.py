@@ -0,0 +1,33 @@
+from nose.tools import *
+
+from dbsync import core
+from dbsync.models import Operation, UNVERSIONED_INDEX
+from dbsync.indexes import missing_indexes, upgrade_indexes
+
+import tests.models # sets the engine up
+
+
+def setup():
+    pass
+
+def teardown():
+    pass
+
+
+@with_setup(setup, teardown)
+def test_upgrade_indexes():
+    engine = core.get_engine()
+    assert missing_indexes(engine) == []
+    for index in Operation.__table__.indexes:
+        index.drop(engine)
+    engine.execute("DROP INDEX {0}".format(UNVERSIONED_INDEX))
+    missing = missing_indexes(engine)
+    assert set(missing) == set([UNVERSIONED_INDEX]) | \
+        set(index.name for index in Operation.__table__.indexes)
+    assert upgrade_indexes(engine) == missing
+    assert missing_indexes(engine) == []
+    plan = engine.execute(
+        "EXPLAIN QUERY PLAN SELECT * FROM {0} WHERE version_id IS NULL "
+        "ORDER BY \"order\"".format(Operation.__tablename__)).fetchall()
+    assert any("USING" in row[-1] for row in plan)
+    assert not any("TEMP B-TREE" in row[-1] for row in plan)
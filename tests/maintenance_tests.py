@@ -0,0 +1,95 @@
+import asyncio
+import datetime
+
+from nose.tools import *
+
+from dbsync import models, core
+from dbsync.client import maintenance
+from dbsync.client.maintenance import Maintenance
+
+from tests.models import A, Session
+
+
+def setup():
+    pass
+
+
+@core.with_listening(False)
+def teardown():
+    session = Session()
+    session.query(A).delete()
+    session.query(models.Operation).delete()
+    session.query(models.Version).delete()
+    session.commit()
+
+
+def addversions(count):
+    session = Session()
+    for _ in range(count):
+        session.add(A(name="a"))
+        session.commit()
+        version = models.Version(created=datetime.datetime.now())
+        session.add(version)
+        session.flush()
+        session.query(models.Operation).\
+            filter(models.Operation.version_id == None).\
+            update({'version_id': version.version_id},
+                   synchronize_session=False)
+        session.commit()
+    session.add(A(name="unversioned"))
+    session.commit()
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+@with_setup(setup, teardown)
+def test_maintenance_purges_versioned_data():
+    addversions(5)
+    latest = core.get_latest_version_id()
+    job = Maintenance(budget=60)
+    job.request()
+    assert job.due()
+    report = run(job.run())
+    assert report.finished
+    assert report.analyzed
+    assert report.operations == 5
+    assert report.versions == 4
+    session = Session()
+    assert [v.version_id for v in session.query(models.Version)] == [latest]
+    assert session.query(models.Operation).count() == 1
+    assert not job.due()
+
+
+@with_setup(setup, teardown)
+def test_maintenance_resumes_within_budget():
+    addversions(5)
+    batch_size = maintenance.MAINTENANCE_BATCH_SIZE
+    maintenance.MAINTENANCE_BATCH_SIZE = 2
+    try:
+        job = Maintenance(budget=0)
+        job.request()
+        report = run(job.run())
+        assert not report.finished
+        assert report.steps == 1
+        assert job.due()
+        runs = 1
+        while not report.finished:
+            report = run(job.run())
+            runs += 1
+        assert runs > 3
+        assert report.operations == 5
+        assert report.versions == 4
+    finally:
+        maintenance.MAINTENANCE_BATCH_SIZE = batch_size
+
+
+@with_setup(setup, teardown)
+def test_maintenance_waits_for_idle():
+    addversions(2)
+    job = Maintenance(budget=60, idle=lambda: False)
+    job.request()
+    report = run(job.run())
+    assert report.steps == 0
+    assert Session().query(models.Version).count() == 2
@@ -0,0 +1,161 @@
+from nose.tools import *
+
+from dbsync import models, core
+from dbsync.utils import get_pk
+from dbsync.messages.base import BaseMessage
+from dbsync.client.repair import (
+    begin_streamed_repair,
+    pending_repair,
+    repair_dependencies,
+    load_repair_chunk,
+    finish_repair_model,
+    finish_streamed_repair,
+    local_merkle_tree,
+    repair_buckets)
+from dbsync.merkle import MerkleTree, bucket, _canonical
+from dbsync.server import handlers
+
+from tests.models import A, B, Session
+
+
+def addstuff():
+    a1 = A(name="first a")
+    a2 = A(name="second a")
+    b1 = B(name="first b", a=a1)
+    b2 = B(name="second b", a=a1)
+    b3 = B(name="third b", a=a2)
+    session = Session()
+    session.add_all([a1, a2, b1, b2, b3])
+    session.commit()
+
+def setup():
+    pass
+
+@core.with_listening(False)
+def teardown():
+    session = Session()
+    for b in session.query(B).all():
+        session.delete(b)
+    for a in session.query(A).all():
+        session.delete(a)
+    for op in session.query(models.Operation).all():
+        session.delete(op)
+    for version in session.query(models.Version).all():
+        session.delete(version)
+    session.commit()
+
+
+def chunks_for(model, session):
+    "Single object chunks, as the server would send them."
+    pk = get_pk(model)
+    return [(BaseMessage().add_object(obj).to_json()['payload'][model.__name__],
+             getattr(obj, pk))
+            for obj in session.query(model).order_by(getattr(model, pk))]
+
+
+def test_repair_dependencies():
+    assert repair_dependencies() == {'A': [], 'B': ['A']}
+
+
+@with_setup(setup, teardown)
+def test_streamed_repair():
+    addstuff()
+    session = Session()
+    expected = dict((model, sorted(o.name for o in session.query(model)))
+                    for model in (A, B))
+    chunks = dict((model.__name__, chunks_for(model, session))
+                  for model in (A, B))
+    session.close()
+
+    begin_streamed_repair()
+    session = Session()
+    assert session.query(A).count() == session.query(B).count() == 0
+    assert session.query(models.Operation).count() == 0
+    session.close()
+    assert pending_repair() == {'A': None, 'B': None}
+
+    # an interrupted repair leaves the cursor at the last chunk loaded
+    objects, last = chunks['A'][0]
+    load_repair_chunk('A', objects, last)
+    pending = pending_repair()
+    assert pending['A'] is not None and pending['B'] is None
+
+    for objects, last in chunks['A'][1:]:
+        load_repair_chunk('A', objects, last)
+    finish_repair_model('A', 3)
+    for objects, last in chunks['B']:
+        load_repair_chunk('B', objects, last)
+    finish_repair_model('B', 2)
+    assert pending_repair() == {}
+
+    assert finish_streamed_repair() == 2
+    session = Session()
+    for model in (A, B):
+        assert sorted(o.name for o in session.query(model)) == expected[model]
+    # bulk inserts aren't tracked
+    assert session.query(models.Operation).count() == 0
+    assert session.query(models.RepairCursor).count() == 0
+    assert [v.version_id for v in session.query(models.Version)] == [2]
+
+
+@with_setup(setup, teardown)
+def test_differential_repair():
+    addstuff()
+    session = Session()
+    expected = sorted((b.id, b.name, b.a_id) for b in session.query(B))
+    server = MerkleTree.for_model(B, session.connection())
+    objects = chunks_for(B, session)
+    session.close()
+    assert local_merkle_tree('B', server.depth).root == server.root
+
+    session = Session()
+    session.query(B).filter(B.name == "first b").one().name = "changed b"
+    session.delete(session.query(B).filter(B.name == "third b").one())
+    session.add(B(name="local b", a_id=expected[0][2]))
+    session.commit()
+
+    local = local_merkle_tree('B', server.depth)
+    assert local.root != server.root
+    prefixes = [""]
+    for _ in range(server.depth):
+        prefixes = local.differing(prefixes, server.children(prefixes))
+    assert prefixes
+    rows = [obj for chunk, _ in objects for obj in chunk
+            if bucket(_canonical(obj['id']), server.depth) in prefixes]
+    assert repair_buckets('B', prefixes, server.depth, rows) > 0
+
+    session = Session()
+    assert sorted((b.id, b.name, b.a_id) for b in session.query(B)) == expected
+    assert local_merkle_tree('B', server.depth).root == server.root
+
+
+@with_setup(setup, teardown)
+def test_merkle_requests():
+    addstuff()
+    handlers._merkle_trees.clear()
+    session = Session()
+    session.add(models.Version(version_id=1))
+    session.commit()
+    trees = {}
+    answer = handlers.handle_merkle_request(
+        dict(type="tree", model="B"), trees, session=session)
+    assert answer['count'] == 3 and answer['latest_version_id'] == 1
+    tree = trees['B']
+    # the tree is kept until a new version is created
+    assert handlers.handle_merkle_request(
+        dict(type="tree", model="B"), {}, session=session) == answer
+    assert handlers.merkle_tree(B, session)[0] is tree
+    session.add(models.Version(version_id=2))
+    session.commit()
+    assert handlers.merkle_tree(B, session)[0] is not tree
+
+    buckets = sorted(tree.levels[tree.depth])
+    pks = tree.bucket_pks(B, buckets)
+    assert len(pks) == 3
+    assert session.query(B).filter(B.id.in_(pks)).count() == 3
+    rows = handlers.handle_merkle_request(
+        dict(type="rows", model="B", buckets=buckets[:1]), trees,
+        session=session)['objects']
+    assert rows and all(bucket(_canonical(obj['id']), tree.depth) == buckets[0]
+                        for obj in rows)
+    session.close()
@@ -0,0 +1,65 @@
+from nose.tools import *
+import dataclasses
+
+from dbsync import models, core
+from dbsync.messages.push import PushMessage
+from dbsync.server.conflicts import find_unique_conflicts
+
+from tests.models import A, B, Session
+
+
+def addstuff():
+    a1 = A(name="first a")
+    b1 = B(name="first b", a=a1)
+    b2 = B(name="second b", a=a1)
+    b3 = B(name="third b", a=a1)
+    session = Session()
+    session.add_all([a1, b1, b2, b3])
+    session.commit()
+
+def setup():
+    pass
+
+@core.with_listening(False)
+def teardown():
+    session = Session()
+    session.query(B).delete()
+    session.query(A).delete()
+    session.query(models.Operation).delete()
+    session.commit()
+
+
+@with_setup(setup, teardown)
+def test_unique_conflicts():
+    addstuff()
+    message = PushMessage()
+    message.latest_version_id = None
+    message.add_unversioned_operations()
+    session = Session()
+    message.set_node(session.query(models.Node).first())
+    message = PushMessage(message.to_json())
+
+    # the pushed objects swapped their names in the database
+    b1 = session.query(B).filter(B.name == "first b").one()
+    b2 = session.query(B).filter(B.name == "second b").one()
+    b2_id = b2.id
+    with core.committing_context() as other:
+        other.query(B).filter(B.id == b1.id).update({'name': "swap"})
+        other.query(B).filter(B.id == b2.id).update({'name': "first b"})
+    session.close()
+
+    # the test models have no unique constraints
+    meta = core.synched_models.metadata[B]
+    core.synched_models.metadata[B] = dataclasses.replace(
+        meta, unique=(('name',),))
+    session = Session()
+    try:
+        conflicts = find_unique_conflicts(message, session)
+    finally:
+        core.synched_models.metadata[B] = meta
+    assert len(conflicts) == 1
+    conflict = conflicts[0]
+    assert conflict['object'].id == b2_id
+    assert conflict['columns'] == ('name',)
+    assert conflict['new_values'] == ("second b",)
+    session.close()
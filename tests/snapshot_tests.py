@@ -0,0 +1,127 @@
+from nose.tools import *
+import asyncio
+import datetime
+import os
+import tempfile
+import time
+
+from dbsync import models, core
+from dbsync.server import snapshot
+from dbsync.server.snapshot import build_snapshot, refresh_snapshot, \
+    snapshot_version, ensure_snapshot, COMPRESSED_SUFFIX
+from dbsync.client.snapshot import load_snapshot
+
+from tests.models import A, B, Session
+
+
+def version_operations():
+    "Assigns a new version to the unversioned operations."
+    session = Session()
+    version = models.Version(created=datetime.datetime.now())
+    session.add(version)
+    session.flush()
+    version_id = version.version_id
+    for op in session.query(models.Operation).\
+            filter(models.Operation.version_id == None):
+        op.version_id = version_id
+    session.commit()
+    return version_id
+
+def addstuff():
+    a1 = A(name="first a")
+    a2 = A(name="second a")
+    b1 = B(name="first b", a=a1)
+    b2 = B(name="second b", a=a1)
+    b3 = B(name="third b", a=a2)
+    session = Session()
+    session.add_all([a1, a2, b1, b2, b3])
+    session.commit()
+    return version_operations()
+
+def changestuff():
+    session = Session()
+    a1 = session.query(A).filter(A.name == "first a").one()
+    a1.name = "first a modified"
+    session.delete(session.query(B).filter(B.name == "third b").one())
+    session.add(B(name="fourth b", a=a1))
+    session.commit()
+    return version_operations()
+
+def contents():
+    session = Session()
+    return dict((model, sorted(o.name for o in session.query(model)))
+                for model in (A, B))
+
+def setup():
+    pass
+
+@core.with_listening(False)
+def teardown():
+    session = Session()
+    for b in session.query(B).all():
+        session.delete(b)
+    for a in session.query(A).all():
+        session.delete(a)
+    for op in session.query(models.Operation).all():
+        session.delete(op)
+    for version in session.query(models.Version).all():
+        session.delete(version)
+    session.commit()
+
+
+@with_setup(setup, teardown)
+def test_snapshot_refresh_and_load():
+    path = tempfile.mktemp(suffix=".db")
+    try:
+        first = addstuff()
+        assert build_snapshot(path) == first
+        assert os.path.exists(path + COMPRESSED_SUFFIX)
+
+        second = changestuff()
+        expected = contents()
+        assert refresh_snapshot(path) == second
+        assert snapshot_version(path) == second
+
+        load_snapshot(path)
+        assert contents() == expected
+        session = Session()
+        assert session.query(models.Operation).count() == 0
+        assert [v.version_id for v in session.query(models.Version)] == [second]
+    finally:
+        for p in (path, path + COMPRESSED_SUFFIX):
+            if os.path.exists(p):
+                os.remove(p)
+
+
+@with_setup(setup, teardown)
+def test_concurrent_requests_build_one_snapshot():
+    path = tempfile.mktemp(suffix=".db")
+    builds = []
+    ticks = []
+    def counting_build(path):
+        builds.append(path)
+        time.sleep(0.05) # a long build
+        return build(path)
+    async def ticker():
+        while not os.path.exists(path + COMPRESSED_SUFFIX):
+            ticks.append(None)
+            await asyncio.sleep(0.001)
+    async def requests():
+        return await asyncio.gather(ensure_snapshot(path),
+                                    ensure_snapshot(path), ticker())
+    build = snapshot.build_snapshot
+    snapshot.build_snapshot = counting_build
+    try:
+        first = addstuff()
+        versions = asyncio.get_event_loop().run_until_complete(requests())
+        assert versions[:2] == [first, first]
+        assert builds == [path]
+        assert len(ticks) > 1 # the event loop wasn't blocked by the build
+        assert not [name for name in os.listdir(os.path.dirname(path))
+                    if name.startswith(os.path.basename(path)) and
+                    name.endswith(".tmp")]
+    finally:
+        snapshot.build_snapshot = build
+        for p in (path, path + COMPRESSED_SUFFIX):
+            if os.path.exists(p):
+                os.remove(p)
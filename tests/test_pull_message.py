@@ -1,12 +1,17 @@
 from nose.tools import *
+import asyncio
 import datetime
 import logging
 import json
+import os
+import time
 
 from dbsync.lang import *
 from dbsync import models, core
 from dbsync.messages.codecs import SyncdbJSONEncoder
 from dbsync.messages.pull import PullMessage
+from dbsync.messages.store import PayloadStore
+from dbsync.client.pull import MergeStats, _Cooperative
 
 from tests.models import A, B, Session
 
@@ -104,3 +109,121 @@ def test_message_does_not_contaminate_database():
     # test that the are no unversioned operations
     assert not session.query(models.Operation).\
         filter(models.Operation.version_id == None).all()
+
+
+@with_setup(setup, teardown)
+def test_decoded_operations_are_records():
+    addstuff()
+    session = Session()
+    message = PullMessage()
+    version = session.query(models.Version).first()
+    message.add_version(version)
+    decoded = PullMessage(message.to_json())
+    assert decoded.operations
+    for op in decoded.operations:
+        assert isinstance(op, models.OperationRecord)
+        assert not hasattr(op, '__dict__')
+        assert op.tracked_model in (A, B)
+    ops = [op.to_operation() for op in decoded.operations]
+    assert all(isinstance(op, models.Operation) for op in ops)
+    assert [op.to_dict() for op in ops] == \
+        [op.to_dict() for op in decoded.operations]
+
+
+@with_setup(setup, teardown)
+def test_message_query_with_store():
+    addstuff()
+    session = Session()
+    message = PullMessage()
+    version = session.query(models.Version).first()
+    message.add_version(version)
+    raw = json.loads(json.dumps(message.to_json(), cls=SyncdbJSONEncoder))
+    in_memory = PullMessage(raw)
+    with PayloadStore(cache_size=2) as store:
+        stored = PullMessage(raw, store=store)
+        assert stored.payload is store
+        assert set(store) == set(in_memory.payload)
+        for b in in_memory.query(B):
+            assert repr(b) == repr(stored.query(B).filter(
+                    attr('__pk__') == b.id).first())
+        for a in in_memory.query(A):
+            # foreign key lookup through the store's index
+            expected = sorted(repr(b) for b in in_memory.query(B).filter(
+                    attr('a_id') == a.id))
+            assert expected
+            assert expected == sorted(repr(b) for b in stored.query(B).filter(
+                    attr('a_id') == a.id))
+        assert stored.query(B).filter(
+            attr('name') == "third b").first().name == "third b"
+        for model in (A, B):
+            assert sorted(map(repr, stored.query(model))) == \
+                sorted(map(repr, in_memory.query(model)))
+    assert not os.path.exists(store.path)
+
+
+@with_setup(setup, teardown)
+def test_payload_in_chunks():
+    addstuff()
+    session = Session()
+    message = PullMessage()
+    message.add_version(session.query(models.Version).first())
+    raw = json.loads(json.dumps(message.to_json(), cls=SyncdbJSONEncoder))
+    payload = raw.pop('payload')
+    raw['payload'] = {}
+    in_memory = PullMessage(dict(raw, payload=payload))
+    b_ids = [b.id for b in in_memory.query(B)]
+    with PayloadStore(cache_size=2) as store:
+        for target in (PullMessage(raw), PullMessage(raw, store=store)):
+            for name, objects in payload.items():
+                for chunk in grouper(objects, 2):
+                    target.add_encoded(name, chunk)
+            for model in (A, B):
+                assert sorted(map(repr, target.query(model))) == \
+                    sorted(map(repr, in_memory.query(model)))
+            found = target.get_objects(B, b_ids[:2] + [None])
+            assert sorted(found) == sorted(b_ids[:2])
+            assert all(repr(found[pk]) == repr(
+                in_memory.query(B).filter(attr('__pk__') == pk).first())
+                       for pk in found)
+
+
+def test_cooperative_merge_checkpoints():
+    async def run():
+        cooperative = _Cooperative(MergeStats(), interval=0.01)
+        await cooperative.checkpoint() # too soon, no yield
+        time.sleep(0.02)
+        await cooperative.checkpoint()
+        return cooperative.finish()
+
+    stats = asyncio.run(run())
+    assert stats.yields == 1
+    assert stats.max_blocking >= 0.02
+    assert stats.duration >= stats.max_blocking
+
+
+def test_cooperative_merge_batches():
+    def step(batch):
+        time.sleep(0.02)
+        return [item * 2 for item in batch]
+
+    async def run():
+        cooperative = _Cooperative(MergeStats(), interval=0.01)
+        results = await cooperative.batched(step, range(5), batch_size=2)
+        return results, cooperative.finish()
+
+    results, stats = asyncio.run(run())
+    assert results == [0, 2, 4, 6, 8]
+    assert stats.yields == 3 # after each batch
+    assert stats.max_blocking < 0.04
+
+
+def test_cooperative_merge_waits():
+    async def run():
+        cooperative = _Cooperative(MergeStats(), interval=1)
+        # time spent suspended isn't blocking
+        await cooperative.wait(asyncio.sleep(0.05))
+        return cooperative.finish()
+
+    stats = asyncio.run(run())
+    assert stats.max_blocking < 0.05
+    assert stats.duration >= 0.05
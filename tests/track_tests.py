@@ -1,13 +1,24 @@
 import logging
+import time
+import uuid
+
+from sqlalchemy import event, select
 from nose.tools import *
 
 from dbsync.lang import *
 from dbsync import models, core, client
+from dbsync.client import tracking
 from dbsync.client.compression import (
     compress,
     compressed_operations,
     unsynched_objects)
 
+from dbsync.client.status import sync_status, model_status, \
+    pending_summary, counter
+from dbsync.client.ordering import OrderAllocator, ORDER_GAP
+from dbsync.client.triggers import enable_trigger_tracking, \
+    disable_trigger_tracking
+
 from tests.models import A, B, Base, Session
 
 
@@ -150,3 +161,395 @@ def test_compression_correctness():
     assert compressed[3].command == 'd'
     assert compressed[4].command == 'u'
     assert compressed[5].command == 'u'
+
+
+def test_batch_compression_matches_compressed_operations():
+    from dbsync import batch
+    if not batch.available:
+        return
+    commands = ['i', 'u', 'd']
+    ops = [models.OperationRecord(command=commands[(n * 7 + k) % 3],
+                                  content_type_id=n % 4, row_id=n, order=o)
+           for o, (n, k) in enumerate(((n, k)
+                                       for n in range(200)
+                                       for k in range(n % 5 + 1)), 1)]
+    previous = batch.MIN_BATCH_SIZE
+    try:
+        batch.MIN_BATCH_SIZE = len(ops) + 1
+        expected = compressed_operations(ops)
+        batch.MIN_BATCH_SIZE = 1
+        compressed = compressed_operations(ops)
+    finally:
+        batch.MIN_BATCH_SIZE = previous
+    assert [(op.order, op.command) for op in compressed] == \
+        [(op.order, op.command) for op in expected]
+
+
+def test_synched_models_metadata():
+    meta = core.synched_models.metadata
+    assert core.synched_models.order == (A, B)
+    assert meta[A].pk == meta[B].pk == 'id'
+    assert meta[A].children == ((B, ('a_id',)),)
+    assert meta[B].parents == ((A, 'a_id'),)
+    assert meta[A].parents == meta[B].children == ()
+    b = B(name="b", a_id="x")
+    assert core.synched_models.parent_references(b) == [(A, "x")]
+
+
+@with_setup(setup, teardown)
+def test_order_allocator_leaves_a_gap():
+    addstuff()
+    session = Session()
+    ops = session.query(models.Operation).\
+        order_by(models.Operation.order).all()
+    rows = [(op.row_id, op.command) for op in ops]
+    orders = OrderAllocator(ops, session)
+    keys = [orders.before() for _ in range(3)]
+    session.flush()
+    first = min(op.order for op in ops)
+    assert keys == sorted(keys) and keys[-1] < first
+    assert first - keys[0] > ORDER_GAP - 3
+    # the operations were moved once, keeping their order
+    assert [(op.row_id, op.command) for op in session.query(models.Operation).
+            order_by(models.Operation.order)] == rows
+    session.rollback()
+
+
+@with_setup(setup, teardown)
+def test_sync_transaction_keeps_readers():
+    engine = core.get_engine()
+    foreign_keys = engine.execute("PRAGMA foreign_keys;").scalar()
+
+    @core.with_transaction()
+    def write(session=None):
+        assert engine.execute("PRAGMA journal_mode;").scalar() == 'wal'
+        assert session.execute("PRAGMA foreign_keys;").scalar() == 0
+        session.add(A(name="written a"))
+        session.flush()
+        # other connections keep reading the last committed state
+        assert engine.execute(A.__table__.count()).scalar() == 0
+
+    write()
+    assert engine.execute("PRAGMA foreign_keys;").scalar() == foreign_keys
+    session = Session()
+    assert [a.name for a in session.query(A)] == ["written a"]
+    session.close()
+
+
+@with_setup(setup, teardown)
+def test_sync_transaction_without_writes():
+    @core.with_transaction()
+    def nothing(fail, session=None):
+        if fail:
+            raise ValueError(fail)
+
+    nothing(False)
+    assert_raises(ValueError, nothing, True)
+    session = Session()
+    session.add(A(name="written a"))
+    session.commit()
+    session.close()
+
+
+@with_setup(setup, teardown)
+def test_trigger_tracking():
+    enable_trigger_tracking()
+    try:
+        engine = core.get_engine()
+        addstuff()
+        session = Session()
+        assert session.query(models.Operation).count() == 5 # not tracked twice
+        a_ids = [a.id for a in session.query(A)]
+        session.close()
+
+        # core statements are tracked, unchanged rows aren't
+        engine.execute(A.__table__.update().values(name=A.__table__.c.name))
+        engine.execute(A.__table__.update().
+                       where(A.__table__.c.name == "first a").
+                       values(name="first a modified"))
+        engine.execute(B.__table__.delete())
+        # internal sessions aren't
+        internal = core.Session()
+        internal.add(A(name="internal a"))
+        internal.commit()
+
+        session = Session()
+        ops = session.query(models.Operation).\
+            order_by(models.Operation.order).all()
+        assert [op.command for op in ops] == ['i'] * 5 + ['u'] + ['d'] * 3
+        assert ops[5].row_id in a_ids
+        session.close()
+    finally:
+        disable_trigger_tracking()
+
+
+@with_setup(setup, teardown)
+def test_trigger_tracking_counter():
+    enable_trigger_tracking()
+    try:
+        counter.invalidate()
+        assert counter.summary() == {}
+        addstuff()
+        assert counter.summary() == {A: 2, B: 3}
+        core.get_engine().execute(A.__table__.insert().values(
+            id=uuid.uuid4(), name="third a"))
+        assert counter.summary() == {A: 3, B: 3}
+    finally:
+        disable_trigger_tracking()
+        counter.invalidate()
+
+
+@with_setup(setup, teardown)
+def test_statement_tracking():
+    engine = core.get_engine()
+    table = A.__table__
+    engine.execute(table.insert().values([{'name': "first a"},
+                                          {'name': "second a"}]))
+    session = Session()
+    session.bulk_insert_mappings(A, [{'name': "third a"}])
+    a_id = session.query(A.id).filter(A.name == "third a").scalar()
+    session.bulk_update_mappings(A, [{'id': a_id, 'name': "third a modified"}])
+    session.add(A(name="fourth a")) # tracked by the listeners only
+    session.commit()
+    engine.execute(table.delete().where(table.c.name.like("%a")))
+    # internal sessions aren't tracked
+    internal = core.Session()
+    internal.execute(table.insert().values(name="internal a"))
+    internal.commit()
+
+    session = Session()
+    ops = session.query(models.Operation).\
+        order_by(models.Operation.order).all()
+    assert [op.command for op in ops] == ['i'] * 3 + ['u', 'i'] + ['d'] * 3
+    assert ops[3].row_id == a_id
+    assert set(op.row_id for op in ops[5:]) == \
+        set(op.row_id for op in ops if op.command == 'i') - set([a_id])
+
+
+@with_setup(setup, teardown)
+def test_statement_tracking_of_generated_keys():
+    engine = core.get_engine()
+    table = A.__table__
+    default = table.c.id.default
+    # the key of test_a generated by the database instead
+    table.c.id.default = None
+    table.drop(engine)
+    engine.execute("CREATE TABLE test_a (id CHAR(32) PRIMARY KEY "
+                   "DEFAULT (lower(hex(randomblob(16)))), name VARCHAR)")
+    try:
+        engine.execute(table.insert().values(name="first a"))
+        with engine.begin() as connection:
+            connection.execute(table.insert(), {'name': "second a"})
+
+        session = Session()
+        ops = session.query(models.Operation).\
+            order_by(models.Operation.order).all()
+        assert [op.command for op in ops] == ['i', 'i']
+        assert set(op.row_id for op in ops) == \
+            set(a.id for a in session.query(A))
+        session.close()
+    finally:
+        table.c.id.default = default
+        table.drop(engine)
+        table.create(engine)
+
+
+@with_setup(setup, teardown)
+def test_statement_tracking_of_multirow_inserts():
+    engine = core.get_engine()
+    table = B.__table__
+    engine.execute(A.__table__.insert(), [{'name': "first a"},
+                                          {'name': "second a"}])
+    session = Session()
+    a_ids = set(a.id for a in session.query(A))
+    assert set(op.row_id for op in session.query(models.Operation)) == a_ids
+    engine.execute(table.insert().from_select(
+        ['id', 'name'],
+        select([A.__table__.c.id, A.__table__.c.name])))
+    # without the key in the select, the statement isn't tracked
+    engine.execute(table.insert().from_select(
+        ['name'], select([A.__table__.c.name]).limit(1)))
+
+    b_ops = session.query(models.Operation).\
+        filter(models.Operation.content_type_id ==
+               core.synched_models.models[B].id).all()
+    assert session.query(B).count() == 3
+    assert [op.command for op in b_ops] == ['i', 'i']
+    assert set(op.row_id for op in b_ops) == a_ids
+
+
+@with_setup(setup, teardown)
+def test_compacted_log():
+    tracking.COMPACT_LOG = True
+    try:
+        session = Session()
+        a1 = A(name="first a")
+        a2 = A(name="second a")
+        session.add_all([a1, a2])
+        session.commit()
+        for i in range(3):
+            a1.name = "first a {0}".format(i)
+            session.commit()
+        session.delete(a2)
+        session.commit()
+        ops = session.query(models.Operation).all()
+        assert [(op.command, op.row_id) for op in ops] == [('i', a1.id)]
+
+        internal = core.Session()
+        version = models.Version()
+        internal.add(version)
+        internal.flush()
+        internal.query(models.Operation).update(
+            {'version_id': version.version_id}, synchronize_session=False)
+        internal.commit()
+        a1.name = "first a modified"
+        session.commit()
+        a1.name = "first a modified again"
+        session.commit()
+        unversioned = session.query(models.Operation).\
+            filter(models.Operation.version_id == None)
+        assert [op.command for op in unversioned] == ['u']
+        session.delete(a1)
+        session.commit()
+        assert [op.command for op in unversioned] == ['d']
+    finally:
+        tracking.COMPACT_LOG = False
+
+
+@with_setup(setup, teardown)
+def test_operations_flushed_in_bulk():
+    inserts = []
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("INSERT INTO sync_operations"):
+            inserts.append(statement)
+    engine = core.get_engine()
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        session = Session()
+        session.add_all([A(name="a {0}".format(i)) for i in range(50)])
+        session.commit()
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    assert len(inserts) == 1
+    assert session.query(models.Operation).count() == 50
+
+
+@with_setup(setup, teardown)
+def test_version_queries_are_lean():
+    session = Session()
+    session.add_all([A(name="a {0}".format(i)) for i in range(200)])
+    session.commit()
+    internal = core.Session()
+    version = models.Version()
+    internal.add(version)
+    internal.flush()
+    internal.query(models.Operation).update(
+        {'version_id': version.version_id}, synchronize_session=False)
+    internal.commit()
+
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    engine = core.get_engine()
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        start = time.perf_counter()
+        for _ in range(20):
+            assert core.get_latest_version_id() == version.version_id
+        elapsed = time.perf_counter() - start
+        versions = core.Session().query(models.Version).all()
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    assert len(statements) == 21
+    assert not any(models.Operation.__tablename__ in s for s in statements)
+    assert [v.version_id for v in versions] == [version.version_id]
+    assert elapsed < 1
+
+    statements[:] = []
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        versions = core.Session().query(models.Version).\
+            options(models.with_operations()).all()
+        assert len(versions[0].operations) == 200
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    assert len(statements) == 2
+
+
+@with_setup(setup, teardown)
+def test_batch_sync_status():
+    addstuff()
+    session = Session()
+    a1, a2 = session.query(A).order_by(A.name).all()
+    bs = session.query(B).all()
+    internal = core.Session()
+    version = models.Version()
+    internal.add(version)
+    internal.flush()
+    internal.query(models.Operation).\
+        filter(models.Operation.row_id == a2.id).\
+        update({'version_id': version.version_id}, synchronize_session=False)
+    internal.commit()
+    a1.name = "first a modified"
+    a2.name = "second a modified"
+    session.commit()
+    session.delete(bs[0])
+    session.commit()
+
+    queries = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+    engine = core.get_engine()
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        statuses = sync_status([a1, a2, A(name="new")] + bs)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    assert len(queries) == 2 # one per model
+    # the first b was inserted and deleted
+    assert statuses == ['i', 'u', 'i', None, 'i', 'i']
+    assert model_status(A) == {a1.id: 'i', a2.id: 'u'}
+    assert core.is_synched(a2) is False
+
+    assert pending_summary() == {A: 2, B: 3}
+    counter.invalidate()
+    assert counter.summary() == {A: 2, B: 3}
+    session.add(A(name="third a"))
+    session.commit()
+    assert counter.summary() == {A: 3, B: 3}
+    assert counter.is_pending(a1)
+    session.execute(A.__table__.insert().values(id=uuid.uuid4(), name="core a"))
+    assert counter.summary() == {A: 3, B: 3}
+    session.commit()
+    assert counter.summary() == pending_summary() == {A: 4, B: 3}
+    session.query(models.Operation).\
+        update({'version_id': version.version_id}, synchronize_session=False)
+    session.commit()
+    assert counter.summary() == pending_summary() == {}
+
+
+@with_setup(setup, teardown)
+def test_pending_counter_load_race():
+    addstuff()
+    content_type_id = core.synched_models.models[A].id
+    added = uuid.uuid4()
+    during_load = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if "DISTINCT" in statement and during_load:
+            during_load.pop()()
+    engine = core.get_engine()
+    event.listen(engine, 'after_cursor_execute', record)
+    try:
+        # an operation committed while the counter loads isn't lost
+        counter.invalidate()
+        during_load.append(lambda: counter.add(content_type_id, [added]))
+        assert counter.summary() == {A: 3, B: 3}
+        assert counter.summary() == {A: 3, B: 3}
+        # a load that began before an invalidation isn't kept
+        counter.invalidate()
+        during_load.append(counter.invalidate)
+        assert counter.summary() == {A: 2, B: 3}
+        assert counter._rows is None
+    finally:
+        event.remove(engine, 'after_cursor_execute', record)
+    assert counter.summary() == pending_summary() == {A: 2, B: 3}
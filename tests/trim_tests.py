@@ -0,0 +1,110 @@
+from nose.tools import *
+import datetime
+
+from sqlalchemy import event
+
+from dbsync import models, core
+from dbsync.server.trim import trim, repair_required
+
+from tests.models import Session
+
+
+def setup():
+    pass
+
+@core.with_listening(False)
+def teardown():
+    session = Session()
+    session.query(models.Operation).delete()
+    session.query(models.Version).delete()
+    session.query(models.TrimMark).delete()
+    session.query(models.Node).\
+        filter(models.Node.node_id != session.query(models.Node.node_id).\
+               order_by(models.Node.node_id).limit(1).scalar()).delete()
+    session.commit()
+
+
+@with_setup(setup, teardown)
+def test_trim_ignores_stale_nodes():
+    now = datetime.datetime.now()
+    old = now - datetime.timedelta(days=60)
+    session = Session()
+    active = session.query(models.Node).first()
+    stale = models.Node(registered=old, secret="secret")
+    session.add(stale)
+    session.flush()
+    pushers = [stale.node_id, None, active.node_id, None, None]
+    for version_id, node_id in enumerate(pushers, 1):
+        session.add(models.Version(version_id=version_id, node_id=node_id,
+                                   created=old if node_id == stale.node_id else now))
+        for _ in range(3):
+            session.add(models.Operation(version_id=version_id, row_id=None,
+                                         content_type_id=1, command='u'))
+    session.commit()
+    assert not repair_required(None)
+
+    result = trim(batch_size=2, now=now)
+    assert result.watermark == 3
+    assert result.stale_nodes == [stale.node_id]
+    assert result.operations == 9
+    assert result.versions == 2
+    session = Session()
+    assert sorted(set(op.version_id for op in session.query(models.Operation))) == [4, 5]
+    assert [v.version_id for v in session.query(models.Version).\
+            order_by(models.Version.version_id)] == [3, 4, 5]
+    assert repair_required(1)
+    assert not repair_required(3)
+    # the history is incomplete for a node that never pulled
+    assert repair_required(None)
+
+
+@with_setup(setup, teardown)
+def test_repair_required_with_version_gaps():
+    now = datetime.datetime.now()
+    session = Session()
+    node = session.query(models.Node).first()
+    # the versions before 4 and version 6 were rolled back
+    for version_id, node_id in [(4, node.node_id), (5, None), (7, node.node_id)]:
+        session.add(models.Version(version_id=version_id, node_id=node_id,
+                                   created=now))
+        session.add(models.Operation(version_id=version_id, row_id=None,
+                                     content_type_id=1, command='u'))
+    session.commit()
+    assert not repair_required(None)
+    assert not repair_required(3)
+
+    result = trim(now=now)
+    assert result.watermark == 7
+    assert not repair_required(7)
+    assert repair_required(5)
+    assert repair_required(None)
+    # a later trim that deletes nothing new keeps the mark
+    trim(now=now)
+    assert Session().query(models.TrimMark).count() == 1
+
+
+@with_setup(setup, teardown)
+def test_trim_batches_fit_in_sql_variables():
+    now = datetime.datetime.now()
+    session = Session()
+    node = session.query(models.Node).first()
+    for version_id in (1, 2):
+        session.add(models.Version(version_id=version_id, created=now,
+                                   node_id=node.node_id))
+    session.flush()
+    session.bulk_insert_mappings(models.Operation, [
+        dict(version_id=1, row_id=None, content_type_id=1, command='u')
+        for _ in range(core.MAX_SQL_VARIABLES + 50)])
+    session.commit()
+
+    sizes = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        sizes.append(len(parameters))
+    engine = core.get_engine()
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        result = trim(batch_size=5000, now=now)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    assert result.operations == core.MAX_SQL_VARIABLES + 50
+    assert max(sizes) <= core.MAX_SQL_VARIABLES